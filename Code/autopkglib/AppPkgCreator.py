@@ -77,6 +77,23 @@ class AppPkgCreator(DmgMounter, PkgCreator):
             "description": "Description of interesting results."
         },
     }
+    memo_inputs = (
+        "app_path",
+        "pathname",
+        "pkg_path",
+        "bundleid",
+        "version",
+        "force_pkg_build",
+        "RECIPE_CACHE_DIR",
+    )
+
+    def memo_input_paths(self):
+        """The app, or the disk image it's on"""
+        if self.env.get("app_path"):
+            return [self.env["app_path"]]
+        if self.env.get("pathname"):
+            return [self.env["pathname"] + "/*.app"]
+        return []
 
     def read_info_plist(self, app_path):
         """Read Contents/Info.plist from the app."""
@@ -69,6 +69,15 @@ class DmgCreator(Processor):
         },
     }
     output_variables = {}
+    memo_inputs = (
+        "dmg_path",
+        "dmg_format",
+        "dmg_filesystem",
+        "dmg_zlib_level",
+        "dmg_megabytes",
+    )
+    memo_input_files = ("dmg_root",)
+    memo_output_files = ("dmg_path",)
 
     def main(self):
         # Remove existing dmg if it exists.
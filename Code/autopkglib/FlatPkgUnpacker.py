@@ -24,6 +24,7 @@ from glob import glob
 
 from autopkglib import ProcessorError
 from autopkglib.DmgMounter import DmgMounter
+from autopkglib.xar import XarArchive, XarError
 
 __all__ = ["FlatPkgUnpacker"]
 
@@ -47,7 +48,8 @@ class FlatPkgUnpacker(DmgMounter):
             "description": (
                 "If true, 'Payload' files will be skipped. "
                 "Defaults to False. Note if this option is used then the "
-                "files are extracted using xar(1) instead of pkgutil(1). "
+                "files are extracted directly from the xar archive instead "
+                "of with pkgutil(1). "
                 "This means components of the package will not be "
                 "extracted such as scripts."
             ),
@@ -69,9 +71,21 @@ class FlatPkgUnpacker(DmgMounter):
         },
     }
     output_variables = {}
+    memo_inputs = (
+        "flat_pkg_path",
+        "skip_payload",
+        "destination_path",
+        "purge_destination",
+    )
+    memo_input_files = ("flat_pkg_path",)
+    memo_output_files = ("destination_path",)
 
     source_path = None
 
+    def memo_replace_outputs(self):
+        """pkgutil expands into a new destination directory"""
+        return super().memo_replace_outputs() or not self.env.get("skip_payload")
+
     def unpack_flat_pkg(self):
         """Unpacks a flat package using either xar or pkgutil"""
         # Create the directory if needed.
@@ -99,29 +113,14 @@ class FlatPkgUnpacker(DmgMounter):
             self.pkgutil_expand()
 
     def xar_expand(self):
-        """Uses xar to expand an archive"""
+        """Expands an archive in-process, like xar -x"""
+        exclude = "Payload" if self.env.get("skip_payload") else None
         try:
-            xarcmd = [
-                "/usr/bin/xar",
-                "-x",
-                "-C",
-                self.env["destination_path"],
-                "-f",
-                self.source_path,
-            ]
-            if self.env.get("skip_payload"):
-                xarcmd.extend(["--exclude", "Payload"])
-            proc = subprocess.Popen(
-                xarcmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
-            )
-            (_, stderr) = proc.communicate()
-        except OSError as err:
-            raise ProcessorError(
-                f"xar execution failed with error code {err.errno}: {err.strerror}"
-            )
-        if proc.returncode != 0:
+            with XarArchive(self.source_path) as archive:
+                archive.extractall(self.env["destination_path"], exclude=exclude)
+        except (OSError, XarError) as err:
             raise ProcessorError(
-                f"extraction of {self.env['flat_pkg_path']} with xar failed: {stderr}"
+                f"extraction of {self.env['flat_pkg_path']} with xar failed: {err}"
             )
 
     def pkgutil_expand(self):
@@ -33,6 +33,14 @@ class MunkiCatalogBuilder(Processor):
                 "If not defined or False, causes running makecatalogs to be skipped."
             ),
         },
+        "MUNKI_BATCH_IMPORT": {
+            "required": False,
+            "description": (
+                "If True, makecatalogs is skipped because catalogs are "
+                "updated once at the end of the run. Set by "
+                "'autopkg run --munki-batch'."
+            ),
+        },
     }
     output_variables = {}
     description = __doc__
@@ -44,6 +52,12 @@ class MunkiCatalogBuilder(Processor):
         if not self.env.get("munki_repo_changed"):
             self.output("Skipping makecatalogs because repo is unchanged.")
             return
+        if self.env.get("MUNKI_BATCH_IMPORT"):
+            self.output(
+                "Skipping makecatalogs because catalogs will be updated at the "
+                "end of the run."
+            )
+            return
 
         # Generate arguments for makecatalogs.
         args = ["/usr/local/munki/makecatalogs", self.env["MUNKI_REPO"]]
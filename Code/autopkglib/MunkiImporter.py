@@ -18,9 +18,12 @@
 import os
 import plistlib
 import shutil
+import sqlite3
 import subprocess
 
 from autopkglib import Processor, ProcessorError
+from autopkglib.digestcache import file_digest
+from autopkglib.munkiindex import MunkiRepoIndex
 
 __all__ = ["MunkiImporter"]
 
@@ -122,123 +125,24 @@ class MunkiImporter(Processor):
     }
     description = __doc__
 
-    def make_catalog_db(self):
-        """Reads the 'all' catalog and returns a dict we can use like a
-         database"""
-
-        repo_path = self.env["MUNKI_REPO"]
-        all_items_path = os.path.join(repo_path, "catalogs", "all")
-        if not os.path.exists(all_items_path):
-            # might be an error, or might be a brand-new empty repo
-            catalogitems = []
-        else:
-            try:
-                with open(all_items_path, "rb") as f:
-                    catalogitems = plistlib.load(f)
-            except OSError as err:
-                raise ProcessorError(
-                    f"Error reading 'all' catalog from Munki repo: {err}"
-                )
-
-        pkgid_table = {}
-        app_table = {}
-        installer_item_table = {}
-        hash_table = {}
-        checksum_table = {}
-        files_table = {}
-
-        itemindex = -1
-        for item in catalogitems:
-            itemindex = itemindex + 1
-            name = item.get("name", "NO NAME")
-            vers = item.get("version", "NO VERSION")
-
-            if name == "NO NAME" or vers == "NO VERSION":
-                # skip this item
-                continue
-
-            # add to hash table
-            if "installer_item_hash" in item:
-                if not item["installer_item_hash"] in hash_table:
-                    hash_table[item["installer_item_hash"]] = []
-                hash_table[item["installer_item_hash"]].append(itemindex)
-
-            # add to installer item table
-            if "installer_item_location" in item:
-                installer_item_name = os.path.basename(item["installer_item_location"])
-                if installer_item_name not in installer_item_table:
-                    installer_item_table[installer_item_name] = {}
-                if vers not in installer_item_table[installer_item_name]:
-                    installer_item_table[installer_item_name][vers] = []
-                installer_item_table[installer_item_name][vers].append(itemindex)
-
-            # add to table of receipts
-            for receipt in item.get("receipts", []):
-                try:
-                    if "packageid" in receipt and "version" in receipt:
-                        pkgid = receipt["packageid"]
-                        pkgvers = receipt["version"]
-                        if pkgid not in pkgid_table:
-                            pkgid_table[pkgid] = {}
-                        if pkgvers not in pkgid_table[pkgid]:
-                            pkgid_table[pkgid][pkgvers] = []
-                        pkgid_table[pkgid][pkgvers].append(itemindex)
-                except TypeError:
-                    # skip this receipt
-                    continue
-
-            # add to table of installed applications
-            for install in item.get("installs", []):
-                try:
-                    if install.get("type") in ("application", "bundle"):
-                        if "path" in install:
-                            if "version_comparison_key" in install:
-                                app_version = install[install["version_comparison_key"]]
-                            else:
-                                app_version = install["CFBundleShortVersionString"]
-                            if install["path"] not in app_table:
-                                app_table[install["path"]] = {}
-                            if vers not in app_table[install["path"]]:
-                                app_table[install["path"]][app_version] = []
-                            app_table[install["path"]][app_version].append(itemindex)
-                    if install.get("type") == "file":
-                        if "path" in install:
-                            if "md5checksum" in install:
-                                cksum = install["md5checksum"]
-
-                                if cksum not in list(checksum_table.keys()):
-                                    checksum_table[cksum] = []
-
-                                checksum_table[cksum].append(
-                                    {"path": install["path"], "index": itemindex}
-                                )
-                            else:
-                                path = install["path"]
-
-                                if path not in list(files_table.keys()):
-                                    files_table[path] = []
-
-                                files_table[path].append(
-                                    {"path": install["path"], "index": itemindex}
-                                )
-
-                except (TypeError, KeyError):
-                    # skip this item
-                    continue
-
-        pkgdb = {}
-        pkgdb["hashes"] = hash_table
-        pkgdb["receipts"] = pkgid_table
-        pkgdb["applications"] = app_table
-        pkgdb["installer_items"] = installer_item_table
-        pkgdb["checksums"] = checksum_table
-        pkgdb["files"] = files_table
-        pkgdb["items"] = catalogitems
-
-        return pkgdb
+    def repo_index(self):
+        """Returns the index of the Munki repo's pkginfo files, brought up to
+        date with any that were added, changed or removed since the last run"""
+        index = None
+        try:
+            index = MunkiRepoIndex(
+                self.env["MUNKI_REPO"], cache_dir=self.env.get("CACHE_DIR")
+            )
+            changed = index.sync()
+        except (OSError, sqlite3.Error) as err:
+            if index:
+                index.close()
+            raise ProcessorError(f"Error indexing Munki repo: {err}")
+        self.output(f"Updated {changed} pkginfo(s) in repo index", verbose_level=3)
+        return index
 
     def find_matching_item_in_repo(self, pkginfo):
-        """Looks through all catalog for items matching the one
+        """Looks through the repo for items matching the one
         described by pkginfo. Returns a matching item if found."""
 
         if not pkginfo.get("installer_item_hash"):
@@ -249,15 +153,56 @@ class MunkiImporter(Processor):
             # the check
             return None
 
-        pkgdb = self.make_catalog_db()
+        index = self.repo_index()
+        try:
+            return self.find_matching_item_in_index(index, pkginfo)
+        finally:
+            index.close()
+
+    def find_item_with_same_hash(self):
+        """Looks up pkg_path's checksum in the repo index, so an item that's
+        already been imported is found without running makepkginfo. The
+        checksum comes from the digest cache if pkg_path hasn't changed since
+        it was last hashed. Returns the matching item, or None."""
+        if self.env.get("force_munkiimport") or not os.path.isfile(
+            self.env["pkg_path"]
+        ):
+            return None
+        try:
+            item_hash = file_digest(
+                self.env["pkg_path"], cache_dir=self.env.get("CACHE_DIR")
+            )
+        except OSError as err:
+            raise ProcessorError(f"Can't read {self.env['pkg_path']}: {err}")
+        index = self.repo_index()
+        try:
+            return index.first_item(index.ids_with_hash(item_hash))
+        finally:
+            index.close()
+
+    def use_matching_item(self, matchingitem):
+        """Sets output variables for an item that's already in the repo"""
+        self.env["pkginfo_repo_path"] = ""
+        # set env["pkg_repo_path"] to the path of the matching item
+        self.env["pkg_repo_path"] = os.path.join(
+            self.env["MUNKI_REPO"], "pkgs", matchingitem["installer_item_location"]
+        )
+        self.env["munki_info"] = {}
+        if "munki_repo_changed" not in self.env:
+            self.env["munki_repo_changed"] = False
 
+        self.output(
+            f"Item {os.path.basename(self.env['pkg_path'])} already exists in the "
+            f"munki repo as pkgs/{matchingitem['installer_item_location']}."
+        )
+
+    def find_matching_item_in_index(self, index, pkginfo):
+        """Queries the repo index for an item matching pkginfo"""
         # match hashes for the pkg or dmg
-        if "installer_item_hash" in pkginfo:
-            pkgdb = self.make_catalog_db()
-            matchingindexes = pkgdb["hashes"].get(pkginfo["installer_item_hash"])
-            if matchingindexes:
-                # we have an item with the exact same checksum hash in the repo
-                return pkgdb["items"][matchingindexes[0]]
+        matching_ids = index.ids_with_hash(pkginfo["installer_item_hash"])
+        if matching_ids:
+            # we have an item with the exact same checksum hash in the repo
+            return index.first_item(matching_ids)
 
         # try to match against installed applications
         applist = [
@@ -266,54 +211,49 @@ class MunkiImporter(Processor):
             if item.get("type") in ("application", "bundle") and "path" in item
         ]
         if applist:
-            matching_indexes = []
+            matching_ids = None
             for app in applist:
-                app_path = app["path"]
                 if "version_comparison_key" in app:
                     app_version = app[app["version_comparison_key"]]
                 else:
                     app_version = app["CFBundleShortVersionString"]
-                match = pkgdb["applications"].get(app_path, {}).get(app_version)
+                match = index.ids_with_application(app["path"], app_version)
                 if not match:
                     # no entry for app['path'] and app['version']
                     # no point in continuing
                     return None
+                if matching_ids is None:
+                    matching_ids = match
                 else:
-                    if not matching_indexes:
-                        # store the array of matching item indexes
-                        matching_indexes = set(match)
-                    else:
-                        # we're only interested in items that match
-                        # all applications
-                        matching_indexes = matching_indexes.intersection(set(match))
+                    # we're only interested in items that match
+                    # all applications
+                    matching_ids &= match
 
             # did we find any matches?
-            if matching_indexes:
-                return pkgdb["items"][list(matching_indexes)[0]]
+            if matching_ids:
+                return index.first_item(matching_ids)
 
         # fall back to matching against receipts
-        matching_indexes = []
+        matching_ids = None
         for item in pkginfo.get("receipts", []):
             pkgid = item.get("packageid")
             vers = item.get("version")
             if pkgid and vers:
-                match = pkgdb["receipts"].get(pkgid, {}).get(vers)
+                match = index.ids_with_receipt(pkgid, vers)
                 if not match:
                     # no entry for pkgid and vers
                     # no point in continuing
                     return None
+                if matching_ids is None:
+                    matching_ids = match
                 else:
-                    if not matching_indexes:
-                        # store the array of matching item indexes
-                        matching_indexes = set(match)
-                    else:
-                        # we're only interested in items that match
-                        # all receipts
-                        matching_indexes = matching_indexes.intersection(set(match))
+                    # we're only interested in items that match
+                    # all receipts
+                    matching_ids &= match
 
         # did we find any matches?
-        if matching_indexes:
-            return pkgdb["items"][list(matching_indexes)[0]]
+        if matching_ids:
+            return index.first_item(matching_ids)
 
         # try to match against install md5checksums
         filelist = [
@@ -321,19 +261,11 @@ class MunkiImporter(Processor):
             for item in pkginfo.get("installs", [])
             if item["type"] == "file" and "path" in item and "md5checksum" in item
         ]
-        if filelist:
-            for fileitem in filelist:
-                cksum = fileitem["md5checksum"]
-                if cksum in pkgdb["checksums"]:
-                    cksum_matches = pkgdb["checksums"][cksum]
-                    for cksum_match in cksum_matches:
-                        if cksum_match["path"] == fileitem["path"]:
-                            matching_pkg = pkgdb["items"][cksum_match["index"]]
-
-                            # TODO: maybe match pkg name, too?
-                            # if matching_pkg['name'] == pkginfo['name']:
-
-                            return matching_pkg
+        for fileitem in filelist:
+            match = index.ids_with_file(fileitem["path"], fileitem["md5checksum"])
+            if match:
+                # TODO: maybe match pkg name, too?
+                return index.first_item(match)
 
         # Try to match against a simple list of files and paths
         # where our pkginfo version also matches
@@ -344,18 +276,13 @@ class MunkiImporter(Processor):
             and "path" in item
             and "md5checksum" not in item
         ]
-        if path_only_filelist:
-            for pathitem in path_only_filelist:
-                path = pathitem["path"]
-                if path in pkgdb["files"]:
-                    path_matches = pkgdb["files"][path]
-                    for path_match in path_matches:
-                        if path_match["path"] == pathitem["path"]:
-                            matching_pkg = pkgdb["items"][path_match["index"]]
-                            # make sure we do this only for items that also
-                            # match our pkginfo version
-                            if matching_pkg["version"] == pkginfo["version"]:
-                                return matching_pkg
+        for pathitem in path_only_filelist:
+            for pkginfo_id in sorted(index.ids_with_file(pathitem["path"])):
+                matching_pkg = index.item(pkginfo_id)
+                # make sure we do this only for items that also
+                # match our pkginfo version
+                if matching_pkg["version"] == pkginfo["version"]:
+                    return matching_pkg
 
         # if we get here, we found no matches
         return None
@@ -461,6 +388,12 @@ class MunkiImporter(Processor):
         # clear any pre-exising summary result
         if "munki_importer_summary_result" in self.env:
             del self.env["munki_importer_summary_result"]
+        # an identical pkg/dmg is already in the repo; no need for makepkginfo
+        matchingitem = self.find_item_with_same_hash()
+        if matchingitem:
+            self.use_matching_item(matchingitem)
+            return
+
         # Generate arguments for makepkginfo.
         args = ["/usr/local/munki/makepkginfo", self.env["pkg_path"]]
         if self.env.get("munkiimport_pkgname"):
@@ -523,19 +456,7 @@ class MunkiImporter(Processor):
         # check to see if this item is already in the repo
         matchingitem = self.find_matching_item_in_repo(pkginfo)
         if matchingitem:
-            self.env["pkginfo_repo_path"] = ""
-            # set env["pkg_repo_path"] to the path of the matching item
-            self.env["pkg_repo_path"] = os.path.join(
-                self.env["MUNKI_REPO"], "pkgs", matchingitem["installer_item_location"]
-            )
-            self.env["munki_info"] = {}
-            if "munki_repo_changed" not in self.env:
-                self.env["munki_repo_changed"] = False
-
-            self.output(
-                f"Item {os.path.basename(self.env['pkg_path'])} already exists in the "
-                f"munki repo as pkgs/{matchingitem['installer_item_location']}."
-            )
+            self.use_matching_item(matchingitem)
             return
 
         # copy pkg/dmg to repo
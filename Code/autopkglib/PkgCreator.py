@@ -18,10 +18,10 @@
 import os.path
 import plistlib
 import socket
-import subprocess
 import xml.etree.ElementTree as ET
 
 from autopkglib import Processor, ProcessorError
+from autopkglib.xar import XarArchive, XarError
 
 AUTO_PKG_SOCKET = "/var/run/autopkgserver"
 
@@ -64,6 +64,39 @@ class PkgCreator(Processor):
             "description": "Description of interesting results."
         },
     }
+    # request keys may also come from env variables of the same name
+    memo_inputs = (
+        "pkg_request",
+        "force_pkg_build",
+        "RECIPE_CACHE_DIR",
+        "RECIPE_DIR",
+        "PARENT_RECIPES",
+        "pkgroot",
+        "pkgname",
+        "pkgtype",
+        "id",
+        "version",
+        "infofile",
+        "resources",
+        "options",
+        "scripts",
+    )
+    memo_output_files = ("pkg_path",)
+
+    def memo_input_paths(self):
+        """The pkgroot, infofile, resources and scripts of the request"""
+        request = self.env["pkg_request"]
+        paths = []
+        for key in ("pkgroot", "infofile", "resources", "scripts"):
+            value = request.get(key, self.env.get(key))
+            if value and not value.startswith("/"):
+                try:
+                    value = self.find_path_for_relpath(value)
+                except ProcessorError:
+                    pass
+            if value:
+                paths.append(value)
+        return paths
 
     def find_path_for_relpath(self, relpath):
         """Searches for the relative path.
@@ -87,29 +120,17 @@ class PkgCreator(Processor):
 
         raise ProcessorError(f"Can't find {relpath}")
 
-    def xar_expand(self, source_path):
-        """Uses xar to expand an archive"""
+    def read_packageinfo(self, source_path):
+        """Reads the PackageInfo file of a flat package straight from the
+        archive. Returns None if the package has no PackageInfo."""
         try:
-            xarcmd = [
-                "/usr/bin/xar",
-                "-x",
-                "-C",
-                self.env.get("RECIPE_CACHE_DIR"),
-                "-f",
-                source_path,
-                "PackageInfo",
-            ]
-            proc = subprocess.Popen(
-                xarcmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
-            )
-            (_, stderr) = proc.communicate()
-        except OSError as err:
-            raise ProcessorError(
-                f"xar execution failed with error code {err.errno}: {err.strerror}"
-            )
-        if proc.returncode != 0:
+            with XarArchive(source_path) as archive:
+                if "PackageInfo" not in archive.names():
+                    return None
+                return archive.read("PackageInfo")
+        except (OSError, XarError) as err:
             raise ProcessorError(
-                f"extraction of {source_path} with xar failed: {stderr}"
+                f"reading PackageInfo from {source_path} failed: {err}"
             )
 
     def pkg_already_exists(self, pkg_path, identifier, version):
@@ -119,7 +140,7 @@ class PkgCreator(Processor):
         if os.path.exists(pkg_path) and not self.env.get("force_pkg_build"):
             self.output(f"Package already exists at path {pkg_path}.")
             try:
-                self.xar_expand(pkg_path)
+                packageinfo = self.read_packageinfo(pkg_path)
             except ProcessorError as err:
                 self.output(err)
                 # just remove the pkg and return False
@@ -129,11 +150,10 @@ class PkgCreator(Processor):
                 except OSError as err:
                     raise ProcessorError(f"Could not remove {pkg_path}: {err}")
                 return False
-            packageinfo_file = os.path.join(self.env["RECIPE_CACHE_DIR"], "PackageInfo")
-            if not os.path.exists(packageinfo_file):
+            if packageinfo is None:
                 self.output(
                     "Failed to parse existing package, as no PackageInfo "
-                    "file could be found in the extracted archive."
+                    "file could be found in the archive."
                 )
                 # just remove the pkg and return False
                 self.output(f"Removing {pkg_path}")
@@ -143,15 +163,9 @@ class PkgCreator(Processor):
                     raise ProcessorError(f"Could not remove {pkg_path}: {err}")
                 return False
             # parse the PackageInfo file for version and identifier
-            tree = ET.parse(packageinfo_file)
-            root = tree.getroot()
+            root = ET.fromstring(packageinfo)
             local_version = root.attrib["version"]
             local_id = root.attrib["identifier"]
-            try:
-                # clean up
-                os.unlink(packageinfo_file)
-            except OSError:
-                pass
             if local_version == version and local_id == identifier:
                 return True
         return False
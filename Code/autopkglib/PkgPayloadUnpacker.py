@@ -20,6 +20,7 @@ import shutil
 import subprocess
 
 from autopkglib import Processor, ProcessorError
+from autopkglib.payload import PayloadError, unpack_payload
 
 __all__ = ["PkgPayloadUnpacker"]
 
@@ -43,12 +44,26 @@ class PkgPayloadUnpacker(Processor):
                 "be removed before unpacking."
             ),
         },
+        "payload_unpacker": {
+            "required": False,
+            "default": "ditto",
+            "description": (
+                "How to unpack the payload: 'ditto' uses /usr/bin/ditto; "
+                "'native' streams it in-process, decompressing pbzx payloads on "
+                "all CPU cores. The native unpacker doesn't fold '._' "
+                "AppleDouble members back into extended attributes or resource "
+                "forks as ditto does. Defaults to 'ditto'."
+            ),
+        },
     }
     output_variables = {}
     description = __doc__
+    memo_inputs = ("pkg_payload_path", "destination_path", "purge_destination")
+    memo_input_files = ("pkg_payload_path",)
+    memo_output_files = ("destination_path",)
 
     def unpack_pkg_payload(self):
-        """Uses ditto to unpack a package payload into destination_path"""
+        """Unpacks a package payload into destination_path"""
         # Create the destination directory if needed.
         if not os.path.exists(self.env["destination_path"]):
             try:
@@ -68,6 +83,32 @@ class PkgPayloadUnpacker(Processor):
                 except OSError as err:
                     raise ProcessorError(f"Can't remove {path}: {err.strerror}")
 
+        if self.env["payload_unpacker"] == "native":
+            self.native_unpack()
+        elif self.env["payload_unpacker"] == "ditto":
+            self.ditto_unpack()
+        else:
+            raise ProcessorError(
+                f"Unknown payload_unpacker {self.env['payload_unpacker']}"
+            )
+        self.output(
+            f"Unpacked {self.env['pkg_payload_path']} to {self.env['destination_path']}"
+        )
+
+    def native_unpack(self):
+        """Streams the payload's cpio archive into destination_path"""
+        try:
+            count = unpack_payload(
+                self.env["pkg_payload_path"], self.env["destination_path"]
+            )
+        except (OSError, PayloadError) as err:
+            raise ProcessorError(
+                f"extraction of {self.env['pkg_payload_path']} failed: {err}"
+            )
+        self.output(f"Extracted {count} items", verbose_level=2)
+
+    def ditto_unpack(self):
+        """Uses ditto to unpack the payload into destination_path"""
         try:
             dittocmd = [
                 "/usr/bin/ditto",
@@ -89,9 +130,6 @@ class PkgPayloadUnpacker(Processor):
                 f"extraction of {self.env['pkg_payload_path']} with ditto failed: "
                 f"{err_out}"
             )
-        self.output(
-            f"Unpacked {self.env['pkg_payload_path']} to {self.env['destination_path']}"
-        )
 
     def main(self):
         self.unpack_pkg_payload()
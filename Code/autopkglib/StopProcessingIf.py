@@ -53,7 +53,8 @@ class StopProcessingIf(Processor):
         except Exception as err:
             raise ProcessorError(f"Predicate error for '{predicate_string}': {err}")
 
-        result = predicate.evaluateWithObject_(self.env)
+        # a plain dict, which PyObjC bridges to an NSDictionary
+        result = predicate.evaluateWithObject_(self.env.copy())
         self.output(f"({predicate_string}) is {result}")
         return result
 
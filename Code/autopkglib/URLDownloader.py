@@ -16,10 +16,18 @@
 # limitations under the License.
 """See docstring for URLDownloader class"""
 
+import concurrent.futures
+import hashlib
 import os.path
+import plistlib
+import sqlite3
+import subprocess
 import tempfile
 
 from autopkglib import BUNDLE_ID, ProcessorError, is_mac
+from autopkglib.digestcache import get_digest_cache, hash_file
+from autopkglib.downloadstore import DownloadStore
+from autopkglib.runtrace import carry_counters
 from autopkglib.URLGetter import URLGetter
 
 if is_mac():
@@ -87,6 +95,44 @@ class URLDownloader(URLGetter):
                 "Defaults to False."
             ),
         },
+        "download_segments": {
+            "default": 1,
+            "required": False,
+            "description": (
+                "Number of byte ranges of the download to fetch at once. Useful "
+                "for servers that throttle each connection. Only used if the "
+                "server supports byte ranges and sends an ETag or Last-Modified "
+                "header, and the download is at least 1 MB per segment. "
+                "Defaults to 1 (a single connection)."
+            ),
+        },
+        "calculate_md5": {
+            "default": False,
+            "required": False,
+            "description": (
+                "If True, also calculate the MD5 checksum of the download "
+                "while it downloads, in addition to its SHA-256 checksum. "
+                "Defaults to False."
+            ),
+        },
+        "DOWNLOAD_STORE_DIR": {
+            "required": False,
+            "description": (
+                "Path to a download store shared by all recipes. If set, "
+                "downloads are stored there once per unique content, and "
+                "recipe download dirs get clones or hard links of them. A "
+                "download already in the store for the same URL is reused "
+                "if the server reports it unchanged. Normally set as a "
+                "preference."
+            ),
+        },
+        "DOWNLOAD_STORE_MAX_MB": {
+            "required": False,
+            "description": (
+                "Size in megabytes the download store may grow to before its "
+                "least recently used downloads are evicted. Unlimited if unset."
+            ),
+        },
         "PKG": {
             "required": False,
             "description": (
@@ -102,6 +148,17 @@ class URLDownloader(URLGetter):
             "description": "last-modified header for the downloaded item."
         },
         "etag": {"description": "etag header for the downloaded item."},
+        "download_sha256": {
+            "description": (
+                "SHA-256 checksum of the downloaded item, calculated while it "
+                "was downloaded."
+            )
+        },
+        "download_md5": {
+            "description": (
+                "MD5 checksum of the downloaded item, if calculate_md5 is True."
+            )
+        },
         "download_changed": {
             "description": (
                 "Boolean indicating if the download has changed since the "
@@ -113,12 +170,52 @@ class URLDownloader(URLGetter):
         },
     }
 
-    def getxattr(self, attr):
-        """Get a named xattr from a file. Return None if not present."""
-        if attr in xattr.listxattr(self.env["pathname"]):
-            return xattr.getxattr(self.env["pathname"], attr).decode()
+    # smallest byte range worth fetching over its own connection
+    min_segment_size = 2 ** 20
+
+    def sidecar_path(self, path):
+        """Return the file holding the xattrs of a download that shares its
+        inode with other recipes' downloads through the download store."""
+        directory, filename = os.path.split(path)
+        return os.path.join(directory, f".{filename}.xattrs.plist")
+
+    def read_sidecar(self, path):
+        """Return the xattrs stored in the sidecar of path, or None if it has
+        none."""
+        try:
+            with open(self.sidecar_path(path), "rb") as f:
+                return plistlib.load(f)
+        except (OSError, plistlib.InvalidFileException, ValueError):
+            return None
+
+    def getxattr(self, attr, path=None):
+        """Get a named xattr from a file (pathname by default). Return None if
+        not present. A hard linked file's xattrs are another recipe's, so
+        they're read from its sidecar instead."""
+        path = path or self.env["pathname"]
+        sidecar = self.read_sidecar(path)
+        if sidecar is not None:
+            return sidecar.get(attr)
+        if os.stat(path).st_nlink > 1:
+            return None
+        if attr in xattr.listxattr(path):
+            return xattr.getxattr(path, attr).decode()
         return None
 
+    def setxattr(self, attr, value, path=None):
+        """Set a named xattr on a file (pathname by default), or in its
+        sidecar if the file is hard linked, as the download store links one
+        copy of a download to every recipe that downloaded it."""
+        path = path or self.env["pathname"]
+        sidecar = self.read_sidecar(path)
+        if sidecar is None and os.stat(path).st_nlink == 1:
+            xattr.setxattr(path, attr, value.encode())
+            return
+        sidecar = sidecar or {}
+        sidecar[attr] = value
+        with open(self.sidecar_path(path), "wb") as f:
+            plistlib.dump(sidecar, f)
+
     def prepare_base_curl_cmd(self):
         """Assemble base curl command and return it."""
         curl_cmd = [
@@ -142,15 +239,24 @@ class URLDownloader(URLGetter):
         if os.path.exists(pathname) and os.path.getsize(pathname) == 0:
             os.remove(pathname)
 
-    def prepare_download_curl_cmd(self, pathname_temporary):
-        """Assemble file download curl command and return it."""
+    def prepare_download_curl_cmd(
+        self, pathname_temporary, resume_offset=0, resume_validator=None
+    ):
+        """Assemble file download curl command and return it. If resume_offset
+        is set, the download continues at that byte of pathname_temporary as
+        long as the server's ETag/Last-Modified still matches resume_validator.
+        """
         curl_cmd = self.prepare_base_curl_cmd()
         curl_cmd.extend(["--fail", "--output", pathname_temporary])
         # Add the common options
         self.add_curl_common_opts(curl_cmd)
         # Clear out a potentially zero-byte file
         self.clear_zero_file(self.env["pathname"])
-        self.add_curl_headers(curl_cmd, self.produce_etag_headers(self.env["pathname"]))
+        headers = self.produce_etag_headers(self.env["pathname"])
+        if resume_offset:
+            curl_cmd.extend(["--continue-at", str(resume_offset)])
+            headers["If-Range"] = resume_validator
+        self.add_curl_headers(curl_cmd, headers)
         return curl_cmd
 
     def clear_vars(self):
@@ -162,9 +268,16 @@ class URLDownloader(URLGetter):
         # XATTR names for Etag and Last-Modified headers
         self.xattr_etag = f"{BUNDLE_ID}.etag"
         self.xattr_last_modified = f"{BUNDLE_ID}.last-modified"
+        # XATTR names for checksums, by hashlib algorithm name
+        self.xattr_digests = {
+            "sha256": f"{BUNDLE_ID}.sha256",
+            "md5": f"{BUNDLE_ID}.md5",
+        }
 
         self.env["last_modified"] = ""
         self.env["etag"] = ""
+        self.env["download_sha256"] = ""
+        self.env["download_md5"] = ""
         self.existing_file_size = None
 
     def prefetch_filename(self):
@@ -241,6 +354,152 @@ class URLDownloader(URLGetter):
         os.chmod(pathname_temporary, 0o644)
         return pathname_temporary
 
+    def partial_download_path(self, download_dir, filename):
+        """Return the path the download is written to until it's complete."""
+        return os.path.join(download_dir, f".{filename}.partial")
+
+    def resume_point(self, pathname_partial):
+        """Return (offset, validator) to resume an interrupted download at, or
+        (0, None) to start over. A partial download can only be resumed if the
+        ETag or Last-Modified header it was downloaded with is known."""
+        if os.path.exists(pathname_partial):
+            size = os.path.getsize(pathname_partial)
+            validator = self.getxattr(
+                self.xattr_etag, pathname_partial
+            ) or self.getxattr(self.xattr_last_modified, pathname_partial)
+            if size and validator:
+                self.output(f"Resuming partial download at byte {size}")
+                return size, validator
+            os.remove(pathname_partial)
+        # Set permissions on the file as curl would set for a newly-downloaded
+        # file, in case it's eventually copied to a Munki repo and needs to be
+        # readable by (for example) the webserver.
+        with open(pathname_partial, "wb"):
+            pass
+        os.chmod(pathname_partial, 0o644)
+        return 0, None
+
+    def keep_partial_download(self, pathname_partial, header):
+        """After a failed download, keep what was downloaded so far if it can
+        be resumed later, otherwise discard it."""
+        if not os.path.exists(pathname_partial):
+            return
+        if (
+            header.get("http_result_code") in ("200", "206")
+            and (header.get("etag") or header.get("last-modified"))
+            and os.path.getsize(pathname_partial)
+        ):
+            for attr, value in (
+                (self.xattr_etag, header.get("etag")),
+                (self.xattr_last_modified, header.get("last-modified")),
+            ):
+                if value:
+                    xattr.setxattr(pathname_partial, attr, value.encode())
+            self.output(
+                f"Kept partial download of {os.path.getsize(pathname_partial)} "
+                "bytes to resume next time"
+            )
+        else:
+            os.remove(pathname_partial)
+
+    def download_resumable(self, pathname_partial, digests):
+        """Download to pathname_partial over a single connection, resuming an
+        earlier interrupted download if possible. Return the parsed headers."""
+        offset, validator = self.resume_point(pathname_partial)
+        curl_cmd = self.prepare_download_curl_cmd(pathname_partial, offset, validator)
+        try:
+            raw_headers = self.download_with_curl(curl_cmd, digests=digests)
+        except ProcessorError as err:
+            curl_error = err.args[0] if err.args else None
+            if not isinstance(curl_error, subprocess.CalledProcessError):
+                raise
+            header = self.parse_headers(curl_error.output or "")
+            if offset and (
+                curl_error.returncode == 33 or header["http_result_code"] == "416"
+            ):
+                # The server changed the item or can't serve the rest of it
+                self.output("Partial download can't be resumed, starting over")
+                os.remove(pathname_partial)
+                return self.download_resumable(pathname_partial, digests)
+            self.keep_partial_download(pathname_partial, header)
+            raise
+        return self.parse_headers(raw_headers)
+
+    def download_segment(self, pathname_segment, first_byte, last_byte, validator):
+        """Download one byte range of the item to pathname_segment."""
+        curl_cmd = self.prepare_base_curl_cmd()
+        curl_cmd.extend(["--fail", "--output", pathname_segment])
+        curl_cmd.extend(["--range", f"{first_byte}-{last_byte}"])
+        self.add_curl_common_opts(curl_cmd)
+        self.add_curl_headers(curl_cmd, {"If-Range": validator})
+        header = self.parse_headers(self.download_with_curl(curl_cmd))
+        if header["http_result_code"] != "206" or os.path.getsize(pathname_segment) != (
+            last_byte - first_byte + 1
+        ):
+            raise ProcessorError(
+                f"Server didn't return bytes {first_byte}-{last_byte} as requested"
+            )
+
+    def download_segmented(self, pathname_partial, segments, digests):
+        """Download to pathname_partial as several byte ranges at once, then
+        join them. Return the parsed headers, or None if the server or item
+        don't allow it."""
+        curl_cmd = self.prepare_base_curl_cmd()
+        curl_cmd.append("--head")
+        self.add_curl_common_opts(curl_cmd)
+        self.clear_zero_file(self.env["pathname"])
+        self.add_curl_headers(curl_cmd, self.produce_etag_headers(self.env["pathname"]))
+        header = self.parse_headers(self.download_with_curl(curl_cmd))
+        if header["http_result_code"] == "304":
+            return header
+        size = int(header.get("content-length") or 0)
+        validator = header.get("etag") or header.get("last-modified")
+        if (
+            header["http_result_code"] != "200"
+            or header.get("accept-ranges") != "bytes"
+            or not validator
+            or size < segments * self.min_segment_size
+        ):
+            self.output("Can't download in segments, using a single connection")
+            return None
+
+        segment_size = -(-size // segments)
+        ranges = [
+            (f"{pathname_partial}.{index}", start, min(start + segment_size, size) - 1)
+            for index, start in enumerate(range(0, size, segment_size))
+        ]
+        self.output(f"Downloading {size} bytes in {len(ranges)} segments")
+        try:
+            # count the segments' curls and bytes against this step
+            download_segment = carry_counters(self.download_segment)
+            with concurrent.futures.ThreadPoolExecutor(len(ranges)) as executor:
+                futures = [
+                    executor.submit(download_segment, *byte_range, validator)
+                    for byte_range in ranges
+                ]
+                for future in futures:
+                    future.result()
+            # join the segments, checksumming on the way
+            hashers = {name: hashlib.new(name) for name in digests}
+            with open(pathname_partial, "wb") as partial:
+                for pathname_segment, _, _ in ranges:
+                    with open(pathname_segment, "rb") as segment:
+                        for chunk in iter(lambda: segment.read(2 ** 20), b""):
+                            partial.write(chunk)
+                            for hasher in hashers.values():
+                                hasher.update(chunk)
+            os.chmod(pathname_partial, 0o644)
+            for name, hasher in hashers.items():
+                digests[name] = hasher.hexdigest()
+        except ProcessorError as err:
+            self.output(f"Segmented download failed ({err}), using a single connection")
+            return None
+        finally:
+            for pathname_segment, _, _ in ranges:
+                if os.path.exists(pathname_segment):
+                    os.remove(pathname_segment)
+        return header
+
     def download_changed(self, header):
         """Check if downloaded file changed on server."""
         # If Content-Length header is present and we had a cached
@@ -251,6 +510,9 @@ class URLDownloader(URLGetter):
             "CHECK_FILESIZE_ONLY"
         ]:
             size_header = header.get("content-length")
+            if header["http_result_code"] == "206":
+                # a resumed download; the full size follows the range
+                size_header = header.get("content-range", "").rpartition("/")[2]
             if size_header and int(size_header) == self.existing_file_size:
                 self.env["download_changed"] = False
                 self.output(
@@ -289,11 +551,7 @@ class URLDownloader(URLGetter):
         """Store last-modified and etag headers in pathname xattr."""
         if header.get("last-modified"):
             self.env["last_modified"] = header.get("last-modified")
-            xattr.setxattr(
-                self.env["pathname"],
-                self.xattr_last_modified,
-                header.get("last-modified").encode(),
-            )
+            self.setxattr(self.xattr_last_modified, header.get("last-modified"))
             self.output(
                 f"Storing new Last-Modified header: {header.get('last-modified')}"
             )
@@ -301,11 +559,88 @@ class URLDownloader(URLGetter):
         self.env["etag"] = ""
         if header.get("etag"):
             self.env["etag"] = header.get("etag")
-            xattr.setxattr(
-                self.env["pathname"], self.xattr_etag, header.get("etag").encode()
-            )
+            self.setxattr(self.xattr_etag, header.get("etag"))
             self.output(f"Storing new ETag header: {header.get('etag')}")
 
+    def digest_names(self):
+        """Return the hashlib names of the checksums to calculate."""
+        if self.env.get("calculate_md5"):
+            return ["sha256", "md5"]
+        return ["sha256"]
+
+    def complete_digests(self, digests):
+        """Fill in any checksums that weren't calculated during download."""
+        missing = [name for name in self.digest_names() if not digests.get(name)]
+        if missing:
+            # nothing was streamed (an empty body); hash what's on disk
+            digests.update(hash_file(self.env["pathname"], missing))
+
+    def store_digests(self, digests):
+        """Store checksums calculated during download in output variables and
+        pathname xattrs."""
+        self.complete_digests(digests)
+        for name in self.digest_names():
+            self.env[f"download_{name}"] = digests[name]
+            self.setxattr(self.xattr_digests[name], digests[name])
+            self.output(f"Storing {name} checksum: {digests[name]}", verbose_level=2)
+        # after the xattrs are written, as that changes the file's ctime
+        cache = get_digest_cache(self.env.get("CACHE_DIR"))
+        if cache:
+            try:
+                cache.record(self.env["pathname"], digests)
+            except sqlite3.Error as err:
+                self.output(f"WARNING: Digest cache error: {err}")
+
+    def restore_digests(self):
+        """Set checksum output variables for an unchanged download from its
+        xattrs, if they were stored when it was downloaded."""
+        for name in self.digest_names():
+            self.env[f"download_{name}"] = self.getxattr(self.xattr_digests[name]) or ""
+
+    def download_store(self):
+        """Return the shared DownloadStore, or None if it's not enabled."""
+        if not self.env.get("DOWNLOAD_STORE_DIR"):
+            return None
+        max_mb = self.env.get("DOWNLOAD_STORE_MAX_MB")
+        return DownloadStore(
+            self.env["DOWNLOAD_STORE_DIR"], int(max_mb) * 2 ** 20 if max_mb else None
+        )
+
+    def fetch_from_download_store(self):
+        """If pathname doesn't exist yet but the last download from the URL is
+        in the download store, put it in place so only a conditional request
+        is needed. Return True if it did."""
+        store = self.download_store()
+        if not store or os.path.exists(self.env["pathname"]):
+            return False
+        entry = store.lookup(self.env["url"])
+        if not entry:
+            return False
+        store.materialize(entry, self.env["pathname"])
+        for attr, value in (
+            (self.xattr_etag, entry["etag"]),
+            (self.xattr_last_modified, entry["last_modified"]),
+            (self.xattr_digests["sha256"], entry["sha256"]),
+        ):
+            if value:
+                self.setxattr(attr, value)
+        self.output(f"Found last download of {self.env['url']} in the download store")
+        return True
+
+    def add_to_download_store(self, header, digests):
+        """Add a new download to the download store, if it's enabled."""
+        store = self.download_store()
+        if not store:
+            return
+        self.complete_digests(digests)
+        store.add(
+            self.env["pathname"],
+            digests["sha256"],
+            self.env["url"],
+            etag=header.get("etag", ""),
+            last_modified=header.get("last-modified", ""),
+        )
+
     def main(self):
         if not is_mac():
             raise ProcessorError("This processor is Mac-only!")
@@ -319,27 +654,45 @@ class URLDownloader(URLGetter):
             return
         download_dir = self.get_download_dir()
         self.env["pathname"] = os.path.join(download_dir, filename)
-        pathname_temporary = self.create_temp_file(download_dir)
-
-        # Prepare curl command
-        curl_cmd = self.prepare_download_curl_cmd(pathname_temporary)
-
-        # Execute curl command and parse headers
-        raw_headers = self.download_with_curl(curl_cmd)
-        header = self.parse_headers(raw_headers)
+        pathname_temporary = self.partial_download_path(download_dir, filename)
+        from_store = self.fetch_from_download_store()
+
+        # Download, checksumming the download as it arrives, and parse headers
+        digests = dict.fromkeys(self.digest_names())
+        header = None
+        segments = int(self.env.get("download_segments") or 1)
+        if segments > 1:
+            header = self.download_segmented(pathname_temporary, segments, digests)
+        if header is None:
+            header = self.download_resumable(pathname_temporary, digests)
 
         if self.download_changed(header):
             self.env["download_changed"] = True
         else:
             # Discard the temp file
-            os.remove(pathname_temporary)
+            if os.path.exists(pathname_temporary):
+                os.remove(pathname_temporary)
+            self.restore_digests()
+            if from_store:
+                # unchanged on the server, but new to this recipe
+                self.env["download_changed"] = True
+                self.store_digests(
+                    {name: self.env[f"download_{name}"] for name in self.digest_names()}
+                )
+                self.output(f"Using {self.env['pathname']} from the download store")
+                self.env["url_downloader_summary_result"] = {
+                    "summary_text": "The following new items were downloaded:",
+                    "data": {"download_path": self.env["pathname"]},
+                }
             return
 
         # New resource was downloaded. Move the temporary download file to the pathname
         self.move_temp_file(pathname_temporary)
+        self.add_to_download_store(header, digests)
 
-        # Save last-modified and etag headers to files xattr
+        # Save last-modified and etag headers and checksums to files xattr
         self.store_headers(header)
+        self.store_digests(digests)
 
         # Generate output messages and variables
         self.output(f"Downloaded {self.env['pathname']}")
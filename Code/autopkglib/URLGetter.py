@@ -20,6 +20,13 @@ import os.path
 import subprocess
 
 from autopkglib import Processor, ProcessorError, get_pref, is_executable, log_err
+from autopkglib.transport import (
+    DEFAULT_TRANSPORT,
+    TRANSPORTS,
+    UnsupportedCurlCommand,
+    get_transport,
+    host_slot,
+)
 
 __all__ = ["URLGetter"]
 
@@ -61,6 +68,10 @@ class URLGetter(Processor):
         if is_executable("/usr/bin/curl"):
             return "/usr/bin/curl"
 
+        if self.url_transport() == "native":
+            # only needed if a request falls back to curl
+            return "curl"
+
         raise ProcessorError("Unable to locate or execute any curl binary")
 
     def prepare_curl_cmd(self):
@@ -177,24 +188,60 @@ class URLGetter(Processor):
                     self.clear_header(header)
         return header
 
-    def execute_curl(self, curl_cmd, text=True):
-        """Execute curl command. Return stdout, stderr and return code."""
-        try:
-            result = subprocess.run(
-                curl_cmd,
-                shell=False,
-                bufsize=1,
-                capture_output=True,
-                check=True,
-                text=text,
+    def url_transport(self):
+        """Return the name of the transport used to run curl commands, in
+        priority order: env['URL_TRANSPORT'], app pref 'URL_TRANSPORT',
+        'curl'."""
+        transport = (
+            self.env.get("URL_TRANSPORT")
+            or get_pref("URL_TRANSPORT")
+            or DEFAULT_TRANSPORT
+        )
+        if transport not in TRANSPORTS:
+            raise ProcessorError(
+                f"Unknown URL_TRANSPORT '{transport}'. "
+                f"Valid values are: {', '.join(TRANSPORTS)}"
             )
+        return transport
+
+    def execute_curl(self, curl_cmd, text=True, digests=None):
+        """Execute curl command. Return stdout, stderr and return code.
+
+        If digests is a dict, its keys are hashlib algorithm names; their
+        values are set to the hex digests of the file downloaded with
+        --output, computed while it downloads."""
+        with host_slot(curl_cmd):
+            return self.run_curl_cmd(curl_cmd, text, digests)
+
+    def run_curl_cmd(self, curl_cmd, text=True, digests=None):
+        """Run curl_cmd with the selected transport."""
+        if self.url_transport() == "native":
+            try:
+                stdout, stderr, retcode = get_transport("native").execute(
+                    curl_cmd, text, digests
+                )
+            except UnsupportedCurlCommand as err:
+                self.output(
+                    f"Native transport can't run this request ({err}), using curl",
+                    verbose_level=4,
+                )
+            else:
+                if retcode:
+                    # same as running curl with check=True
+                    raise ProcessorError(
+                        subprocess.CalledProcessError(
+                            retcode, curl_cmd, output=stdout, stderr=stderr
+                        )
+                    )
+                return stdout, stderr, retcode
+        try:
+            return get_transport("curl").execute(curl_cmd, text, digests)
         except subprocess.CalledProcessError as e:
             raise ProcessorError(e)
-        return result.stdout, result.stderr, result.returncode
 
-    def download_with_curl(self, curl_cmd, text=True):
+    def download_with_curl(self, curl_cmd, text=True, digests=None):
         """Launch curl, return its output, and handle failures."""
-        proc_stdout, proc_stderr, retcode = self.execute_curl(curl_cmd, text)
+        proc_stdout, proc_stderr, retcode = self.execute_curl(curl_cmd, text, digests)
         self.output(f"Curl command: {curl_cmd}", verbose_level=4)
         if retcode:  # Non-zero exit code from curl => problem with download
             curl_err = self.parse_curl_error(proc_stderr)
@@ -20,6 +20,7 @@ import shutil
 import subprocess
 
 from autopkglib import Processor, ProcessorError
+from autopkglib.archive import ArchiveError, UnsupportedArchive, detect_format, extract
 
 __all__ = ["Unarchiver"]
 
@@ -27,6 +28,8 @@ EXTNS = {
     "zip": ["zip"],
     "tar_gzip": ["tar.gz", "tgz"],
     "tar_bzip2": ["tar.bz2", "tbz"],
+    "tar_xz": ["tar.xz", "txz"],
+    "tar_zstd": ["tar.zst", "tzst"],
     "tar": ["tar"],
     "gzip": ["gzip"],
 }
@@ -59,12 +62,56 @@ class Unarchiver(Processor):
             "required": False,
             "description": (
                 "The archive format. Currently supported: 'zip', "
-                "'tar_gzip', 'tar_bzip2', 'tar'. If omitted, the "
-                "file extension is used to guess the format."
+                "'tar_gzip', 'tar_bzip2', 'tar_xz', 'tar_zstd', 'tar'. If "
+                "omitted, the format is detected from the archive's contents, "
+                "or failing that guessed from the file extension."
+            ),
+        },
+        "unarchive_engine": {
+            "required": False,
+            "default": "system",
+            "description": (
+                "How to unarchive: 'system' uses ditto and tar; 'native' "
+                "extracts in-process, decompressing zip archives on all CPU "
+                "cores. The native engine doesn't restore the extended "
+                "attributes or resource forks ditto restores from __MACOSX "
+                "entries, which some code signatures are stored in, and falls "
+                "back to the system tools for archives it can't handle. "
+                "Defaults to 'system'."
             ),
         },
     }
     output_variables = {}
+    memo_inputs = (
+        "archive_path",
+        "pathname",
+        "destination_path",
+        "RECIPE_CACHE_DIR",
+        "NAME",
+        "purge_destination",
+        "archive_format",
+    )
+    memo_output_files = ("destination_path",)
+
+    def get_archive_path(self):
+        """Returns archive_path, defaulting to pathname"""
+        return self.env.get("archive_path", self.env.get("pathname"))
+
+    def get_destination_path(self):
+        """Returns destination_path, defaulting to RECIPE_CACHE_DIR/NAME"""
+        return self.env.get(
+            "destination_path",
+            os.path.join(self.env["RECIPE_CACHE_DIR"], self.env["NAME"]),
+        )
+
+    def memo_input_paths(self):
+        """The archive"""
+        archive_path = self.get_archive_path()
+        return [archive_path] if archive_path else []
+
+    def memo_output_paths(self):
+        """The destination directory"""
+        return [self.get_destination_path()]
 
     def get_archive_format(self, archive_path):
         """Guess archive format based on filename extension"""
@@ -75,18 +122,56 @@ class Unarchiver(Processor):
         # We found no known archive file extension if we got this far
         return None
 
+    def system_unarchive(self, fmt, archive_path, destination_path):
+        """Unarchive with ditto or tar"""
+        if fmt == "zip":
+            cmd = [
+                "/usr/bin/ditto",
+                "--noqtn",
+                "-x",
+                "-k",
+                archive_path,
+                destination_path,
+            ]
+        elif fmt == "gzip":
+            cmd = ["/usr/bin/ditto", "--noqtn", "-x", archive_path, destination_path]
+        elif fmt.startswith("tar"):
+            cmd = ["/usr/bin/tar", "-x", "-f", archive_path, "-C", destination_path]
+            if fmt.endswith("gzip"):
+                cmd.append("-z")
+            elif fmt.endswith("bzip2"):
+                cmd.append("-j")
+            elif fmt.endswith("xz"):
+                cmd.append("-J")
+            elif fmt.endswith("zstd"):
+                cmd.append("--zstd")
+
+        # Call command.
+        try:
+            proc = subprocess.Popen(
+                cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+            )
+            (_, stderr) = proc.communicate()
+        except OSError as err:
+            raise ProcessorError(
+                f"{os.path.basename(cmd[0])} execution failed with error code "
+                f"{err.errno}: {err.strerror}"
+            )
+        if proc.returncode != 0:
+            raise ProcessorError(
+                f"Unarchiving {archive_path} with {os.path.basename(cmd[0])} failed: "
+                f"{stderr}"
+            )
+
     def main(self):
         """Unarchive a file"""
         # handle some defaults for archive_path and destination_path
-        archive_path = self.env.get("archive_path", self.env.get("pathname"))
+        archive_path = self.get_archive_path()
         if not archive_path:
             raise ProcessorError(
                 "Expected an 'archive_path' input variable but none is set!"
             )
-        destination_path = self.env.get(
-            "destination_path",
-            os.path.join(self.env["RECIPE_CACHE_DIR"], self.env["NAME"]),
-        )
+        destination_path = self.get_destination_path()
 
         # Create the directory if needed.
         if not os.path.exists(destination_path):
@@ -106,6 +191,16 @@ class Unarchiver(Processor):
                     raise ProcessorError(f"Can't remove {path}: {err.strerror}")
 
         fmt = self.env.get("archive_format")
+        if fmt is None:
+            try:
+                fmt = detect_format(archive_path)
+            except OSError as err:
+                raise ProcessorError(f"Can't read {archive_path}: {err.strerror}")
+            if fmt:
+                self.output(
+                    f"Detected archive format '{fmt}' of "
+                    f"{os.path.basename(archive_path)}"
+                )
         if fmt is None:
             fmt = self.get_archive_format(archive_path)
             if not fmt:
@@ -124,40 +219,19 @@ class Unarchiver(Processor):
                 f"Must be one of {msg}."
             )
 
-        if fmt == "zip":
-            cmd = [
-                "/usr/bin/ditto",
-                "--noqtn",
-                "-x",
-                "-k",
-                archive_path,
-                destination_path,
-            ]
-        elif fmt == "gzip":
-            cmd = ["/usr/bin/ditto", "--noqtn", "-x", archive_path, destination_path]
-        elif fmt.startswith("tar"):
-            cmd = ["/usr/bin/tar", "-x", "-f", archive_path, "-C", destination_path]
-            if fmt.endswith("gzip"):
-                cmd.append("-z")
-            elif fmt.endswith("bzip2"):
-                cmd.append("-j")
-
-        # Call command.
-        try:
-            proc = subprocess.Popen(
-                cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
-            )
-            (_, stderr) = proc.communicate()
-        except OSError as err:
-            raise ProcessorError(
-                f"{os.path.basename(cmd[0])} execution failed with error code "
-                f"{err.errno}: {err.strerror}"
-            )
-        if proc.returncode != 0:
-            raise ProcessorError(
-                f"Unarchiving {archive_path} with {os.path.basename(cmd[0])} failed: "
-                f"{stderr}"
-            )
+        engine = self.env["unarchive_engine"]
+        if engine not in ("native", "system"):
+            raise ProcessorError(f"Unknown unarchive_engine {engine}")
+        if engine == "native":
+            try:
+                extract(archive_path, destination_path, fmt)
+            except UnsupportedArchive as err:
+                self.output(f"{err}; using the system tools instead")
+                engine = "system"
+            except (OSError, ArchiveError) as err:
+                raise ProcessorError(f"Unarchiving {archive_path} failed: {err}")
+        if engine == "system":
+            self.system_unarchive(fmt, archive_path, destination_path)
 
         self.output(f"Unarchived {archive_path} to {destination_path}")
 
@@ -17,8 +17,12 @@
 """Core/shared autopkglib functions"""
 
 
-import glob
+import collections.abc
+import copy
+import functools
+import glob  # noqa: F401 -- processor tests patch autopkglib.glob.glob
 import imp
+import importlib
 import json
 import os
 import platform
@@ -28,6 +32,7 @@ import re
 import subprocess
 import sys
 import traceback
+import types
 from distutils.version import LooseVersion
 
 
@@ -307,19 +312,10 @@ def get_identifier_from_recipe_file(filename):
 def find_recipe_by_identifier(identifier, search_dirs):
     """Search search_dirs for a recipe with the given
     identifier"""
-    for directory in search_dirs:
-        normalized_dir = os.path.abspath(os.path.expanduser(directory))
-        patterns = [
-            os.path.join(normalized_dir, "*.recipe"),
-            os.path.join(normalized_dir, "*/*.recipe"),
-        ]
-        for pattern in patterns:
-            matches = glob.glob(pattern)
-            for match in matches:
-                if get_identifier_from_recipe_file(match) == identifier:
-                    return match
+    # imported here as autopkglib.recipeindex itself imports from autopkglib
+    from autopkglib.recipeindex import get_recipe_index
 
-    return None
+    return get_recipe_index().find_recipe_by_identifier(identifier, search_dirs)
 
 
 def get_autopkg_version():
@@ -341,37 +337,108 @@ def version_equal_or_greater(this, that):
     return LooseVersion(this) >= LooseVersion(that)
 
 
-def update_data(a_dict, key, value):
-    """Update a_dict keys with value. Existing data can be referenced
-    by wrapping the key in %percent% signs."""
+class KeyrefTemplate:
+    """A string split into literal text and the keys of its %key%
+    references, so it can be filled in without matching RE_KEYREF again.
+    Remembers its last result, which is reused until the values of the
+    referenced keys change."""
+
+    __slots__ = ("literals", "keys", "last")
+
+    def __init__(self, text):
+        self.literals = []
+        self.keys = []
+        position = 0
+        for match in RE_KEYREF.finditer(text):
+            self.literals.append(text[position : match.start()])
+            self.keys.append(match.group("key"))
+            position = match.end()
+        self.literals.append(text[position:])
+        self.last = (None, None)
+
+    def substitute(self, data):
+        """Returns the text with each %key% replaced with data[key]. Raises
+        KeyError for the first key that isn't in data."""
+        values = tuple(data[key] for key in self.keys)
+        last_values, last_result = self.last
+        if values == last_values:
+            return last_result
+        parts = [self.literals[0]]
+        for value, literal in zip(values, self.literals[1:]):
+            parts.append(value)
+            parts.append(literal)
+        result = "".join(parts)
+        self.last = (values, result)
+        return result
 
-    def getdata(match):
-        """Returns data from a match object"""
-        return a_dict[match.group("key")]
 
-    def do_variable_substitution(item):
-        """Do variable substitution for item"""
-        if isinstance(item, str):
-            try:
-                item = RE_KEYREF.sub(getdata, item)
-            except KeyError as err:
-                log_err(f"Use of undefined key in variable substitution: {err}")
-        elif isinstance(item, (list, NSArray)):
-            for index in range(len(item)):
-                item[index] = do_variable_substitution(item[index])
-        elif isinstance(item, (dict, NSDictionary)):
-            # Modify a copy of the orginal
-            if isinstance(item, dict):
-                item_copy = item.copy()
-            else:
-                # Need to specify the copy is mutable for NSDictionary
-                item_copy = item.mutableCopy()
-            for key, value in list(item.items()):
-                item_copy[key] = do_variable_substitution(value)
+@functools.lru_cache(maxsize=4096)
+def compile_keyrefs(text):
+    """Returns a KeyrefTemplate for text, or None if it has no %key%
+    references"""
+    if not RE_KEYREF.search(text):
+        return None
+    return KeyrefTemplate(text)
+
+
+def substitute_keyrefs(item, data):
+    """Returns item with %key% references in it, and in any lists and dicts
+    in it, replaced with values from data. Lists are updated in place. Items
+    without references are returned as is, and dicts are only copied if
+    something in them changed."""
+    if isinstance(item, str):
+        template = compile_keyrefs(item) if "%" in item else None
+        if template is None:
+            return item
+        try:
+            return template.substitute(data)
+        except KeyError as err:
+            log_err(f"Use of undefined key in variable substitution: {err}")
+            return item
+    elif isinstance(item, (list, NSArray)):
+        for index in range(len(item)):
+            value = item[index]
+            if isinstance(value, str) and "%" not in value:
+                # the common case, checked here to save a call
+                continue
+            new_value = substitute_keyrefs(value, data)
+            if new_value is not value:
+                item[index] = new_value
+    elif isinstance(item, (dict, NSDictionary)):
+        item_copy = None
+        for key, value in item.items():
+            if isinstance(value, str) and "%" not in value:
+                continue
+            new_value = substitute_keyrefs(value, data)
+            if new_value is not value:
+                if item_copy is None:
+                    # Modify a copy of the orginal
+                    if isinstance(item, dict):
+                        item_copy = item.copy()
+                    else:
+                        # Need to specify the copy is mutable for NSDictionary
+                        item_copy = item.mutableCopy()
+                item_copy[key] = new_value
+        if item_copy is not None:
             return item_copy
-        return item
+    return item
 
-    a_dict[key] = do_variable_substitution(value)
+
+def has_keyrefs(item):
+    """True if item, or any list or dict in it, has %key% references"""
+    if isinstance(item, str):
+        return "%" in item and compile_keyrefs(item) is not None
+    elif isinstance(item, (list, NSArray)):
+        return any(has_keyrefs(value) for value in item)
+    elif isinstance(item, (dict, NSDictionary)):
+        return any(has_keyrefs(value) for value in item.values())
+    return False
+
+
+def update_data(a_dict, key, value):
+    """Update a_dict keys with value. Existing data can be referenced
+    by wrapping the key in %percent% signs."""
+    a_dict[key] = substitute_keyrefs(value, a_dict)
 
 
 def is_executable(exe_path):
@@ -395,6 +462,14 @@ class Processor:
     returns a new or updated property list that can be processed further.
     """
 
+    # Memoization of main(), used when STEP_CACHE_DIR is set: the env
+    # variables whose values decide what main() does, those naming files or
+    # directories whose contents do, and those naming what main() outputs.
+    # Only processors that declare memo_output_files are memoized.
+    memo_inputs = ()
+    memo_input_files = ()
+    memo_output_files = ()
+
     def __init__(self, env=None, infile=None, outfile=None):
         # super(Processor, self).__init__()
         self.env = env
@@ -477,9 +552,43 @@ class Processor:
             if flags.get("required") and (variable not in self.env):
                 raise ProcessorError(f"{self.__name__} requires {variable}")
 
-        self.main()
+        cache = self.step_cache()
+        if cache is None:
+            self.main()
+        else:
+            # imported here to keep autopkglib's own imports to a minimum
+            from autopkglib.stepcache import run_memoized
+
+            run_memoized(self, cache)
         return self.env
 
+    def step_cache(self):
+        """Returns the StepCache to memoize main() with, or None if this
+        processor isn't memoized or STEP_CACHE_DIR isn't set"""
+        if not (self.memo_output_files and self.env.get("STEP_CACHE_DIR")):
+            return None
+        # imported here to keep autopkglib's own imports to a minimum
+        from autopkglib.stepcache import StepCache
+
+        max_mb = self.env.get("STEP_CACHE_MAX_MB")
+        return StepCache(
+            self.env["STEP_CACHE_DIR"], int(max_mb) * 2 ** 20 if max_mb else None
+        )
+
+    def memo_input_paths(self):
+        """Returns the files or directories whose contents decide what main()
+        does, for memoization"""
+        return [self.env[key] for key in self.memo_input_files if self.env.get(key)]
+
+    def memo_output_paths(self):
+        """Returns the files or directories main() output, for memoization"""
+        return [self.env[key] for key in self.memo_output_files if self.env.get(key)]
+
+    def memo_replace_outputs(self):
+        """True if main() replaces its output directories, rather than adding
+        to what's already in them"""
+        return bool(self.env.get("purge_destination"))
+
     def cmdexec(self, command, description):
         """Execute a command and return output."""
 
@@ -522,12 +631,106 @@ class AutoPackagerError(Exception):
     pass
 
 
+class ProcessorStepError(AutoPackagerError):
+    """Error from a processor run as a recipe step"""
+
+    def __init__(self, message, processor=None):
+        super().__init__(message)
+        self.processor = processor
+
+
 class AutoPackagerLoadError(Exception):
     """Represent an exception loading a recipe or processor."""
 
     pass
 
 
+class RecipeEnv(collections.abc.MutableMapping):
+    """A recipe's environment, layered over shared base layers (such as the
+    preferences) that are never changed, like a ChainMap. Values are set in
+    the recipe's own layer; mutable values are copied up from the base
+    layers the first time they're read, so changes to them stay with this
+    recipe. That saves copying every preference for every recipe."""
+
+    # values of these types can be shared without copying
+    IMMUTABLE_TYPES = (str, bytes, int, float, bool, type(None))
+
+    def __init__(self, *base_layers):
+        self.layer = {}
+        self.base_layers = base_layers
+        self.deleted = set()
+
+    def __getitem__(self, key):
+        if key in self.layer:
+            return self.layer[key]
+        if key not in self.deleted:
+            for base_layer in self.base_layers:
+                if key in base_layer:
+                    value = base_layer[key]
+                    if not isinstance(value, self.IMMUTABLE_TYPES):
+                        value = self.layer[key] = copy.deepcopy(value)
+                    return value
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        self.layer[key] = value
+        self.deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.layer.pop(key, None)
+        if any(key in base_layer for base_layer in self.base_layers):
+            self.deleted.add(key)
+
+    def __contains__(self, key):
+        if key in self.layer:
+            return True
+        return key not in self.deleted and any(
+            key in base_layer for base_layer in self.base_layers
+        )
+
+    def __iter__(self):
+        # same order as a dict built from the base layers, then updated
+        seen = set()
+        for layer in (*reversed(self.base_layers), self.layer):
+            for key in layer:
+                if key not in seen and key not in self.deleted:
+                    seen.add(key)
+                    yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(self.copy())
+
+    def copy(self):
+        """Returns a shallow copy as a dict, without copying up any values,
+        like dict.copy()"""
+        flattened = {}
+        for layer in (*reversed(self.base_layers), self.layer):
+            flattened.update(layer)
+        for key in self.deleted:
+            flattened.pop(key, None)
+        return flattened
+
+    def changes(self):
+        """Returns a dict of the values in the recipe's own layer: those set
+        for the recipe, or copied up from a base layer to be changed"""
+        return dict(self.layer)
+
+
+def split_check_phase(process):
+    """Splits a recipe Process into the steps up to and including
+    EndOfCheckPhase, and the steps after it. A recipe without EndOfCheckPhase
+    has no separate check phase."""
+    for index, step in enumerate(process):
+        if step["Processor"] == "EndOfCheckPhase":
+            return process[: index + 1], process[index + 1 :]
+    return [], process
+
+
 class AutoPackager:
     """Instantiate and execute processors from a recipe."""
 
@@ -535,6 +738,10 @@ class AutoPackager:
         self.verbose = options.verbose
         self.env = env
         self.results = []
+        # skip the steps after the check phase if nothing changed since the
+        # last run
+        self.fastpath = False
+        self.inputs = None
         self.env["AUTOPKG_VERSION"] = get_autopkg_version()
 
     def output(self, msg, verbose_level=1):
@@ -567,9 +774,11 @@ class AutoPackager:
         inputs.update(recipe["Input"])
         inputs.update(cli_values)
         self.env.update(inputs)
-        # do any internal string substitutions
-        for key, value in list(self.env.items()):
-            update_data(self.env, key, value)
+        # do any internal string substitutions. Values without references
+        # are skipped, so preferences aren't copied up into a RecipeEnv
+        for key, value in list(self.env.copy().items()):
+            if has_keyrefs(value):
+                update_data(self.env, key, self.env[key])
 
     def verify(self, recipe):
         """Verify a recipe and check for errors."""
@@ -623,17 +832,86 @@ class AutoPackager:
 
     def process(self, recipe):
         """Process a recipe."""
+        self.prepare(recipe)
+        check_steps, build_steps = split_check_phase(recipe["Process"])
+        if not (self.fastpath and check_steps):
+            self.process_steps(recipe["Process"])
+            return
+        self.process_steps(check_steps)
+        if not self.env.get("stop_processing_recipe"):
+            self.process_build_phase(recipe, build_steps)
+
+    def process_build_phase(self, recipe, build_steps):
+        """Run the steps after a recipe's check phase. With fastpath set, they
+        are skipped instead if the recipe, its inputs, its check phase outputs
+        and its processors all match its last complete run and the files that
+        run output still exist; the env variables naming those files are
+        restored, but not ones reporting what the run did, such as an
+        import."""
+        if not (self.fastpath and build_steps):
+            self.process_steps(build_steps)
+            return
+        # imported here as autopkglib.fastpath itself imports from autopkglib
+        from autopkglib import fastpath
+
+        recipe_fingerprint = fastpath.fingerprint(
+            recipe,
+            self.inputs,
+            [item["Output"] for item in self.results if "Output" in item],
+            [self.step_processor(step) for step in recipe["Process"]],
+            self.env.get("CACHE_DIR"),
+        )
+        record = fastpath.matching_record(
+            self.env["RECIPE_CACHE_DIR"], recipe_fingerprint
+        )
+        if record:
+            self.output("Nothing changed since the last run, skipping the rest")
+            self.env.update(record["outputs"])
+            self.results.append(
+                {
+                    "FastPath": {
+                        "fingerprint": recipe_fingerprint,
+                        "skipped_steps": [step["Processor"] for step in build_steps],
+                    }
+                }
+            )
+            return
+        first_build_result = len(self.results)
+        self.process_steps(build_steps)
+        if self.env.get("stop_processing_recipe"):
+            return
+        fastpath.save_record(
+            self.env["RECIPE_CACHE_DIR"],
+            recipe_fingerprint,
+            [item["Output"] for item in self.results[first_build_result:]],
+        )
+
+    def step_processor(self, step):
+        """Returns the processor class for a recipe Process step"""
+        processor_name = extract_processor_name_with_recipe_identifier(
+            step["Processor"]
+        )[0]
+        return get_processor(processor_name, verbose=self.verbose)
+
+    def prepare(self, recipe):
+        """Set up the RECIPE_CACHE_DIR and record the recipe input, ahead of
+        running any steps."""
         identifier = self.get_recipe_identifier(recipe)
+        self.identifier = identifier
         # define a cache/work directory for use by the recipe
         cache_dir = self.env.get("CACHE_DIR") or os.path.expanduser(
             "~/Library/AutoPkg/Cache"
         )
         self.env["RECIPE_CACHE_DIR"] = os.path.join(cache_dir, identifier)
 
-        recipe_input_dict = {}
-        for key in list(self.env.keys()):
-            recipe_input_dict[key] = self.env[key]
+        if isinstance(self.env, RecipeEnv):
+            # leave out preferences the recipe didn't change
+            recipe_input_dict = self.env.changes()
+        else:
+            recipe_input_dict = self.env.copy()
         self.results.append({"Recipe input": recipe_input_dict})
+        # the fast path fingerprints everything the recipe was given
+        self.inputs = self.env.copy() if self.fastpath else None
 
         # make sure the RECIPE_CACHE_DIR exists, creating it if needed
         if not os.path.exists(self.env["RECIPE_CACHE_DIR"]):
@@ -648,15 +926,19 @@ class AutoPackager:
         if self.verbose > 2:
             pprint.pprint(self.env)
 
-        for step in recipe["Process"]:
+    def process_steps(self, steps):
+        """Run a list of recipe Process steps. Stops early if a processor sets
+        stop_processing_recipe. prepare() must have been called first."""
+        # imported here to keep autopkglib's own imports to a minimum
+        from autopkglib.runtrace import Measurement
+
+        identifier = self.identifier
+        for step in steps:
 
             if self.verbose:
                 print(step["Processor"])
 
-            processor_name = extract_processor_name_with_recipe_identifier(
-                step["Processor"]
-            )[0]
-            processor_class = get_processor(processor_name, verbose=self.verbose)
+            processor_class = self.step_processor(step)
             processor = processor_class(self.env)
             processor.inject(step.get("Arguments", {}))
 
@@ -670,7 +952,8 @@ class AutoPackager:
                 pprint.pprint({"Input": input_dict})
 
             try:
-                self.env = processor.process()
+                with Measurement() as resources:
+                    self.env = processor.process()
             except Exception as err:
                 if self.verbose > 2:
                     exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -682,9 +965,10 @@ class AutoPackager:
                 # from one processor do not prevent execution of
                 # subsequent recipes.
                 log_err(err)
-                raise AutoPackagerError(
+                raise ProcessorStepError(
                     f"Error in {identifier}: Processor: {step['Processor']}: "
-                    f"Error: {err}"
+                    f"Error: {err}",
+                    processor=step["Processor"],
                 )
 
             output_dict = {}
@@ -705,6 +989,7 @@ class AutoPackager:
                     "Processor": step["Processor"],
                     "Input": input_dict,
                     "Output": output_dict,
+                    "Resources": resources,
                 }
             )
 
@@ -787,38 +1072,90 @@ class APLooseVersion(LooseVersion):
         return self._compare(other) >= 0
 
 
-_CORE_PROCESSOR_NAMES = []
-_PROCESSOR_NAMES = []
+# The processors that ship with AutoPkg, each a class in a module of the same
+# name in this directory. They're imported the first time they're looked up,
+# so importing autopkglib doesn't import every processor and its
+# dependencies. Keep this in sync with the modules; test_autopkglib checks.
+_CORE_PROCESSOR_NAMES = [
+    "AppDmgVersioner",
+    "AppPkgCreator",
+    "BrewCaskInfoProvider",
+    "CURLDownloader",
+    "CURLTextSearcher",
+    "CodeSignatureVerifier",
+    "Copier",
+    "DeprecationWarning",
+    "DmgCreator",
+    "DmgMounter",
+    "EndOfCheckPhase",
+    "FileCreator",
+    "FileFinder",
+    "FileMover",
+    "FlatPkgPacker",
+    "FlatPkgUnpacker",
+    "GitHubReleasesInfoProvider",
+    "InstallFromDMG",
+    "Installer",
+    "MunkiCatalogBuilder",
+    "MunkiImporter",
+    "MunkiInfoCreator",
+    "MunkiInstallsItemsCreator",
+    "MunkiPkginfoMerger",
+    "MunkiSetDefaultCatalog",
+    "PackageRequired",
+    "PathDeleter",
+    "PkgCopier",
+    "PkgCreator",
+    "PkgExtractor",
+    "PkgInfoCreator",
+    "PkgPayloadUnpacker",
+    "PkgRootCreator",
+    "PlistEditor",
+    "PlistReader",
+    "SparkleUpdateInfoProvider",
+    "StopProcessingIf",
+    "Symlinker",
+    "URLDownloader",
+    "URLGetter",
+    "URLTextSearcher",
+    "Unarchiver",
+    "Versioner",
+]
+_PROCESSOR_NAMES = list(_CORE_PROCESSOR_NAMES)
+
+
+class AutoPkgLibModule(types.ModuleType):
+    """The type of the autopkglib module. Importing a core processor's module
+    sets autopkglib.<name> to the module, however it's imported (including
+    by other modules, as in 'from autopkglib.URLGetter import URLGetter');
+    this sets it to the processor class instead, as callers expect."""
+
+    def __setattr__(self, name, value):
+        if name in _CORE_PROCESSOR_NAMES and isinstance(value, types.ModuleType):
+            value = getattr(value, name, value)
+        super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = AutoPkgLibModule
+
+
+def load_core_processor(name):
+    """Imports a core processor's module and returns the processor class"""
+    return getattr(importlib.import_module(f"{__name__}.{name}"), name)
 
 
 def import_processors():
-    """Imports processors from the directory this init file is in"""
-    # get the directory this __init__.py file is in
-    mydir = os.path.dirname(os.path.abspath(__file__))
-    mydirname = os.path.basename(mydir)
-
-    # find all the .py files (minus this one)
-    processor_files = [
-        os.path.splitext(name)[0]
-        for name in os.listdir(mydir)
-        if name.endswith(".py") and not name == "__init__.py"
-    ]
-
-    # Warning! Fancy dynamic importing ahead!
-    #
-    # import the filename as a submodule
-    # then add the attribute with the same name to the globals()
-    #
-    # This is the equivalent of:
-    #
-    #    from Bar.Foo import Foo
-    #
-    for name in processor_files:
-        globals()[name] = getattr(
-            __import__(mydirname + "." + name, fromlist=[name]), name
-        )
-        _PROCESSOR_NAMES.append(name)
-        _CORE_PROCESSOR_NAMES.append(name)
+    """Imports all the core processors"""
+    for name in _CORE_PROCESSOR_NAMES:
+        load_core_processor(name)
+
+
+def __getattr__(name):
+    """Imports core processors when they're first used as autopkglib
+    attributes"""
+    if name in _CORE_PROCESSOR_NAMES:
+        return load_core_processor(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 # convenience functions for adding and accessing processors
@@ -905,6 +1242,9 @@ def get_processor(processor_name, verbose=None, recipe=None, env=None):
                         traceback.print_tb(exc_traceback, limit=1, file=sys.stdout)
                     raise AutoPackagerLoadError(err)
 
+    processor = globals().get(processor_name)
+    if not isinstance(processor, type) and processor_name in _CORE_PROCESSOR_NAMES:
+        return load_core_processor(processor_name)
     return globals()[processor_name]
 
 
@@ -916,10 +1256,3 @@ def processor_names():
 def core_processor_names():
     """Returns the names of the 'core' processors"""
     return _CORE_PROCESSOR_NAMES
-
-
-# when importing autopkglib, need to also import all the processors
-# in this same directory
-
-
-import_processors()
@@ -0,0 +1,276 @@
+#!/usr/local/autopkg/python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""In-process extraction of zip and tar archives"""
+
+import bz2
+import concurrent.futures
+import contextlib
+import gzip
+import lzma
+import os
+import shutil
+import stat
+import tarfile
+import threading
+import time
+import zipfile
+import zlib
+
+from autopkglib.payload import PayloadError, unpack_payload
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DECOMPRESSION_ERRORS = (EOFError, zlib.error, lzma.LZMAError)
+if zstandard is not None:
+    DECOMPRESSION_ERRORS += (zstandard.ZstdError,)
+
+# links tarfile's "tar" filter refuses, pointing outside the destination
+LINK_FILTER_ERRORS = tuple(
+    getattr(tarfile, name)
+    for name in ("AbsoluteLinkError", "LinkOutsideDestinationError")
+    if hasattr(tarfile, name)
+)
+
+COPY_BUFSIZE = 2 ** 20
+TAR_MAGIC_OFFSET = 257
+MACOSX_METADATA_DIR = "__MACOSX"
+# compressed tar formats, by the magic bytes of their compression
+COMPRESSION_MAGIC = {
+    b"\x1f\x8b": ("tar_gzip", gzip.open),
+    b"BZh": ("tar_bzip2", bz2.open),
+    b"\xfd7zXZ\x00": ("tar_xz", lzma.open),
+    b"\x28\xb5\x2f\xfd": ("tar_zstd", None),
+}
+
+
+class ArchiveError(Exception):
+    """Raised for archives that can't be extracted"""
+
+
+class UnsupportedArchive(ArchiveError):
+    """Raised for archives this module can't extract but other tools might"""
+
+
+def is_tar_header(block):
+    """True if block starts with a valid tar header"""
+    try:
+        tarfile.TarInfo.frombuf(block[:512], "utf-8", "surrogateescape")
+    except tarfile.HeaderError:
+        return False
+    return True
+
+
+def detect_format(path):
+    """Returns the Unarchiver format of an archive from its magic bytes:
+    zip, tar, tar_gzip, tar_bzip2, tar_xz, tar_zstd or gzip (a gzipped cpio
+    archive, as ditto writes). Returns None if the format isn't recognised."""
+    with open(path, "rb") as f:
+        header = f.read(512)
+    if header.startswith((b"PK\x03\x04", b"PK\x05\x06")):
+        return "zip"
+    if header[TAR_MAGIC_OFFSET : TAR_MAGIC_OFFSET + 5] == b"ustar":
+        return "tar"
+    for magic, (fmt, opener) in COMPRESSION_MAGIC.items():
+        if not header.startswith(magic):
+            continue
+        if opener is None:
+            return fmt
+        try:
+            with opener(path, "rb") as f:
+                block = f.read(512)
+        except (OSError, *DECOMPRESSION_ERRORS):
+            return None
+        if fmt == "tar_gzip" and block.startswith((b"070707", b"070701")):
+            return "gzip"
+        return fmt if is_tar_header(block) else None
+    return None
+
+
+def safe_path(destination, name):
+    """Returns where a member named name is extracted to, or None for the
+    archive root. Raises ArchiveError for names that would escape
+    destination."""
+    name = os.path.normpath(name.replace("\\", "/").lstrip("/"))
+    if name == ".":
+        return None
+    if name == ".." or name.startswith("../"):
+        raise ArchiveError(f"Refusing to extract {name} outside the destination")
+    return os.path.join(destination, name)
+
+
+def check_inside(destination, path):
+    """Raises ArchiveError if path, with any symlinks in it resolved, is
+    outside destination. Checked before writing through a path whose parents
+    the archive may have made symlinks."""
+    root = os.path.realpath(destination)
+    real_path = os.path.realpath(path)
+    if real_path != root and not real_path.startswith(root + os.sep):
+        raise ArchiveError(f"Refusing to extract {path} outside the destination")
+
+
+def check_link(destination, target, link_target):
+    """Raises ArchiveError if a symlink at target to link_target would point
+    outside destination"""
+    check_inside(destination, os.path.join(os.path.dirname(target), link_target))
+
+
+def zip_mode(info):
+    """Returns the Unix mode stored in a zip member, or None"""
+    mode = info.external_attr >> 16
+    return mode if info.create_system == 3 and mode else None
+
+
+def extract_zip(path, destination, workers=None):
+    """Extract a zip archive into destination. Files are decompressed in
+    parallel on a pool of threads, each with its own handle on the archive,
+    and streamed to disk. Unix modes, symlinks and modification times are
+    restored; the __MACOSX metadata ditto adds is skipped. Returns the number
+    of members extracted."""
+    workers = workers or os.cpu_count() or 1
+    local = threading.local()
+    handles = []
+
+    def archive():
+        if not hasattr(local, "archive"):
+            local.archive = zipfile.ZipFile(path)
+            handles.append(local.archive)
+        return local.archive
+
+    def extract_file(info, target):
+        check_inside(destination, os.path.dirname(target))
+        with archive().open(info) as source, open(target, "wb") as f:
+            shutil.copyfileobj(source, f, COPY_BUFSIZE)
+        mode = zip_mode(info)
+        if mode is not None:
+            os.chmod(target, stat.S_IMODE(mode))
+        mtime = time.mktime(info.date_time + (0, 0, -1))
+        os.utime(target, (mtime, mtime))
+
+    try:
+        with zipfile.ZipFile(path) as zip_file:
+            members = []
+            for info in zip_file.infolist():
+                name = info.filename
+                if name.split("/", 1)[0] == MACOSX_METADATA_DIR:
+                    continue
+                target = safe_path(destination, name)
+                if target is not None:
+                    members.append((info, target))
+            # create directories and symlinks first, then stream the files
+            directories = []
+            files = []
+            for info, target in members:
+                mode = zip_mode(info)
+                if info.is_dir():
+                    check_inside(destination, target)
+                    os.makedirs(target, exist_ok=True)
+                    directories.append((info, target))
+                    continue
+                check_inside(destination, os.path.dirname(target))
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                if os.path.lexists(target):
+                    os.unlink(target)
+                if mode is not None and stat.S_ISLNK(mode):
+                    link_target = zip_file.read(info).decode("utf-8")
+                    check_link(destination, target, link_target)
+                    os.symlink(link_target, target)
+                else:
+                    files.append((info, target))
+            with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                for future in [
+                    executor.submit(extract_file, info, target)
+                    for info, target in files
+                ]:
+                    future.result()
+            for info, target in reversed(directories):
+                mode = zip_mode(info)
+                if mode is not None:
+                    os.chmod(target, stat.S_IMODE(mode))
+            return len(members)
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, *DECOMPRESSION_ERRORS) as err:
+        raise ArchiveError(f"Can't extract {path}: {err}")
+    except NotImplementedError as err:
+        raise UnsupportedArchive(f"Can't extract {path}: {err}")
+    finally:
+        for handle in handles:
+            handle.close()
+
+
+@contextlib.contextmanager
+def open_tar_stream(path, fmt):
+    """Context manager yielding a tarfile reading path sequentially,
+    decompressing as it goes"""
+    if fmt != "tar_zstd":
+        with tarfile.open(path, mode="r|*", bufsize=COPY_BUFSIZE) as tar:
+            yield tar
+        return
+    if zstandard is None:
+        raise UnsupportedArchive(
+            "Extracting zstd archives needs the zstandard Python module"
+        )
+    with open(path, "rb") as f:
+        with zstandard.ZstdDecompressor().stream_reader(f) as source:
+            with tarfile.open(fileobj=source, mode="r|", bufsize=COPY_BUFSIZE) as tar:
+                yield tar
+
+
+def extract_tar(path, destination, fmt="tar"):
+    """Extract a tar archive, plain or compressed with gzip, bzip2, xz or
+    zstd, into destination. The archive is read as a stream, one member at a
+    time. Returns the number of members extracted."""
+    count = 0
+    try:
+        with open_tar_stream(path, fmt) as tar:
+            for member in tar:
+                target = safe_path(destination, member.name)
+                if target is None:
+                    continue
+                # older Pythons' tarfile has no extraction filters to do this
+                check_inside(destination, os.path.dirname(target))
+                if member.issym():
+                    check_link(destination, target, member.linkname)
+                elif member.islnk():
+                    link_source = safe_path(destination, member.linkname)
+                    check_inside(destination, link_source or destination)
+                if hasattr(tarfile, "tar_filter"):
+                    tar.extract(member, destination, filter="tar")
+                else:
+                    tar.extract(member, destination)
+                count += 1
+    except LINK_FILTER_ERRORS as err:
+        # tar(1) would extract this, so let the caller fall back to it
+        raise UnsupportedArchive(f"Can't extract {path}: {err}")
+    except (tarfile.TarError, *DECOMPRESSION_ERRORS) as err:
+        raise ArchiveError(f"Can't extract {path}: {err}")
+    return count
+
+
+def extract(path, destination, fmt=None, workers=None):
+    """Extract an archive into destination, detecting its format from its
+    magic bytes if fmt isn't given. Returns the number of members
+    extracted."""
+    fmt = fmt or detect_format(path)
+    if fmt == "zip":
+        return extract_zip(path, destination, workers)
+    if fmt == "gzip":
+        try:
+            return unpack_payload(path, destination)
+        except PayloadError as err:
+            raise ArchiveError(str(err))
+    if fmt in ("tar", "tar_gzip", "tar_bzip2", "tar_xz", "tar_zstd"):
+        return extract_tar(path, destination, fmt)
+    raise UnsupportedArchive(f"Unknown archive format for {path}")
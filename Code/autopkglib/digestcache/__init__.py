@@ -0,0 +1,181 @@
+#!/usr/local/autopkg/python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Persistent cache of file digests, so unchanged files are hashed once"""
+
+import concurrent.futures
+import hashlib
+import mmap
+import os
+import sqlite3
+import threading
+
+from autopkglib import log_err
+
+ALGORITHMS = ("sha256", "md5")
+CACHE_FILENAME = "digests.sqlite"
+# files at least this big are hashed through mmap, in slices
+MMAP_THRESHOLD = 2 ** 20
+SLICE_SIZE = 8 * 2 ** 20
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS digests (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    ctime_ns INTEGER NOT NULL,
+    sha256 TEXT,
+    md5 TEXT,
+    PRIMARY KEY (dev, ino)
+)
+"""
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def hash_file(path, algorithms=("sha256",)):
+    """Returns a dict of algorithm -> hex digest of the file at path. Big
+    files are mapped into memory rather than read, and when more than one
+    digest is needed they're computed side by side on threads (hashlib
+    releases the GIL while it works)."""
+    hashers = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < MMAP_THRESHOLD:
+            for chunk in iter(lambda: f.read(2 ** 16), b""):
+                for hasher in hashers.values():
+                    hasher.update(chunk)
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+
+                def update(hasher):
+                    for offset in range(0, size, SLICE_SIZE):
+                        hasher.update(view[offset : offset + SLICE_SIZE])
+
+                try:
+                    if len(hashers) == 1:
+                        update(next(iter(hashers.values())))
+                    else:
+                        with concurrent.futures.ThreadPoolExecutor(
+                            len(hashers)
+                        ) as executor:
+                            list(executor.map(update, hashers.values()))
+                finally:
+                    view.release()
+    return {algorithm: hasher.hexdigest() for algorithm, hasher in hashers.items()}
+
+
+def file_key(info):
+    """Returns what identifies a version of a file: device, inode, size,
+    mtime and ctime. ctime can't be set back like mtime can, so a file that
+    is rewritten and touched back to its old mtime still looks changed."""
+    return (info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns, info.st_ctime_ns)
+
+
+class DigestCache:
+    """SHA-256 and MD5 digests of files, stored in SQLite by file_key() so
+    they survive across runs. Safe to share between threads."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.db:
+            self.db.execute(SCHEMA)
+
+    def close(self):
+        """Close the database connection"""
+        self.db.close()
+
+    def lookup(self, info):
+        """Returns the cached digests for a file's stat info"""
+        dev, ino, size, mtime_ns, ctime_ns = file_key(info)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT sha256, md5 FROM digests WHERE dev = ? AND ino = ? "
+                "AND size = ? AND mtime_ns = ? AND ctime_ns = ?",
+                (dev, ino, size, mtime_ns, ctime_ns),
+            ).fetchone()
+        if not row:
+            return {}
+        return {key: value for key, value in zip(ALGORITHMS, row) if value}
+
+    def store(self, info, digests):
+        """Cache digests (a dict of algorithm -> hex digest) for a file's stat
+        info, keeping any other digests already cached for it"""
+        digests = dict(self.lookup(info), **digests)
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)",
+                file_key(info)
+                + tuple(digests.get(algorithm) for algorithm in ALGORITHMS),
+            )
+
+    def digests(self, path, algorithms=("sha256",)):
+        """Returns a dict of algorithm -> hex digest for the file at path,
+        hashing it only if it changed since it was last hashed"""
+        info = os.stat(path)
+        cached = self.lookup(info)
+        missing = [algorithm for algorithm in algorithms if algorithm not in cached]
+        if missing:
+            computed = hash_file(path, missing)
+            # only trust the digests if the file didn't change while hashed
+            if file_key(os.stat(path)) == file_key(info):
+                self.store(info, computed)
+            cached.update(computed)
+        return {algorithm: cached[algorithm] for algorithm in algorithms}
+
+    def record(self, path, digests):
+        """Cache digests computed elsewhere, for example while downloading,
+        for the file at path as it is now"""
+        digests = {
+            algorithm: digest
+            for algorithm, digest in digests.items()
+            if algorithm in ALGORITHMS
+        }
+        if digests:
+            self.store(os.stat(path), digests)
+
+
+def get_digest_cache(cache_dir=None):
+    """Returns the process-wide DigestCache kept in cache_dir (defaults to
+    ~/Library/AutoPkg/Cache), or None if it can't be opened"""
+    cache_dir = os.path.expanduser(cache_dir or "~/Library/AutoPkg/Cache")
+    path = os.path.join(cache_dir, CACHE_FILENAME)
+    # SQLite connections can't be shared with forked worker processes
+    key = (path, os.getpid())
+    with _caches_lock:
+        if key not in _caches:
+            try:
+                _caches[key] = DigestCache(path)
+            except (OSError, sqlite3.Error) as err:
+                log_err(f"WARNING: Can't open digest cache {path}: {err}")
+                _caches[key] = None
+        return _caches[key]
+
+
+def file_digest(path, algorithm="sha256", cache_dir=None):
+    """Returns the hex digest of the file at path, from the digest cache if
+    the file hasn't changed since it was last hashed"""
+    cache = get_digest_cache(cache_dir)
+    if cache is None:
+        return hash_file(path, (algorithm,))[algorithm]
+    try:
+        return cache.digests(path, (algorithm,))[algorithm]
+    except sqlite3.Error as err:
+        log_err(f"WARNING: Digest cache error: {err}")
+        return hash_file(path, (algorithm,))[algorithm]
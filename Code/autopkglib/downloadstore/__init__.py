@@ -0,0 +1,151 @@
+#!/usr/local/autopkg/python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Content-addressed store of downloads shared by all recipes"""
+
+import contextlib
+import fcntl
+import json
+import os
+import shutil
+import subprocess
+import time
+
+from autopkglib import is_mac, log_err
+
+INDEX_FILENAME = "index.json"
+# bump this whenever the format of the index changes
+INDEX_VERSION = 1
+
+
+def link_file(source, destination):
+    """Make destination a copy of source without duplicating its data where
+    possible: an APFS clone, then a hard link, then a plain copy."""
+    if is_mac():
+        result = subprocess.run(
+            ["/bin/cp", "-c", source, destination], capture_output=True
+        )
+        if result.returncode == 0:
+            return
+    try:
+        os.link(source, destination)
+        return
+    except OSError:
+        pass
+    shutil.copy2(source, destination)
+
+
+class DownloadStore:
+    """Downloads stored once by SHA-256 under root/objects, with an index from
+    URL to the checksum, ETag and Last-Modified header of what was last
+    downloaded from it. Recipe download dirs get clones or hard links of the
+    stored files; hard links share their xattrs, so URLDownloader keeps each
+    recipe's validators for them in a sidecar file instead. The least
+    recently used files are evicted once the store grows beyond max_size
+    bytes."""
+
+    def __init__(self, root, max_size=None):
+        self.root = os.path.expanduser(root)
+        self.max_size = max_size
+        self.index_path = os.path.join(self.root, INDEX_FILENAME)
+
+    def object_path(self, sha256):
+        """Returns the path of the stored file with the given checksum"""
+        return os.path.join(self.root, "objects", sha256[:2], sha256)
+
+    @contextlib.contextmanager
+    def locked_index(self, write=False):
+        """Context manager yielding the index while holding the store lock,
+        writing it back afterwards if write is True"""
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, ".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            index = {"version": INDEX_VERSION, "urls": {}, "objects": {}}
+            try:
+                with open(self.index_path) as f:
+                    data = json.load(f)
+                if data.get("version") == INDEX_VERSION:
+                    index = data
+            except (OSError, ValueError):
+                pass
+            yield index
+            if write:
+                temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+                with open(temp_path, "w") as f:
+                    json.dump(index, f)
+                os.replace(temp_path, self.index_path)
+
+    def lookup(self, url):
+        """Returns the index entry (sha256, etag, last_modified) for what was
+        last downloaded from url, or None if it isn't in the store"""
+        with self.locked_index() as index:
+            entry = index["urls"].get(url)
+        if entry and os.path.exists(self.object_path(entry["sha256"])):
+            return entry
+        return None
+
+    def materialize(self, entry, destination):
+        """Put a copy of a stored download at destination"""
+        link_file(self.object_path(entry["sha256"]), destination)
+        with self.locked_index(write=True) as index:
+            if entry["sha256"] in index["objects"]:
+                index["objects"][entry["sha256"]]["last_used"] = time.time()
+
+    def add(self, path, sha256, url, etag="", last_modified=""):
+        """Record a download of url at path. If the same content is already
+        stored, path is replaced with a link to it; otherwise path is added to
+        the store."""
+        object_path = self.object_path(sha256)
+        with self.locked_index(write=True) as index:
+            if os.path.exists(object_path):
+                os.remove(path)
+                link_file(object_path, path)
+            else:
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                temp_path = f"{object_path}.{os.getpid()}.tmp"
+                link_file(path, temp_path)
+                os.replace(temp_path, object_path)
+            index["objects"][sha256] = {
+                "size": os.path.getsize(object_path),
+                "last_used": time.time(),
+            }
+            index["urls"][url] = {
+                "sha256": sha256,
+                "etag": etag,
+                "last_modified": last_modified,
+            }
+            self.evict(index)
+
+    def evict(self, index):
+        """Remove the least recently used downloads until the store is no
+        bigger than max_size. Must be called with the index locked."""
+        if not self.max_size:
+            return
+        objects = index["objects"]
+        total_size = sum(info["size"] for info in objects.values())
+        for sha256 in sorted(objects, key=lambda key: objects[key]["last_used"]):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(self.object_path(sha256))
+            except FileNotFoundError:
+                pass
+            except OSError as err:
+                log_err(f"WARNING: Can't evict {sha256} from download store: {err}")
+                continue
+            total_size -= objects.pop(sha256)["size"]
+        index["urls"] = {
+            url: entry
+            for url, entry in index["urls"].items()
+            if entry["sha256"] in objects
+        }
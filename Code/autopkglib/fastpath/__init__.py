@@ -0,0 +1,166 @@
+#!/usr/local/autopkg/python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Fingerprints of completed recipe runs, so that the steps after the check
+phase can be skipped when nothing they depend on has changed"""
+
+import hashlib
+import inspect
+import json
+import os
+import plistlib
+import tempfile
+
+from autopkglib import log_err
+from autopkglib.digestcache import file_digest
+
+RECORD_FILENAME = "fastpath.plist"
+# bump this whenever what a record holds changes
+RECORD_VERSION = 2
+# env variables that differ between runs without anything having changed
+VOLATILE_KEYS = (
+    "verbose",
+    "download_changed",
+    "etag",
+    "last_modified",
+    "download_sha256",
+    "download_md5",
+)
+
+# outputs saying what a run did, such as importing into a Munki repo, which
+# a skipped run mustn't report as done again
+CHANGE_KEYS = (
+    "munki_repo_changed",
+    "munki_info",
+    "pkginfo_repo_path",
+    "pkg_repo_path",
+    "new_package_request",
+)
+
+
+def is_volatile(key):
+    """True if key shouldn't count towards a fingerprint, or be restored"""
+    return key in VOLATILE_KEYS or key.endswith("_summary_result")
+
+
+def file_path(value):
+    """Returns value if it's the absolute path of an existing file or
+    directory, else None"""
+    if isinstance(value, str) and os.path.isabs(value) and os.path.exists(value):
+        return value
+    return None
+
+
+def processor_file(processor_class):
+    """Returns [path, size, mtime] of the file a processor class was loaded
+    from, standing in for its version"""
+    try:
+        path = inspect.getfile(processor_class)
+        info = os.stat(path)
+    except (TypeError, OSError):
+        return [getattr(processor_class, "__name__", str(processor_class))]
+    return [path, info.st_size, info.st_mtime_ns]
+
+
+def fingerprint(recipe, inputs, check_outputs, processor_classes, cache_dir=None):
+    """Returns a digest of everything the steps after a recipe's check phase
+    depend on: the merged recipe, its resolved inputs, the outputs of its
+    check phase (with the contents of any files they name, such as the
+    download) and the files its processors were loaded from"""
+    outputs = []
+    for output in check_outputs:
+        values = {}
+        for key, value in output.items():
+            if is_volatile(key):
+                continue
+            values[key] = value
+            path = file_path(value)
+            if path and os.path.isfile(path):
+                values[f"{key}:sha256"] = file_digest(path, cache_dir=cache_dir)
+        outputs.append(values)
+    data = json.dumps(
+        {
+            "recipe": recipe,
+            "inputs": {
+                key: value for key, value in inputs.items() if not is_volatile(key)
+            },
+            "check_outputs": outputs,
+            "processors": [processor_file(cls) for cls in processor_classes],
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def load_record(recipe_cache_dir):
+    """Returns the record of the recipe's last completed run, or None"""
+    try:
+        with open(os.path.join(recipe_cache_dir, RECORD_FILENAME), "rb") as f:
+            return plistlib.load(f)
+    except (OSError, plistlib.InvalidFileException, ValueError):
+        return None
+
+
+def matching_record(recipe_cache_dir, recipe_fingerprint):
+    """Returns the record of the recipe's last run if it had the same
+    fingerprint and the files it output still exist, else None"""
+    record = load_record(recipe_cache_dir)
+    if not record or record.get("version") != RECORD_VERSION:
+        return None
+    if record.get("fingerprint") != recipe_fingerprint:
+        return None
+    if not all(os.path.exists(path) for path in record.get("files", [])):
+        return None
+    return record
+
+
+def save_record(recipe_cache_dir, recipe_fingerprint, build_outputs):
+    """Record a completed run: its fingerprint, and the files output by the
+    steps after the check phase. Only the env variables naming those files
+    are restored when the run is skipped, and not the ones in CHANGE_KEYS:
+    flags and other outputs would report what the run did as done again."""
+    outputs = {}
+    files = []
+    for output in build_outputs:
+        for key, value in output.items():
+            path = file_path(value)
+            if path:
+                files.append(path)
+                if not (is_volatile(key) or key in CHANGE_KEYS):
+                    outputs[key] = path
+    record = {
+        "version": RECORD_VERSION,
+        "fingerprint": recipe_fingerprint,
+        "outputs": outputs,
+        "files": files,
+    }
+    path = os.path.join(recipe_cache_dir, RECORD_FILENAME)
+    try:
+        data = plistlib.dumps(record)
+    except (TypeError, OverflowError) as err:
+        # outputs that can't be recorded, so the run can't be skipped
+        log_err(f"WARNING: Can't record the run for the fast path: {err}")
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    fd, tmp_path = tempfile.mkstemp(dir=recipe_cache_dir, prefix=f".{RECORD_FILENAME}.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except OSError as err:
+        log_err(f"WARNING: Can't write {path}: {err}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
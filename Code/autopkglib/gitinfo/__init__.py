@@ -0,0 +1,171 @@
+#!/usr/local/autopkg/python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Last commits and local changes of the files in git working copies, read
+for all of a working copy's files at once"""
+
+import hashlib
+import json
+import os
+import re
+
+from autopkglib import log_err
+from autopkglib.recipeindex import git_head
+
+CACHE_VERSION = 1
+CACHE_SUBDIR = "git_info"
+COMMIT_HASH = re.compile(r"^[0-9a-f]{40}([0-9a-f]{24})?$")
+
+_repos = {}
+
+
+def find_toplevel(path):
+    """Returns the top directory of the git working copy containing path, or
+    None. Looks for .git rather than spawning git."""
+    directory = os.path.dirname(os.path.realpath(os.path.expanduser(path)))
+    while True:
+        if os.path.exists(os.path.join(directory, ".git")):
+            return directory
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+
+def parse_log(output):
+    """Returns a dict of path -> most recent commit from the output of
+    git log -z --format=%x01%H --name-only, newest commit first"""
+    commits = {}
+    for record in output.split("\x01")[1:]:
+        fields = record.split("\0")
+        for name in fields[1:]:
+            if name.startswith("\n"):
+                name = name[1:]
+            if name:
+                commits.setdefault(name, fields[0])
+    return commits
+
+
+def parse_status(output):
+    """Returns the set of paths listed by git status --porcelain -z"""
+    paths = set()
+    fields = iter(output.split("\0"))
+    for entry in fields:
+        if len(entry) < 4:
+            continue
+        paths.add(entry[3:])
+        if entry[0] in "RC":
+            # renames and copies are followed by the path they came from
+            paths.add(next(fields, ""))
+    return paths
+
+
+class GitRepoInfo:
+    """The commit that last changed each file in a git working copy, and
+    which files have local changes. Three git commands answer every lookup,
+    and the last commits are cached in CACHE_DIR for as long as HEAD stays
+    the same. run_git is called with a list of git arguments and a
+    git_directory, and returns git's output."""
+
+    def __init__(self, toplevel, run_git, cache_dir=None):
+        self.toplevel = toplevel
+        self.run_git = run_git
+        cache_dir = os.path.expanduser(cache_dir or "~/Library/AutoPkg/Cache")
+        self.cache_path = os.path.join(
+            cache_dir,
+            CACHE_SUBDIR,
+            hashlib.sha1(toplevel.encode("utf-8")).hexdigest() + ".json",
+        )
+        self.head = self.current_head()
+        self.commits = self.load() or self.read_commits()
+        self.changed = parse_status(
+            self.git(["status", "--porcelain", "-z", "--untracked-files=no"])
+        )
+
+    def git(self, arguments):
+        """Run git in the working copy"""
+        return self.run_git(arguments, git_directory=self.toplevel)
+
+    def current_head(self):
+        """Returns the commit checked out, reading .git directly if it can"""
+        head = git_head(self.toplevel)
+        if head and COMMIT_HASH.match(head):
+            return head
+        return self.git(["rev-parse", "HEAD"]).strip()
+
+    def load(self):
+        """Returns the cached last commits if they were read at this HEAD"""
+        try:
+            with open(self.cache_path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if (
+            not isinstance(data, dict)
+            or data.get("version") != CACHE_VERSION
+            or data.get("head") != self.head
+        ):
+            return None
+        return data.get("commits")
+
+    def read_commits(self):
+        """Read the last commit of every file from a single git log, and
+        cache them"""
+        commits = parse_log(
+            self.git(
+                ["log", "-z", "--format=%x01%H", "--name-only", "--no-renames", "HEAD"]
+            )
+        )
+        temp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with open(temp_path, "w") as f:
+                json.dump(
+                    {"version": CACHE_VERSION, "head": self.head, "commits": commits},
+                    f,
+                )
+            os.replace(temp_path, self.cache_path)
+        except OSError as err:
+            log_err(f"WARNING: Can't write git info cache {self.cache_path}: {err}")
+        return commits
+
+    def relative_path(self, path):
+        """Returns path relative to the top of the working copy, as git
+        names it"""
+        path = os.path.realpath(os.path.expanduser(path))
+        return os.path.relpath(path, self.toplevel).replace(os.sep, "/")
+
+    def last_commit(self, path):
+        """Returns the commit that last changed path, or None if it isn't
+        tracked"""
+        return self.commits.get(self.relative_path(path))
+
+    def is_changed(self, path):
+        """True if path has changes that aren't committed"""
+        return self.relative_path(path) in self.changed
+
+    def clean_commit(self, path):
+        """Returns the commit that last changed path, or None if path isn't
+        tracked or has been changed since"""
+        if self.is_changed(path):
+            return None
+        return self.last_commit(path)
+
+
+def get_git_repo_info(toplevel, run_git, cache_dir=None):
+    """Returns a GitRepoInfo for the working copy at toplevel, shared within
+    this process until its HEAD moves"""
+    repo = _repos.get(toplevel)
+    if repo is None or repo.current_head() != repo.head:
+        repo = _repos[toplevel] = GitRepoInfo(toplevel, run_git, cache_dir)
+    return repo
@@ -0,0 +1,256 @@
+#!/usr/local/autopkg/python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Metrics of recipe runs, written as OpenMetrics text files for collectors
+like node_exporter's textfile collector"""
+
+import os
+import tempfile
+import time
+
+from autopkglib import extract_processor_name_with_recipe_identifier
+
+# histogram buckets, in seconds
+RECIPE_BUCKETS = (1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+PROCESSOR_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+TRUST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def format_value(value):
+    """Returns a number as OpenMetrics expects it"""
+    if isinstance(value, float):
+        return repr(value) if value != float("inf") else "+Inf"
+    return str(value)
+
+
+def format_labels(labels):
+    """Returns {name="value",...} for a dict of labels, or "" if empty"""
+    if not labels:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Histogram:
+    """Counts of observed values by bucket, with their sum"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Add a value"""
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        """Returns the OpenMetrics sample lines of this histogram"""
+        lines = []
+        for bound, count in zip(self.buckets, self.bucket_counts):
+            bucket_labels = dict(labels, le=format_value(float(bound)))
+            lines.append(f"{name}_bucket{format_labels(bucket_labels)} {count}")
+        bucket_labels = dict(labels, le="+Inf")
+        lines.append(f"{name}_bucket{format_labels(bucket_labels)} {self.count}")
+        lines.append(f"{name}_count{format_labels(labels)} {self.count}")
+        lines.append(f"{name}_sum{format_labels(labels)} {format_value(self.sum)}")
+        return lines
+
+
+class RunMetrics:
+    """Metrics of a single 'autopkg run', built up from the results of each
+    recipe as it finishes"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.recipes = {"success": 0, "failure": 0, "load_failure": 0}
+        self.recipe_seconds = Histogram(RECIPE_BUCKETS)
+        self.last_recipe_seconds = {}
+        self.recipe_download_bytes = {}
+        self.processor_seconds = {}
+        self.processor_failures = {}
+        self.downloads = {"changed": 0, "unchanged": 0}
+        self.download_bytes = 0
+        self.trust_verification_seconds = Histogram(TRUST_BUCKETS)
+
+    def count_recipe(self, result):
+        """Count a recipe by result: success, failure or load_failure"""
+        self.recipes[result] += 1
+
+    def record_recipe(self, recipe_path, recipe_result):
+        """Add the result of a recipe run, as returned by process_recipe()"""
+        failure = recipe_result["failure"]
+        self.count_recipe("failure" if failure else "success")
+        if failure and failure.get("processor"):
+            processor = extract_processor_name_with_recipe_identifier(
+                failure["processor"]
+            )[0]
+            self.processor_failures[processor] = (
+                self.processor_failures.get(processor, 0) + 1
+            )
+
+        resources = recipe_result.get("resources") or {}
+        if "wall_time" in resources:
+            self.recipe_seconds.observe(resources["wall_time"])
+            self.last_recipe_seconds[recipe_path] = resources["wall_time"]
+        if "trust_verification_time" in resources:
+            self.trust_verification_seconds.observe(
+                resources["trust_verification_time"]
+            )
+
+        download_bytes = 0
+        for item in recipe_result["results"]:
+            if not item.get("Resources"):
+                continue
+            processor = extract_processor_name_with_recipe_identifier(
+                item["Processor"]
+            )[0]
+            if processor not in self.processor_seconds:
+                self.processor_seconds[processor] = Histogram(PROCESSOR_BUCKETS)
+            self.processor_seconds[processor].observe(item["Resources"]["wall_time"])
+            download_bytes += item["Resources"]["network_bytes"]
+            if processor == "URLDownloader":
+                # Output only has variables that are set and true
+                changed = item.get("Output", {}).get("download_changed")
+                self.downloads["changed" if changed else "unchanged"] += 1
+        self.download_bytes += download_bytes
+        self.recipe_download_bytes[recipe_path] = download_bytes
+
+    def finish(self):
+        """Mark the run as finished"""
+        self.finished = time.time()
+
+    def render(self):
+        """Returns the metrics in the OpenMetrics text format"""
+        lines = []
+
+        def family(name, metric_type, help_text):
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.append(f"# HELP {name} {help_text}")
+
+        family("autopkg_run_start_time_seconds", "gauge", "When the last run started.")
+        lines.append(f"autopkg_run_start_time_seconds {format_value(self.started)}")
+        family("autopkg_run_in_progress", "gauge", "1 while a run is in progress.")
+        lines.append(f"autopkg_run_in_progress {0 if self.finished else 1}")
+        if self.finished:
+            family(
+                "autopkg_run_duration_seconds", "gauge", "How long the last run took."
+            )
+            lines.append(
+                "autopkg_run_duration_seconds "
+                f"{format_value(self.finished - self.started)}"
+            )
+
+        family("autopkg_recipes", "counter", "Recipes run, by result.")
+        for result, count in self.recipes.items():
+            lines.append(
+                f"autopkg_recipes_total{format_labels({'result': result})} {count}"
+            )
+
+        family("autopkg_recipe_duration_seconds", "histogram", "Recipe run times.")
+        lines.extend(self.recipe_seconds.samples("autopkg_recipe_duration_seconds", {}))
+        family(
+            "autopkg_recipe_last_duration_seconds",
+            "gauge",
+            "How long each recipe took in this run.",
+        )
+        for recipe, seconds in sorted(self.last_recipe_seconds.items()):
+            lines.append(
+                "autopkg_recipe_last_duration_seconds"
+                f"{format_labels({'recipe': recipe})} {format_value(seconds)}"
+            )
+        family(
+            "autopkg_recipe_download_bytes",
+            "gauge",
+            "Bytes each recipe downloaded in this run.",
+        )
+        for recipe, count in sorted(self.recipe_download_bytes.items()):
+            lines.append(
+                "autopkg_recipe_download_bytes"
+                f"{format_labels({'recipe': recipe})} {count}"
+            )
+
+        family(
+            "autopkg_processor_duration_seconds",
+            "histogram",
+            "Processor run times, by processor.",
+        )
+        for processor, histogram in sorted(self.processor_seconds.items()):
+            lines.extend(
+                histogram.samples(
+                    "autopkg_processor_duration_seconds", {"processor": processor}
+                )
+            )
+        family(
+            "autopkg_processor_failures",
+            "counter",
+            "Recipes that failed in a processor, by processor.",
+        )
+        for processor, count in sorted(self.processor_failures.items()):
+            lines.append(
+                "autopkg_processor_failures_total"
+                f"{format_labels({'processor': processor})} {count}"
+            )
+
+        family(
+            "autopkg_downloads",
+            "counter",
+            "URLDownloader steps, by whether the download changed or the "
+            "cached copy was used.",
+        )
+        for result, count in self.downloads.items():
+            lines.append(
+                f"autopkg_downloads_total{format_labels({'result': result})} {count}"
+            )
+        family("autopkg_download_bytes", "counter", "Bytes downloaded.")
+        lines.append(f"autopkg_download_bytes_total {self.download_bytes}")
+
+        family(
+            "autopkg_trust_verification_duration_seconds",
+            "histogram",
+            "Parent recipe trust verification times.",
+        )
+        lines.extend(
+            self.trust_verification_seconds.samples(
+                "autopkg_trust_verification_duration_seconds", {}
+            )
+        )
+
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Atomically replace the file at path with the metrics, so that
+        collectors never read a partial file"""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(
+            dir=directory, prefix=f".{os.path.basename(path)}."
+        )
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(self.render())
+            # readable by collectors running as another user
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
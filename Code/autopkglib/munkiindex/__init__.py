@@ -0,0 +1,314 @@
+#!/usr/local/autopkg/python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Persistent SQLite index of the pkginfo files in a Munki repo"""
+
+import hashlib
+import os
+import plistlib
+import sqlite3
+
+from autopkglib import log_err
+
+# bump this whenever the schema changes; the index is then rebuilt
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE pkginfos (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    name TEXT,
+    version TEXT,
+    item BLOB
+);
+CREATE TABLE hashes (
+    pkginfo_id INTEGER REFERENCES pkginfos(id) ON DELETE CASCADE,
+    hash TEXT NOT NULL
+);
+CREATE TABLE receipts (
+    pkginfo_id INTEGER REFERENCES pkginfos(id) ON DELETE CASCADE,
+    packageid TEXT NOT NULL,
+    version TEXT NOT NULL
+);
+CREATE TABLE applications (
+    pkginfo_id INTEGER REFERENCES pkginfos(id) ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    version TEXT NOT NULL
+);
+CREATE TABLE files (
+    pkginfo_id INTEGER REFERENCES pkginfos(id) ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    md5checksum TEXT
+);
+CREATE TABLE installer_items (
+    pkginfo_id INTEGER REFERENCES pkginfos(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    version TEXT NOT NULL
+);
+CREATE INDEX hashes_hash ON hashes(hash);
+CREATE INDEX receipts_packageid ON receipts(packageid, version);
+CREATE INDEX applications_path ON applications(path, version);
+CREATE INDEX files_path ON files(path);
+CREATE INDEX files_md5checksum ON files(md5checksum);
+CREATE INDEX installer_items_name ON installer_items(name, version);
+CREATE INDEX hashes_pkginfo ON hashes(pkginfo_id);
+CREATE INDEX receipts_pkginfo ON receipts(pkginfo_id);
+CREATE INDEX applications_pkginfo ON applications(pkginfo_id);
+CREATE INDEX files_pkginfo ON files(pkginfo_id);
+CREATE INDEX installer_items_pkginfo ON installer_items(pkginfo_id);
+"""
+
+
+def default_index_path(repo_path, cache_dir=None):
+    """Returns where the index for a repo is kept: inside CACHE_DIR, named
+    after the repo path, so a shared repo is never written to"""
+    cache_dir = os.path.expanduser(cache_dir or "~/Library/AutoPkg/Cache")
+    repo_key = hashlib.sha1(os.path.abspath(repo_path).encode()).hexdigest()
+    return os.path.join(cache_dir, "munki_index", f"{repo_key}.sqlite")
+
+
+def pkginfo_rows(item):
+    """Returns the rows to index for a pkginfo, as a dict of table name to a
+    list of value tuples. Mirrors the tables MunkiImporter used to build from
+    the 'all' catalog."""
+    vers = item["version"]
+    rows = {
+        "hashes": [],
+        "receipts": [],
+        "applications": [],
+        "files": [],
+        "installer_items": [],
+    }
+    if "installer_item_hash" in item:
+        rows["hashes"].append((item["installer_item_hash"],))
+    if "installer_item_location" in item:
+        name = os.path.basename(item["installer_item_location"])
+        rows["installer_items"].append((name, vers))
+    for receipt in item.get("receipts", []):
+        try:
+            if "packageid" in receipt and "version" in receipt:
+                rows["receipts"].append((receipt["packageid"], receipt["version"]))
+        except TypeError:
+            continue
+    for install in item.get("installs", []):
+        try:
+            if install.get("type") in ("application", "bundle") and "path" in install:
+                if "version_comparison_key" in install:
+                    app_version = install[install["version_comparison_key"]]
+                else:
+                    app_version = install["CFBundleShortVersionString"]
+                rows["applications"].append((install["path"], app_version))
+            if install.get("type") == "file" and "path" in install:
+                rows["files"].append((install["path"], install.get("md5checksum")))
+        except (AttributeError, TypeError, KeyError):
+            continue
+    return rows
+
+
+class MunkiRepoIndex:
+    """An SQLite index of a Munki repo's pkginfo files: installer item hashes,
+    receipts, installs paths/versions and installer item names.
+
+    sync() brings the index up to date by re-reading only pkginfo files whose
+    mtime or size changed since the last sync, and dropping deleted ones."""
+
+    def __init__(self, repo_path, index_path=None, cache_dir=None):
+        self.repo_path = repo_path
+        self.index_path = index_path or default_index_path(repo_path, cache_dir)
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        self.db = sqlite3.connect(self.index_path, timeout=60)
+        self.db.execute("PRAGMA foreign_keys = ON")
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            self.create_schema()
+
+    def create_schema(self):
+        """(Re)create the index tables"""
+        with self.db:
+            tables = [
+                row[0]
+                for row in self.db.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table'"
+                )
+            ]
+            for table in tables:
+                self.db.execute(f"DROP TABLE {table}")
+            self.db.executescript(SCHEMA)
+            self.db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def close(self):
+        """Close the database connection"""
+        self.db.close()
+
+    def scan_pkginfo_files(self):
+        """Returns a dict of path -> (mtime_ns, size) for the pkginfo files in
+        the repo, skipping hidden files and directories like makecatalogs"""
+        pkgsinfo_dir = os.path.join(self.repo_path, "pkgsinfo")
+        found = {}
+        for dirpath, dirnames, filenames in os.walk(pkgsinfo_dir, followlinks=True):
+            dirnames[:] = [name for name in dirnames if not name.startswith(".")]
+            for filename in filenames:
+                if filename.startswith("."):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    continue
+                found[path] = (info.st_mtime_ns, info.st_size)
+        return found
+
+    def sync(self):
+        """Update the index from the repo's pkgsinfo directory. Returns the
+        number of pkginfo files that were (re)indexed or removed."""
+        found = self.scan_pkginfo_files()
+        known = {
+            path: (mtime_ns, size)
+            for path, mtime_ns, size in self.db.execute(
+                "SELECT path, mtime_ns, size FROM pkginfos"
+            )
+        }
+        changed = [path for path, stat in found.items() if known.get(path) != stat]
+        removed = [path for path in known if path not in found]
+        if not changed and not removed:
+            return 0
+        with self.db:
+            self.db.executemany(
+                "DELETE FROM pkginfos WHERE path = ?",
+                [(path,) for path in removed + changed],
+            )
+            for path in changed:
+                self.index_pkginfo(path, found[path])
+        return len(changed) + len(removed)
+
+    def index_pkginfo(self, path, stat):
+        """Parse a pkginfo file and add it to the index. Must be called inside
+        a transaction."""
+        item = None
+        try:
+            with open(path, "rb") as f:
+                item = plistlib.load(f)
+        except Exception as err:
+            log_err(f"WARNING: Can't read pkginfo {path}: {err}")
+        if not isinstance(item, dict) or not item.get("name") or "version" not in item:
+            # remember the file so it isn't re-read until it changes
+            self.db.execute(
+                "INSERT INTO pkginfos (path, mtime_ns, size) VALUES (?, ?, ?)",
+                (path, stat[0], stat[1]),
+            )
+            return
+        cursor = self.db.execute(
+            "INSERT INTO pkginfos (path, mtime_ns, size, name, version, item) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                path,
+                stat[0],
+                stat[1],
+                item["name"],
+                item["version"],
+                plistlib.dumps(item, fmt=plistlib.FMT_BINARY),
+            ),
+        )
+        pkginfo_id = cursor.lastrowid
+        for table, values in pkginfo_rows(item).items():
+            if not values:
+                continue
+            placeholders = ", ".join("?" * (len(values[0]) + 1))
+            self.db.executemany(
+                f"INSERT INTO {table} VALUES ({placeholders})",
+                [(pkginfo_id,) + row for row in values],
+            )
+
+    def missing_items(self, item):
+        """Returns the installer and uninstaller items a pkginfo refers to
+        that are missing from the repo's pkgs directory"""
+        pkgs_dir = os.path.join(self.repo_path, "pkgs")
+        return [
+            item[key]
+            for key in ("installer_item_location", "uninstaller_item_location")
+            if key in item and not os.path.exists(os.path.join(pkgs_dir, item[key]))
+        ]
+
+    def item(self, pkginfo_id):
+        """Returns the pkginfo dict with the given id"""
+        row = self.db.execute(
+            "SELECT item FROM pkginfos WHERE id = ?", (pkginfo_id,)
+        ).fetchone()
+        return plistlib.loads(row[0]) if row else None
+
+    def ids(self, query, params):
+        """Returns the set of pkginfo ids a query matches, leaving out
+        pkginfos whose installer item is missing from the repo, as the 'all'
+        catalog does"""
+        return {
+            pkginfo_id
+            for pkginfo_id in {row[0] for row in self.db.execute(query, params)}
+            if not self.missing_items(self.item(pkginfo_id))
+        }
+
+    def ids_with_hash(self, installer_item_hash):
+        """Returns ids of pkginfos with the given installer_item_hash"""
+        return self.ids(
+            "SELECT pkginfo_id FROM hashes WHERE hash = ?", (installer_item_hash,)
+        )
+
+    def ids_with_application(self, path, version):
+        """Returns ids of pkginfos installing an application/bundle at path
+        with the given version"""
+        return self.ids(
+            "SELECT pkginfo_id FROM applications WHERE path = ? AND version = ?",
+            (path, version),
+        )
+
+    def ids_with_receipt(self, packageid, version):
+        """Returns ids of pkginfos with the given receipt"""
+        return self.ids(
+            "SELECT pkginfo_id FROM receipts WHERE packageid = ? AND version = ?",
+            (packageid, version),
+        )
+
+    def ids_with_file(self, path, md5checksum=None):
+        """Returns ids of pkginfos installing a file at path, with the given
+        md5checksum, or with no md5checksum if md5checksum is None"""
+        if md5checksum is None:
+            return self.ids(
+                "SELECT pkginfo_id FROM files "
+                "WHERE path = ? AND md5checksum IS NULL",
+                (path,),
+            )
+        return self.ids(
+            "SELECT pkginfo_id FROM files WHERE path = ? AND md5checksum = ?",
+            (path, md5checksum),
+        )
+
+    def ids_with_installer_item(self, name, version):
+        """Returns ids of pkginfos whose installer item has the given file
+        name and version"""
+        return self.ids(
+            "SELECT pkginfo_id FROM installer_items WHERE name = ? AND version = ?",
+            (name, version),
+        )
+
+    def first_item(self, pkginfo_ids):
+        """Returns the pkginfo with the lowest path among pkginfo_ids, or
+        None"""
+        if not pkginfo_ids:
+            return None
+        ids = sorted(pkginfo_ids)
+        row = self.db.execute(
+            "SELECT id FROM pkginfos WHERE id IN "
+            f"({', '.join('?' * len(ids))}) ORDER BY path LIMIT 1",
+            ids,
+        ).fetchone()
+        return self.item(row[0])
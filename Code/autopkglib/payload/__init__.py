@@ -0,0 +1,313 @@
+#!/usr/local/autopkg/python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Streaming extractor for package payloads: cpio archives, plain or
+compressed with gzip, bzip2, xz or pbzx"""
+
+import bz2
+import collections
+import concurrent.futures
+import lzma
+import os
+import stat
+import struct
+import zlib
+
+CHUNK_SIZE = 2 ** 20
+PBZX_MAGIC = b"pbzx"
+XZ_MAGIC = b"\xfd7zXZ\x00"
+CPIO_ODC_MAGIC = b"070707"
+CPIO_NEWC_MAGICS = (b"070701", b"070702")
+CPIO_TRAILER = "TRAILER!!!"
+
+
+class PayloadError(Exception):
+    """Raised for payloads that can't be unpacked"""
+
+
+def payload_format(path):
+    """Returns the format of a payload file: pbzx, gzip, bzip2, xz or cpio.
+    Returns None if it's none of these."""
+    with open(path, "rb") as f:
+        magic = f.read(6)
+    if magic.startswith(PBZX_MAGIC):
+        return "pbzx"
+    if magic.startswith(b"\x1f\x8b"):
+        return "gzip"
+    if magic.startswith(b"BZh"):
+        return "bzip2"
+    if magic == XZ_MAGIC:
+        return "xz"
+    if magic == CPIO_ODC_MAGIC or magic in CPIO_NEWC_MAGICS:
+        return "cpio"
+    return None
+
+
+def decompress_pbzx_chunk(data):
+    """Decompress one pbzx chunk. Chunks that didn't compress are stored as
+    is."""
+    if data.startswith(XZ_MAGIC):
+        return lzma.decompress(data, format=lzma.FORMAT_XZ)
+    return data
+
+
+def read_pbzx_chunks(f):
+    """Yields the raw chunks of a pbzx stream: a header, then chunks each
+    preceded by flags and a length, for as long as the flags say more follow"""
+    header = f.read(12)
+    if len(header) < 12 or not header.startswith(PBZX_MAGIC):
+        raise PayloadError("Not a pbzx stream")
+    (flags,) = struct.unpack(">Q", header[4:])
+    while flags & 0x01000000:
+        chunk_header = f.read(16)
+        if len(chunk_header) < 16:
+            raise PayloadError("Truncated pbzx stream")
+        flags, length = struct.unpack(">QQ", chunk_header)
+        data = f.read(length)
+        if len(data) < length:
+            raise PayloadError("Truncated pbzx stream")
+        yield data
+
+
+def iter_pbzx(f, workers):
+    """Yields the decompressed contents of a pbzx stream in order. Chunks are
+    decompressed across a pool of worker processes, with at most two per
+    worker in flight so memory use stays bounded."""
+    chunks = read_pbzx_chunks(f)
+    first = next(chunks, None)
+    if first is None:
+        return
+    second = next(chunks, None)
+    if second is None or workers < 2:
+        yield decompress_pbzx_chunk(first)
+        if second is not None:
+            yield decompress_pbzx_chunk(second)
+        for data in chunks:
+            yield decompress_pbzx_chunk(data)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque(
+            executor.submit(decompress_pbzx_chunk, data) for data in (first, second)
+        )
+        for data in chunks:
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+            pending.append(executor.submit(decompress_pbzx_chunk, data))
+        while pending:
+            yield pending.popleft().result()
+
+
+def iter_decompressed(f, new_decompressor):
+    """Yields the decompressed contents of a stream of one or more
+    concatenated compressed members"""
+    decompressor = new_decompressor()
+    while True:
+        data = f.read(CHUNK_SIZE)
+        if not data:
+            break
+        while data:
+            yield decompressor.decompress(data)
+            if not decompressor.eof:
+                break
+            data = decompressor.unused_data
+            decompressor = new_decompressor()
+
+
+def iter_payload(path, workers=1):
+    """Yields the uncompressed cpio archive of a payload in chunks"""
+    payload = payload_format(path)
+    with open(path, "rb") as f:
+        try:
+            if payload == "pbzx":
+                yield from iter_pbzx(f, workers)
+            elif payload == "gzip":
+                yield from iter_decompressed(
+                    f, lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+                )
+            elif payload == "bzip2":
+                yield from iter_decompressed(f, bz2.BZ2Decompressor)
+            elif payload == "xz":
+                yield from iter_decompressed(f, lzma.LZMADecompressor)
+            elif payload == "cpio":
+                yield from iter(lambda: f.read(CHUNK_SIZE), b"")
+            else:
+                raise PayloadError(f"{path} is not a supported payload")
+        except (EOFError, OSError, zlib.error, lzma.LZMAError) as err:
+            raise PayloadError(f"Can't decompress {path}: {err}")
+
+
+class ChunkReader:
+    """File-like reads of exact sizes from an iterator of byte chunks"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = memoryview(b"")
+
+    def fill(self):
+        """Replace the buffer with the next non-empty chunk. Returns False at
+        the end of the stream."""
+        for chunk in self.chunks:
+            if chunk:
+                self.buffer = memoryview(chunk)
+                return True
+        return False
+
+    def iter_read(self, size):
+        """Yields exactly size bytes in pieces, without joining them"""
+        while size:
+            if not self.buffer and not self.fill():
+                raise PayloadError("Truncated cpio archive")
+            piece = self.buffer[:size]
+            self.buffer = self.buffer[len(piece) :]
+            size -= len(piece)
+            yield piece
+
+    def read(self, size):
+        """Returns exactly size bytes"""
+        return b"".join(self.iter_read(size))
+
+    def skip(self, size):
+        """Discard size bytes"""
+        for _ in self.iter_read(size):
+            pass
+
+
+class CpioEntry:
+    """The header of one cpio archive entry"""
+
+    def __init__(self, reader):
+        magic = reader.read(6)
+        if magic == CPIO_ODC_MAGIC:
+            header = reader.read(70)
+            fields = [int(header[i : i + 6], 8) for i in range(0, 42, 6)]
+            self.dev, self.ino, self.mode, self.uid, self.gid, self.nlink, _ = fields
+            self.mtime = int(header[42:53], 8)
+            namesize = int(header[53:59], 8)
+            self.size = int(header[59:70], 8)
+            self.padding = 0
+            name = reader.read(namesize)
+        elif magic in CPIO_NEWC_MAGICS:
+            header = reader.read(104)
+            fields = [int(header[i : i + 8], 16) for i in range(0, 104, 8)]
+            self.ino, self.mode, self.uid, self.gid, self.nlink = fields[:5]
+            self.mtime, self.size = fields[5:7]
+            self.dev = (fields[7], fields[8])
+            namesize = fields[11]
+            # the header and name, then the data, are padded to 4 bytes
+            name = reader.read(namesize + (-(110 + namesize) % 4))[:namesize]
+            self.padding = -self.size % 4
+        else:
+            raise PayloadError(f"Bad cpio header magic {magic!r}")
+        self.name = os.fsdecode(name.rstrip(b"\0"))
+
+
+def safe_path(destination, name):
+    """Returns where a member named name is extracted to, or None for the
+    archive root. Raises PayloadError for names that would escape
+    destination."""
+    name = os.path.normpath(name.lstrip("/"))
+    if name == ".":
+        return None
+    if name == ".." or name.startswith("../"):
+        raise PayloadError(f"Refusing to extract {name} outside the destination")
+    return os.path.join(destination, name)
+
+
+def check_inside(destination, path):
+    """Raises PayloadError if path, with any symlinks in it resolved, is
+    outside destination. Payloads hold symlinks to anywhere, such as
+    /usr/local/bin links, but nothing is written through them."""
+    root = os.path.realpath(destination)
+    real_path = os.path.realpath(path)
+    if real_path != root and not real_path.startswith(root + os.sep):
+        raise PayloadError(f"Refusing to extract {path} outside the destination")
+
+
+def extract_cpio(chunks, destination):
+    """Extract a cpio archive (odc or newc), given as an iterator of byte
+    chunks, into destination. Regular files are streamed to disk; modes,
+    modification times, symlinks and hard links are restored, and owners
+    too when running as root. Returns the number of entries extracted."""
+    reader = ChunkReader(chunks)
+    links = {}
+    directories = []
+    count = 0
+    restore_owner = os.geteuid() == 0
+    while True:
+        entry = CpioEntry(reader)
+        if entry.name == CPIO_TRAILER:
+            break
+        path = safe_path(destination, entry.name)
+        kind = stat.S_IFMT(entry.mode)
+        if path is None or kind not in (stat.S_IFDIR, stat.S_IFLNK, stat.S_IFREG):
+            # the archive root, or a device or fifo; nothing to extract
+            reader.skip(entry.size + entry.padding)
+            continue
+        count += 1
+        parent = os.path.dirname(path)
+        check_inside(destination, path if kind == stat.S_IFDIR else parent)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        if kind == stat.S_IFDIR:
+            reader.skip(entry.size + entry.padding)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            directories.append((path, entry))
+            continue
+        if os.path.lexists(path) and not os.path.isdir(path):
+            os.unlink(path)
+        if kind == stat.S_IFLNK:
+            target = os.fsdecode(reader.read(entry.size))
+            reader.skip(entry.padding)
+            os.symlink(target, path)
+            if restore_owner:
+                os.lchown(path, entry.uid, entry.gid)
+            continue
+
+        link_key = (entry.dev, entry.ino)
+        if entry.nlink > 1 and link_key in links:
+            # a later link to a file we already extracted: link to it, and
+            # write its data through the link if this entry carries it
+            os.link(links[link_key], path)
+            if not entry.size:
+                reader.skip(entry.padding)
+                continue
+        elif entry.nlink > 1:
+            links[link_key] = path
+        with open(path, "wb") as f:
+            for piece in reader.iter_read(entry.size):
+                f.write(piece)
+        reader.skip(entry.padding)
+        if restore_owner:
+            os.chown(path, entry.uid, entry.gid)
+        os.chmod(path, stat.S_IMODE(entry.mode))
+        os.utime(path, (entry.mtime, entry.mtime))
+
+    # set directory modes and times last, once their contents are in place
+    for path, entry in reversed(directories):
+        if restore_owner:
+            os.chown(path, entry.uid, entry.gid)
+        os.chmod(path, stat.S_IMODE(entry.mode))
+        os.utime(path, (entry.mtime, entry.mtime))
+    return count
+
+
+def unpack_payload(path, destination, workers=None):
+    """Unpack a package payload into destination, decompressing pbzx chunks
+    across up to workers processes (defaults to the number of CPUs). Returns
+    the number of entries extracted."""
+    workers = workers or os.cpu_count() or 1
+    try:
+        return extract_cpio(iter_payload(path, workers), destination)
+    except ValueError as err:
+        raise PayloadError(f"Bad cpio header in {path}: {err}")
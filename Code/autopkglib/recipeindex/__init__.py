@@ -0,0 +1,309 @@
+#!/usr/local/autopkg/python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Persistent index of the recipes found in recipe search directories"""
+
+import json
+import os
+import plistlib
+import threading
+
+from autopkglib import get_identifier, get_pref, log_err
+
+INDEX_FILENAME = "recipe_index.json"
+# bump this whenever the format of an indexed recipe changes
+INDEX_VERSION = 1
+
+
+def default_index_path():
+    """Returns the path of the index file inside CACHE_DIR"""
+    cache_dir = get_pref("CACHE_DIR") or "~/Library/AutoPkg/Cache"
+    return os.path.join(os.path.expanduser(cache_dir), INDEX_FILENAME)
+
+
+def git_head(directory):
+    """Returns the commit checked out in a git working copy at directory, or
+    None if directory isn't the top of a git working copy. Reads .git directly
+    to avoid spawning git."""
+    git_dir = os.path.join(directory, ".git")
+    try:
+        with open(os.path.join(git_dir, "HEAD")) as f:
+            head = f.read().strip()
+    except OSError:
+        return None
+    if not head.startswith("ref: "):
+        # detached HEAD
+        return head
+    ref = head[5:]
+    try:
+        with open(os.path.join(git_dir, ref)) as f:
+            return f.read().strip()
+    except OSError:
+        pass
+    try:
+        with open(os.path.join(git_dir, "packed-refs")) as f:
+            for line in f:
+                if line.rstrip("\n").endswith(" " + ref):
+                    return line.split()[0]
+    except OSError:
+        pass
+    return head
+
+
+def stat_key(path):
+    """Returns a list of (mtime_ns, inode, size) for path, or None if path
+    can't be stat'd"""
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return [info.st_mtime_ns, info.st_ino, info.st_size]
+
+
+def scan_recipe_files(directory):
+    """Returns (recipe_paths, stamp) for a directory: the '*.recipe' and
+    '*/*.recipe' files in the same top-level-first order as the glob patterns
+    previously used for recipe lookup, and a stamp that changes whenever those
+    directories' contents do."""
+    stamp = {"git_head": git_head(directory), "dirs": {}}
+    top_level = []
+    nested = []
+    subdirs = []
+    stamp["dirs"]["."] = stat_key(directory)
+    try:
+        entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+    except OSError:
+        return [], stamp
+    for entry in entries:
+        if entry.name.startswith("."):
+            continue
+        if entry.name.endswith(".recipe") and entry.is_file():
+            top_level.append(entry.path)
+        elif entry.is_dir():
+            subdirs.append(entry)
+    for subdir in subdirs:
+        stamp["dirs"][subdir.name] = stat_key(subdir.path)
+        try:
+            sub_entries = sorted(os.scandir(subdir.path), key=lambda e: e.name)
+        except OSError:
+            continue
+        for entry in sub_entries:
+            if (
+                not entry.name.startswith(".")
+                and entry.name.endswith(".recipe")
+                and entry.is_file()
+            ):
+                nested.append(entry.path)
+    return top_level + nested, stamp
+
+
+def directory_stamp(directory, previous_stamp):
+    """Returns a fresh stamp for directory, using only the subdirectories that
+    were known when previous_stamp was made. Any new subdirectory also changes
+    the stamp of the directory itself."""
+    stamp = {"git_head": git_head(directory), "dirs": {}}
+    for subdir in previous_stamp.get("dirs", {}):
+        stamp["dirs"][subdir] = stat_key(
+            os.path.normpath(os.path.join(directory, subdir))
+        )
+    return stamp
+
+
+def index_recipe_file(path, file_stat):
+    """Parses a recipe file and returns the dict stored in the index for it"""
+    entry = {
+        "stat": file_stat,
+        "name": os.path.splitext(os.path.basename(path))[0],
+        "keys": [],
+        "identifier": None,
+        "parent": None,
+        "processors": [],
+    }
+    try:
+        with open(path, "rb") as f:
+            recipe = plistlib.load(f)
+    except Exception as err:
+        log_err(f"WARNING: plist error for {path}: {err}")
+        return entry
+    if not isinstance(recipe, dict):
+        return entry
+    entry["keys"] = sorted(recipe.keys())
+    entry["identifier"] = get_identifier(recipe)
+    parent = recipe.get("ParentRecipe")
+    if not parent and isinstance(recipe.get("Recipe"), dict):
+        parent = recipe["Recipe"].get("identifier")
+    entry["parent"] = parent
+    process = recipe.get("Process")
+    if isinstance(process, list):
+        entry["processors"] = [
+            step.get("Processor") for step in process if isinstance(step, dict)
+        ]
+    return entry
+
+
+class RecipeIndex:
+    """An on-disk index of recipe files (identifier -> path, name -> path,
+    parent identifier and processors used), kept per search directory.
+
+    A directory is re-listed only when the mtime/inode of it or one of its
+    subdirectories changes, or when its git HEAD moves. Each indexed file is
+    also stat'd so recipes edited in place (like overrides updated by
+    update-trust-info, or uncommitted edits in a git working copy) are
+    re-parsed. Each directory is validated at most once per process; after
+    that lookups are dict lookups. An index may be shared between threads."""
+
+    def __init__(self, index_path=None):
+        self.index_path = index_path or default_index_path()
+        self.lock = threading.RLock()
+        self.directories = {}
+        self.validated = set()
+        self.lookup_tables = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        """Read the index file, discarding it if it's unreadable or from
+        another version of the index"""
+        try:
+            with open(self.index_path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(data, dict) or data.get("version") != INDEX_VERSION:
+            return
+        self.directories = data.get("directories", {})
+
+    def save(self):
+        """Atomically write the index file if anything changed"""
+        with self.lock:
+            if not self.dirty:
+                return
+            temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+            try:
+                os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+                with open(temp_path, "w") as f:
+                    json.dump(
+                        {"version": INDEX_VERSION, "directories": self.directories}, f
+                    )
+                os.replace(temp_path, self.index_path)
+            except OSError as err:
+                log_err(f"WARNING: Can't write recipe index {self.index_path}: {err}")
+                return
+            self.dirty = False
+
+    def invalidate(self, directory=None):
+        """Forget that directory (or every directory) was validated in this
+        process, so that the next lookup checks it again"""
+        with self.lock:
+            if directory is None:
+                self.validated.clear()
+                self.lookup_tables.clear()
+            else:
+                directory = os.path.abspath(os.path.expanduser(directory))
+                self.validated.discard(directory)
+                self.lookup_tables.pop(directory, None)
+
+    def refresh_directory(self, directory):
+        """Bring the index entry for a normalized directory up to date"""
+        cached = self.directories.get(directory)
+        if cached and directory_stamp(directory, cached["stamp"]) == cached["stamp"]:
+            paths = list(cached["recipes"].keys())
+            stamp = cached["stamp"]
+        else:
+            paths, stamp = scan_recipe_files(directory)
+        old_recipes = cached["recipes"] if cached else {}
+        recipes = {}
+        changed = not cached or stamp != cached["stamp"]
+        for path in paths:
+            file_stat = stat_key(path)
+            if file_stat is None:
+                changed = True
+                continue
+            entry = old_recipes.get(path)
+            if not entry or entry["stat"] != file_stat:
+                entry = index_recipe_file(path, file_stat)
+                changed = True
+            recipes[path] = entry
+        if changed:
+            self.directories[directory] = {"stamp": stamp, "recipes": recipes}
+            self.lookup_tables.pop(directory, None)
+            self.dirty = True
+
+    def directory_tables(self, directory):
+        """Returns lookup tables for the recipes in directory, refreshing the
+        index entry for the directory first if needed"""
+        with self.lock:
+            directory = os.path.abspath(os.path.expanduser(directory))
+            if directory not in self.validated:
+                self.refresh_directory(directory)
+                self.validated.add(directory)
+                self.save()
+            if directory not in self.lookup_tables:
+                by_identifier = {}
+                by_name = {}
+                recipes = self.directories.get(directory, {}).get("recipes", {})
+                # dicts keep insertion order, which is our search order
+                for path, entry in recipes.items():
+                    if entry["identifier"]:
+                        by_identifier.setdefault(entry["identifier"], path)
+                    by_name.setdefault(entry["name"], []).append(path)
+                self.lookup_tables[directory] = {
+                    "recipes": recipes,
+                    "by_identifier": by_identifier,
+                    "by_name": by_name,
+                }
+            return self.lookup_tables[directory]
+
+    def find_recipe_by_identifier(self, identifier, search_dirs):
+        """Returns the path to the first recipe in search_dirs with the given
+        identifier, or None"""
+        for directory in search_dirs:
+            path = self.directory_tables(directory)["by_identifier"].get(identifier)
+            if path:
+                return path
+        return None
+
+    def find_recipes_by_name(self, name, directory):
+        """Returns the paths to recipes named name ('*.recipe' minus the
+        extension) in a single directory. Names that only match
+        case-insensitively are returned too if the filesystem resolves them,
+        mirroring glob's behavior on case-insensitive filesystems."""
+        tables = self.directory_tables(directory)
+        paths = list(tables["by_name"].get(name, []))
+        lowercase_name = name.lower()
+        for other_name, other_paths in tables["by_name"].items():
+            if other_name == name or other_name.lower() != lowercase_name:
+                continue
+            for path in other_paths:
+                candidate = os.path.join(os.path.dirname(path), f"{name}.recipe")
+                if os.path.exists(candidate):
+                    paths.append(candidate)
+        return paths
+
+    def recipe_entries(self, search_dirs):
+        """Yields (path, entry) for all indexed recipes in search_dirs"""
+        for directory in search_dirs:
+            yield from self.directory_tables(directory)["recipes"].items()
+
+
+_recipe_index = None
+_recipe_index_lock = threading.Lock()
+
+
+def get_recipe_index():
+    """Returns the process-wide RecipeIndex"""
+    global _recipe_index
+    with _recipe_index_lock:
+        if _recipe_index is None:
+            _recipe_index = RecipeIndex()
+    return _recipe_index
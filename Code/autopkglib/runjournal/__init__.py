@@ -0,0 +1,136 @@
+#!/usr/local/autopkg/python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Append-only JSON lines journal of the recipes in an 'autopkg run', with
+a reader and an exporter to the autopkg_results.plist format"""
+
+import base64
+import datetime
+import json
+import os
+import plistlib
+import tempfile
+import threading
+import time
+
+JOURNAL_FILENAME = "autopkg_results.jsonl"
+JOURNAL_VERSION = 1
+# seconds between fsyncs; every record is flushed so it can be tailed
+FSYNC_INTERVAL = 1.0
+
+
+def encode_value(value):
+    """json.dumps() default for the plist types JSON doesn't have"""
+    if isinstance(value, datetime.datetime):
+        return {"$date": value.isoformat()}
+    if isinstance(value, (bytes, bytearray)):
+        return {"$data": base64.b64encode(value).decode("ascii")}
+    if isinstance(value, tuple):
+        return list(value)
+    raise TypeError(f"Can't write a {type(value).__name__} to the journal")
+
+
+def decode_object(obj):
+    """json.loads() object_hook turning encode_value() objects back into
+    plist types"""
+    if len(obj) == 1:
+        if "$date" in obj:
+            return datetime.datetime.fromisoformat(obj["$date"])
+        if "$data" in obj:
+            return base64.b64decode(obj["$data"])
+    return obj
+
+
+class RunJournal:
+    """Writes one JSON line per recipe run, after a line for the run itself.
+    Each line is flushed as it's written, so the journal can be followed
+    with tail -f, and fsynced at most every FSYNC_INTERVAL seconds and when
+    closed. A crash can only lose whole records, which read_journal()
+    skips."""
+
+    def __init__(self, path, fsync_interval=FSYNC_INTERVAL):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.file = open(path, "wb")
+        self.last_fsync = time.monotonic()
+        self.write({"type": "run", "version": JOURNAL_VERSION, "started": time.time()})
+
+    def write(self, record):
+        """Append a record"""
+        line = json.dumps(record, default=encode_value, separators=(",", ":"))
+        with self.lock:
+            self.file.write(line.encode("utf-8") + b"\n")
+            self.file.flush()
+            if time.monotonic() - self.last_fsync >= self.fsync_interval:
+                os.fsync(self.file.fileno())
+                self.last_fsync = time.monotonic()
+
+    def add_recipe(self, recipe_path, results):
+        """Append the AutoPackager results of a recipe run"""
+        self.write(
+            {
+                "type": "recipe",
+                "recipe": recipe_path,
+                "finished": time.time(),
+                "results": results,
+            }
+        )
+
+    def close(self):
+        """Flush, fsync and close the journal"""
+        with self.lock:
+            if not self.file.closed:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+
+
+def read_journal(path):
+    """Yields the records of a journal in order. A final line that was only
+    partly written, or any line that isn't valid JSON, is skipped."""
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                # still being written, or cut off by a crash
+                break
+            try:
+                yield json.loads(line, object_hook=decode_object)
+            except ValueError:
+                continue
+
+
+def journal_results(path):
+    """Yields the AutoPackager results of each recipe in a journal, the
+    items of the list autopkg_results.plist holds"""
+    for record in read_journal(path):
+        if record.get("type") == "recipe":
+            yield record["results"]
+
+
+def export_plist(journal_path, plist_path):
+    """Write the results in a journal to plist_path in the format of
+    autopkg_results.plist. The plist is replaced atomically."""
+    directory = os.path.dirname(os.path.abspath(plist_path))
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix=f".{os.path.basename(plist_path)}."
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            plistlib.dump(list(journal_results(journal_path)), f)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, plist_path)
+    except (OSError, TypeError, ValueError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
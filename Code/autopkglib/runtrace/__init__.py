@@ -0,0 +1,239 @@
+#!/usr/local/autopkg/python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Resource usage of recipe steps, and Chrome trace event files of whole
+runs"""
+
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+# audit events raised when a subprocess is started
+SUBPROCESS_EVENTS = ("subprocess.Popen", "os.system", "os.posix_spawn", "os.spawn")
+# proc_pid_rusage() flavor with disk I/O byte counts
+RUSAGE_INFO_V2 = 2
+
+_local = threading.local()
+_counters_lock = threading.Lock()
+_audit_hook_lock = threading.Lock()
+_audit_hook_added = False
+_libproc = None
+_rusage_info_v2 = None
+
+
+def current_counters():
+    """Returns the dict of subprocesses started and network bytes received
+    that this thread counts into"""
+    counters = getattr(_local, "counters", None)
+    if counters is None:
+        counters = _local.counters = {"subprocesses": 0, "network_bytes": 0}
+    return counters
+
+
+def _count(key, value):
+    with _counters_lock:
+        current_counters()[key] += value
+
+
+def carry_counters(function):
+    """Returns a wrapper of function that counts against the step running in
+    the calling thread, for handing work to other threads"""
+    counters = current_counters()
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        saved = getattr(_local, "counters", None)
+        _local.counters = counters
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _local.counters = saved
+
+    return wrapper
+
+
+def _audit(event, args):
+    """Counts subprocesses started by each thread"""
+    if event in SUBPROCESS_EVENTS:
+        _count("subprocesses", 1)
+
+
+def add_audit_hook():
+    """Start counting subprocesses. Audit hooks can't be removed, so this
+    is only done once per process. Python 3.7 has no audit hooks, so
+    subprocesses aren't counted there."""
+    global _audit_hook_added
+    with _audit_hook_lock:
+        if not _audit_hook_added and hasattr(sys, "addaudithook"):
+            sys.addaudithook(_audit)
+            _audit_hook_added = True
+
+
+def add_network_bytes(count):
+    """Called by the URL transports with the number of bytes received, so
+    they're counted against the step running in this thread"""
+    _count("network_bytes", count)
+
+
+# struct rusage_info_v2 from <sys/resource.h> on macOS, up to the disk I/O
+# byte counts
+RUSAGE_INFO_V2_FIELDS = (
+    "ri_user_time",
+    "ri_system_time",
+    "ri_pkg_idle_wkups",
+    "ri_interrupt_wkups",
+    "ri_pageins",
+    "ri_wired_size",
+    "ri_resident_size",
+    "ri_phys_footprint",
+    "ri_proc_start_abstime",
+    "ri_proc_exit_abstime",
+    "ri_child_user_time",
+    "ri_child_system_time",
+    "ri_child_pkg_idle_wkups",
+    "ri_child_interrupt_wkups",
+    "ri_child_pageins",
+    "ri_child_elapsed_abstime",
+    "ri_diskio_bytesread",
+    "ri_diskio_byteswritten",
+)
+
+
+def darwin_disk_io_bytes():
+    """Returns (bytes read, bytes written) from proc_pid_rusage(). ctypes is
+    imported here as it's slow to import and only needed on macOS."""
+    global _libproc, _rusage_info_v2
+    import ctypes
+    import ctypes.util
+
+    if _libproc is None:
+        _rusage_info_v2 = type(
+            "RusageInfoV2",
+            (ctypes.Structure,),
+            {
+                "_fields_": [("ri_uuid", ctypes.c_uint8 * 16)]
+                + [(name, ctypes.c_uint64) for name in RUSAGE_INFO_V2_FIELDS]
+            },
+        )
+        _libproc = ctypes.CDLL(ctypes.util.find_library("proc"))
+    info = _rusage_info_v2()
+    if _libproc.proc_pid_rusage(os.getpid(), RUSAGE_INFO_V2, ctypes.byref(info)):
+        return 0, 0
+    return info.ri_diskio_bytesread, info.ri_diskio_byteswritten
+
+
+def disk_io_bytes():
+    """Returns (bytes read, bytes written) from disk by this process so far,
+    or (0, 0) if the platform doesn't say"""
+    if sys.platform == "darwin":
+        try:
+            return darwin_disk_io_bytes()
+        except (OSError, AttributeError):
+            return 0, 0
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["read_bytes"]), int(counters["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def snapshot():
+    """Returns the counters a Measurement takes the difference of"""
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read_bytes, written_bytes = disk_io_bytes()
+    counters = {
+        "wall_time": time.perf_counter(),
+        "cpu_time": time.thread_time() + children.ru_utime + children.ru_stime,
+        "read_bytes": read_bytes,
+        "written_bytes": written_bytes,
+        **current_counters(),
+    }
+    if not _audit_hook_added:
+        del counters["subprocesses"]
+    return counters
+
+
+class Measurement:
+    """Measures the resources used from when it's created to when stop() is
+    called, or over a with block: wall_time and cpu_time in seconds
+    (cpu_time counts this thread and any subprocesses waited for), bytes
+    read from and written to disk, subprocesses started and network bytes
+    received (subprocesses aren't counted on Python 3.7). Also records when
+    it started, and the process and thread it ran in, for trace events.
+    Disk I/O and subprocess CPU time are per process, so they overlap when
+    recipes are run in threads."""
+
+    def __init__(self):
+        add_audit_hook()
+        self.usage = {
+            "started": time.time(),
+            "pid": os.getpid(),
+            "thread": threading.get_ident(),
+        }
+        self.before = snapshot()
+
+    def stop(self):
+        """Returns a dict of the resources used so far"""
+        after = snapshot()
+        for key, value in self.before.items():
+            self.usage[key] = after[key] - value
+        return self.usage
+
+    def __enter__(self):
+        return self.usage
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stop()
+
+
+def trace_event(name, category, usage, args=None):
+    """Returns a Chrome trace event for the usage from a Measurement"""
+    return {
+        "name": name,
+        "cat": category,
+        "ph": "X",
+        "ts": int(usage["started"] * 1000000),
+        "dur": int(usage["wall_time"] * 1000000),
+        "pid": usage["pid"],
+        "tid": usage["thread"],
+        "args": args if args is not None else {},
+    }
+
+
+def recipe_trace_events(recipe_resources):
+    """Returns trace events for recipe runs and their steps. recipe_resources
+    is a list of dicts with the recipe path, the resources its run used and
+    the resources each of its steps used."""
+    events = []
+    for recipe in recipe_resources:
+        events.append(trace_event(recipe["recipe"], "recipe", recipe["resources"]))
+        for step in recipe["steps"]:
+            args = {
+                key: value
+                for key, value in step.items()
+                if key not in ("processor", "started", "pid", "thread", "wall_time")
+            }
+            events.append(trace_event(step["processor"], "processor", step, args))
+    return events
+
+
+def write_trace(path, events):
+    """Write trace events to path in the Chrome trace event JSON format, as
+    loaded by chrome://tracing and Perfetto"""
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
@@ -0,0 +1,307 @@
+#!/usr/local/autopkg/python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Memoization of processor steps: the files and env variables a step
+output, stored by a digest of everything it depends on"""
+
+import contextlib
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import shutil
+import stat
+import subprocess
+import time
+
+from autopkglib import is_mac, log_err
+from autopkglib.digestcache import file_digest
+from autopkglib.downloadstore import link_file
+from autopkglib.fastpath import is_volatile, processor_file
+from autopkglib.runjournal import decode_object, encode_value
+
+INDEX_FILENAME = "index.json"
+MANIFEST_FILENAME = "manifest.json"
+# bump this whenever the format of the index or the manifests changes
+INDEX_VERSION = 1
+DMG_EXTENSIONS = (".dmg", ".iso", ".DMG", ".ISO")
+
+
+def source_paths(value):
+    """Returns the existing paths a processor input names: the path itself,
+    the disk image holding a path inside one, or the matches of a glob.
+    Returns an empty list if it names nothing that exists."""
+    if os.path.lexists(value):
+        return [value]
+    for extension in DMG_EXTENSIONS:
+        dmg_path, dmg, _ = value.partition(extension + "/")
+        if dmg and os.path.isfile(dmg_path + extension):
+            return [dmg_path + extension]
+    return sorted(glob.glob(value))
+
+
+def tree_entries(path):
+    """Yields (relative path, stat info) of path and everything under it,
+    in a stable order, without following symlinks"""
+    yield "", os.lstat(path)
+    if not os.path.isdir(path) or os.path.islink(path):
+        return
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for name in dirnames + sorted(filenames):
+            full_path = os.path.join(dirpath, name)
+            yield os.path.relpath(full_path, path), os.lstat(full_path)
+
+
+def tree_digest(path, cache_dir=None):
+    """Returns a digest of the names, modes, symlink targets and file contents
+    of path and everything under it. File contents come from the digest
+    cache, so unchanged files aren't hashed again."""
+    hasher = hashlib.sha256()
+    for relpath, info in tree_entries(path):
+        full_path = os.path.join(path, relpath) if relpath else path
+        if stat.S_ISLNK(info.st_mode):
+            content = os.readlink(full_path)
+        elif stat.S_ISREG(info.st_mode):
+            content = file_digest(full_path, cache_dir=cache_dir)
+        else:
+            content = ""
+        hasher.update(f"{relpath}\0{info.st_mode:o}\0{content}\0".encode())
+    return hasher.hexdigest()
+
+
+def remove_path(path):
+    """Remove a file, symlink or directory tree if it exists"""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def link_tree(source, destination):
+    """Make destination a copy of the file or directory tree at source
+    without duplicating file data where possible: a directory tree is cloned
+    in one go on APFS when nothing is at destination yet, otherwise each file
+    is cloned or hard linked (see link_file()). Files already at destination
+    are replaced; anything else there is kept."""
+    if is_mac() and os.path.isdir(source) and not os.path.lexists(destination):
+        result = subprocess.run(
+            ["/bin/cp", "-cRp", source, destination], capture_output=True
+        )
+        if result.returncode == 0:
+            return
+        remove_path(destination)
+    for relpath, info in tree_entries(source):
+        source_path = os.path.join(source, relpath) if relpath else source
+        dest_path = os.path.join(destination, relpath) if relpath else destination
+        if stat.S_ISDIR(info.st_mode):
+            if os.path.lexists(dest_path) and not os.path.isdir(dest_path):
+                os.unlink(dest_path)
+            os.makedirs(dest_path, exist_ok=True)
+            os.chmod(dest_path, stat.S_IMODE(info.st_mode))
+            continue
+        remove_path(dest_path)
+        if stat.S_ISLNK(info.st_mode):
+            os.symlink(os.readlink(source_path), dest_path)
+        else:
+            link_file(source_path, dest_path)
+
+
+def tree_manifest(path):
+    """Returns [relative path, size, mtime] of each file under path. A file
+    in the cache that was hard linked out and then changed in place no longer
+    matches its manifest. (Unlike the digest cache this can't use the ctime,
+    which also changes as links to a file are made and removed.)"""
+    return [
+        [relpath, info.st_size, info.st_mtime_ns]
+        for relpath, info in tree_entries(path)
+        if stat.S_ISREG(info.st_mode)
+    ]
+
+
+def step_key(processor, cache_dir=None):
+    """Returns the digest of everything a memoized processor step depends on,
+    or None if an input path doesn't exist, so the step can't be memoized"""
+    paths = {}
+    for value in processor.memo_input_paths():
+        sources = source_paths(value)
+        if not sources:
+            return None
+        paths[value] = [tree_digest(path, cache_dir) for path in sources]
+    data = json.dumps(
+        {
+            "processor": [processor_file(cls) for cls in type(processor).__mro__],
+            "inputs": {key: processor.env.get(key) for key in processor.memo_inputs},
+            "paths": paths,
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class StepCache:
+    """The outputs of memoized processor steps, stored under root/entries by
+    step_key(). An entry holds a copy of each file or directory the step
+    output, cloned or hard linked rather than copied where possible, and the
+    env variables it set. The least recently used entries are evicted once
+    the cache grows beyond max_size bytes."""
+
+    def __init__(self, root, max_size=None):
+        self.root = os.path.expanduser(root)
+        self.max_size = max_size
+        self.index_path = os.path.join(self.root, INDEX_FILENAME)
+
+    def entry_path(self, key):
+        """Returns the directory holding the entry with the given key"""
+        return os.path.join(self.root, "entries", key[:2], key)
+
+    @contextlib.contextmanager
+    def locked_index(self, write=False):
+        """Context manager yielding the index while holding the cache lock,
+        writing it back afterwards if write is True"""
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, ".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            index = {"version": INDEX_VERSION, "entries": {}}
+            try:
+                with open(self.index_path) as f:
+                    data = json.load(f)
+                if data.get("version") == INDEX_VERSION:
+                    index = data
+            except (OSError, ValueError):
+                pass
+            yield index
+            if write:
+                temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+                with open(temp_path, "w") as f:
+                    json.dump(index, f)
+                os.replace(temp_path, self.index_path)
+
+    def read_manifest(self, key):
+        """Returns the manifest of an entry: the paths it restores, the
+        env variables it sets and the files it holds. Returns None if the
+        entry is missing, or its files changed since it was stored."""
+        entry_path = self.entry_path(key)
+        try:
+            with open(os.path.join(entry_path, MANIFEST_FILENAME)) as f:
+                manifest = json.load(f, object_hook=decode_object)
+            for number, _ in enumerate(manifest["paths"]):
+                stored = os.path.join(entry_path, str(number))
+                if tree_manifest(stored) != manifest["files"][number]:
+                    return None
+        except (OSError, ValueError, KeyError, IndexError):
+            return None
+        return manifest
+
+    def restore(self, key, replace=False):
+        """Put the files of an entry back where the step output them, and
+        return the env variables it set, or None if there is no usable entry
+        for key. Directories are merged into what's already there unless
+        replace is True."""
+        # held throughout, so the entry can't be evicted while it's restored
+        with self.locked_index(write=True) as index:
+            if key not in index["entries"]:
+                return None
+            manifest = self.read_manifest(key)
+            if manifest is None:
+                del index["entries"][key]
+                remove_path(self.entry_path(key))
+                return None
+            for number, path in enumerate(manifest["paths"]):
+                stored = os.path.join(self.entry_path(key), str(number))
+                if replace or not os.path.isdir(stored):
+                    remove_path(path)
+                link_tree(stored, path)
+            index["entries"][key]["last_used"] = time.time()
+        return manifest["env"]
+
+    def add(self, key, paths, env):
+        """Store the files or directories at paths and the env variables in
+        env as the outputs of the step with the given key"""
+        entry_path = self.entry_path(key)
+        temp_path = f"{entry_path}.{os.getpid()}.tmp"
+        remove_path(temp_path)
+        os.makedirs(temp_path)
+        try:
+            manifest = {"paths": paths, "env": env, "files": []}
+            for number, path in enumerate(paths):
+                stored = os.path.join(temp_path, str(number))
+                link_tree(path, stored)
+                manifest["files"].append(tree_manifest(stored))
+            with open(os.path.join(temp_path, MANIFEST_FILENAME), "w") as f:
+                json.dump(manifest, f, default=encode_value)
+            size = sum(size for files in manifest["files"] for _, size, _ in files)
+            with self.locked_index(write=True) as index:
+                remove_path(entry_path)
+                os.replace(temp_path, entry_path)
+                index["entries"][key] = {"size": size, "last_used": time.time()}
+                self.evict(index)
+        finally:
+            remove_path(temp_path)
+
+    def evict(self, index):
+        """Remove the least recently used entries until the cache is no
+        bigger than max_size. Must be called with the index locked."""
+        if not self.max_size:
+            return
+        entries = index["entries"]
+        total_size = sum(info["size"] for info in entries.values())
+        for key in sorted(entries, key=lambda key: entries[key]["last_used"]):
+            if total_size <= self.max_size:
+                break
+            try:
+                remove_path(self.entry_path(key))
+            except OSError as err:
+                log_err(f"WARNING: Can't evict {key} from step cache: {err}")
+                continue
+            total_size -= entries.pop(key)["size"]
+
+
+def run_memoized(processor, cache):
+    """Run a processor's main(), or restore its outputs from cache if it ran
+    before with the same inputs"""
+    cache_dir = processor.env.get("CACHE_DIR")
+    key = step_key(processor, cache_dir)
+    if key is None:
+        processor.main()
+        return
+    try:
+        env = cache.restore(key, replace=processor.memo_replace_outputs())
+    except OSError as err:
+        log_err(f"WARNING: Can't restore from step cache: {err}")
+        env = None
+    if env is not None:
+        processor.env.update(env)
+        processor.output("Restored the outputs of an identical earlier run")
+        return
+    processor.main()
+    paths = [
+        os.path.abspath(path)
+        for path in processor.memo_output_paths()
+        if os.path.lexists(path)
+    ]
+    keys = set(processor.output_variables) | set(processor.memo_output_files)
+    env = {
+        key: processor.env[key]
+        for key in sorted(keys)
+        if key in processor.env and not is_volatile(key)
+    }
+    try:
+        cache.add(key, paths, env)
+    except (OSError, TypeError, ValueError) as err:
+        log_err(
+            f"WARNING: Can't add the outputs of {type(processor).__name__} to "
+            f"step cache: {err}"
+        )
@@ -0,0 +1,814 @@
+#!/usr/local/autopkg/python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""HTTP transports used by URLGetter.
+
+URLGetter and its subclasses describe every request as a curl command line.
+The curl transport runs that command. The native transport interprets the same
+command line with a pure-Python HTTP/1.1 client that keeps connections alive
+per host, and produces the same stdout/stderr/exit code curl would, so header
+parsing (redirect tracking, ETag/Last-Modified) works unchanged."""
+
+import base64
+import contextlib
+import hashlib
+import http.client
+import locale
+import os
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import zlib
+from urllib.parse import urljoin, urlsplit
+from urllib.request import getproxies, proxy_bypass
+
+from autopkglib.runtrace import add_network_bytes
+
+try:
+    import certifi
+except ImportError:
+    certifi = None
+
+TRANSPORTS = ("curl", "native")
+DEFAULT_TRANSPORT = "curl"
+
+CHUNK_SIZE = 2 ** 16
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+# curl's exit codes for the failures we can report
+CURLE_UNSUPPORTED_PROTOCOL = 1
+CURLE_COULDNT_RESOLVE_HOST = 6
+CURLE_COULDNT_CONNECT = 7
+CURLE_WEIRD_SERVER_REPLY = 8
+CURLE_HTTP_RETURNED_ERROR = 22
+CURLE_WRITE_ERROR = 23
+CURLE_OPERATION_TIMEDOUT = 28
+CURLE_RANGE_ERROR = 33
+CURLE_SSL_CONNECT_ERROR = 35
+CURLE_TOO_MANY_REDIRECTS = 47
+CURLE_RECV_ERROR = 56
+CURLE_PEER_FAILED_VERIFICATION = 60
+
+# curl options we understand, mapped to the attribute they set
+FLAG_OPTIONS = {
+    "--compressed": "compressed",
+    "--location": "location",
+    "-L": "location",
+    "--silent": None,
+    "-s": None,
+    "--show-error": None,
+    "-S": None,
+    "--no-buffer": None,
+    "-N": None,
+    "--globoff": None,
+    "-g": None,
+    "--fail": "fail",
+    "-f": "fail",
+    "--head": "head",
+    "-I": "head",
+    "--insecure": "insecure",
+    "-k": "insecure",
+}
+VALUE_OPTIONS = {
+    "--header": "header",
+    "-H": "header",
+    "--dump-header": "dump_header",
+    "-D": "dump_header",
+    "--speed-time": "speed_time",
+    "-y": "speed_time",
+    "--speed-limit": None,
+    "-Y": None,
+    "--url": "url",
+    "--output": "output",
+    "-o": "output",
+    "--request": "method",
+    "-X": "method",
+    "--data": "data",
+    "-d": "data",
+    "--data-raw": "data_raw",
+    "--data-binary": "data",
+    "--user-agent": "user_agent",
+    "-A": "user_agent",
+    "--referer": "referer",
+    "-e": "referer",
+    "--cookie": "cookie",
+    "-b": "cookie",
+    "--max-time": "max_time",
+    "-m": "max_time",
+    "--connect-timeout": "connect_timeout",
+    "--max-redirs": "max_redirs",
+    "--user": "user",
+    "-u": "user",
+    "--range": "range",
+    "-r": "range",
+    "--retry": "retry",
+    "--retry-delay": "retry_delay",
+    "--continue-at": "continue_at",
+    "-C": "continue_at",
+}
+
+
+class UnsupportedCurlCommand(Exception):
+    """The native transport can't faithfully run this curl command"""
+
+    pass
+
+
+class CurlRequest:
+    """A request described by a curl command line."""
+
+    def __init__(self):
+        self.url = None
+        self.method = None
+        self.headers = []
+        self.data = []
+        self.output = None
+        self.dump_header = None
+        self.compressed = False
+        self.location = False
+        self.fail = False
+        self.head = False
+        self.insecure = False
+        self.speed_time = None
+        self.max_time = None
+        self.connect_timeout = None
+        self.max_redirs = 50
+        self.retry = 0
+        self.retry_delay = None
+        self.continue_at = 0
+
+    def set_option(self, attribute, value):
+        """Apply a single curl option to the request"""
+        if attribute == "header":
+            name, sep, header_value = value.partition(":")
+            if not sep:
+                raise UnsupportedCurlCommand(f"Unsupported header form: {value}")
+            self.headers.append((name.strip(), header_value.strip()))
+        elif attribute in ("data", "data_raw"):
+            if attribute == "data" and value.startswith("@"):
+                raise UnsupportedCurlCommand("Reading request data from a file")
+            self.data.append(value)
+        elif attribute == "user_agent":
+            self.headers.append(("User-Agent", value))
+        elif attribute == "referer":
+            self.headers.append(("Referer", value))
+        elif attribute == "cookie":
+            if "=" not in value:
+                raise UnsupportedCurlCommand("Reading cookies from a file")
+            self.headers.append(("Cookie", value))
+        elif attribute == "user":
+            credentials = base64.b64encode(value.encode()).decode()
+            self.headers.append(("Authorization", f"Basic {credentials}"))
+        elif attribute == "range":
+            self.headers.append(("Range", f"bytes={value}"))
+        elif attribute in ("speed_time", "max_time", "connect_timeout", "retry_delay"):
+            setattr(self, attribute, float(value))
+        elif attribute == "continue_at":
+            if value == "-":
+                raise UnsupportedCurlCommand("Resuming from the output file size")
+            self.continue_at = int(value)
+        elif attribute in ("max_redirs", "retry"):
+            setattr(self, attribute, int(value))
+        else:
+            setattr(self, attribute, value)
+
+    def header_names(self):
+        """Returns the lowercased names of the request headers"""
+        return {name.lower() for name, _ in self.headers}
+
+
+def parse_curl_cmd(curl_cmd):
+    """Returns a CurlRequest for a curl command line (a list whose first item
+    is the curl binary). Raises UnsupportedCurlCommand for anything the native
+    transport can't do exactly like curl."""
+    request = CurlRequest()
+    args = list(curl_cmd[1:])
+    while args:
+        arg = args.pop(0)
+        if arg in FLAG_OPTIONS:
+            if FLAG_OPTIONS[arg]:
+                setattr(request, FLAG_OPTIONS[arg], True)
+        elif arg in VALUE_OPTIONS:
+            if not args:
+                raise UnsupportedCurlCommand(f"Missing value for {arg}")
+            value = args.pop(0)
+            if VALUE_OPTIONS[arg]:
+                request.set_option(VALUE_OPTIONS[arg], value)
+        elif arg.startswith("-") and not arg.startswith("--") and len(arg) > 2:
+            # a cluster of short flags (-sSL) or a short option with its
+            # value attached (-HAccept: */*)
+            if f"-{arg[1]}" in VALUE_OPTIONS:
+                args.insert(0, arg[2:])
+                args.insert(0, f"-{arg[1]}")
+            elif all(f"-{flag}" in FLAG_OPTIONS for flag in arg[1:]):
+                args[0:0] = [f"-{flag}" for flag in arg[1:]]
+            else:
+                raise UnsupportedCurlCommand(f"Unsupported curl option {arg}")
+        elif arg.startswith("-"):
+            raise UnsupportedCurlCommand(f"Unsupported curl option {arg}")
+        elif request.url is None:
+            request.url = arg
+        else:
+            raise UnsupportedCurlCommand("More than one URL")
+    if not request.url:
+        raise UnsupportedCurlCommand("No URL")
+    scheme = urlsplit(request.url).scheme.lower()
+    if scheme not in ("http", "https"):
+        raise UnsupportedCurlCommand(f"Unsupported protocol {scheme or 'none'}")
+    if request.dump_header not in (None, "-"):
+        raise UnsupportedCurlCommand("Dumping headers to a file")
+    if request.head and request.output:
+        raise UnsupportedCurlCommand("Writing --head headers to a file")
+    if request.method is None:
+        if request.head:
+            request.method = "HEAD"
+        elif request.data:
+            request.method = "POST"
+        else:
+            request.method = "GET"
+    return request
+
+
+def uses_proxy(url):
+    """Returns True if curl would send a request for url through a proxy
+    configured in the environment"""
+    parts = urlsplit(url)
+    proxies = getproxies()
+    if not (proxies.get(parts.scheme) or proxies.get("all")):
+        return False
+    return not proxy_bypass(parts.hostname or "")
+
+
+class CurlError(Exception):
+    """A failure reported the way curl would report it"""
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class ConnectionPool:
+    """Keeps idle HTTP/1.1 connections around per (scheme, host, port) so
+    requests to the same host reuse a TCP (and TLS) connection."""
+
+    def __init__(self, max_idle_per_host=6):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.connections_opened = 0
+        self.ssl_contexts = {}
+
+    def ssl_context(self, insecure):
+        """Returns a (cached) SSL context"""
+        if insecure not in self.ssl_contexts:
+            if insecure:
+                context = ssl._create_unverified_context()
+            elif certifi:
+                context = ssl.create_default_context(cafile=certifi.where())
+            else:
+                context = ssl.create_default_context()
+            self.ssl_contexts[insecure] = context
+        return self.ssl_contexts[insecure]
+
+    def get(self, scheme, host, port, insecure, timeout):
+        """Returns (connection, reused) for a host, preferring an idle one"""
+        key = (scheme, host, port, insecure)
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                connection = idle.pop()
+                connection.timeout = timeout
+                if connection.sock:
+                    connection.sock.settimeout(timeout)
+                return connection, True
+            self.connections_opened += 1
+        if scheme == "https":
+            connection = http.client.HTTPSConnection(
+                host, port, timeout=timeout, context=self.ssl_context(insecure)
+            )
+        else:
+            connection = http.client.HTTPConnection(host, port, timeout=timeout)
+        return connection, False
+
+    def put(self, scheme, host, port, insecure, connection):
+        """Return a connection to the pool once its response has been read"""
+        key = (scheme, host, port, insecure)
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        """Close all idle connections"""
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle = {}
+
+
+class ContentDecoder:
+    """Undoes gzip/deflate Content-Encoding for --compressed requests"""
+
+    def __init__(self, encoding):
+        self.decompressor = None
+        if encoding == "gzip":
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            self.decompressor = zlib.decompressobj()
+        self.first_chunk = True
+
+    def decode(self, chunk):
+        """Decode a chunk of the body"""
+        if not self.decompressor:
+            return chunk
+        if self.first_chunk and self.decompressor.unused_data == b"":
+            self.first_chunk = False
+            try:
+                return self.decompressor.decompress(chunk)
+            except zlib.error:
+                # some servers send raw deflate streams without a zlib header
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self.decompressor.decompress(chunk)
+
+    def flush(self):
+        """Return any remaining decoded data"""
+        if not self.decompressor:
+            return b""
+        return self.decompressor.flush()
+
+
+def decode_output(data):
+    """Decode output the way subprocess text mode does, with universal
+    newlines"""
+    decoded = data.decode(locale.getpreferredencoding(False), errors="replace")
+    return decoded.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def format_response_headers(response):
+    """Return the status line and headers of a response the way curl dumps
+    them"""
+    version = "HTTP/1.0" if response.version == 10 else "HTTP/1.1"
+    lines = [f"{version} {response.status} {response.reason}"]
+    lines.extend(f"{name}: {value}" for name, value in response.msg.items())
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("iso-8859-1")
+
+
+class NativeTransport:
+    """Runs curl command lines with a pooled pure-Python HTTP/1.1 client."""
+
+    name = "native"
+
+    def __init__(self, pool=None):
+        self.pool = pool or ConnectionPool()
+
+    def execute(self, curl_cmd, text=True, digests=None):
+        """Run a curl command line. Returns (stdout, stderr, returncode), like
+        running the curl binary would. Raises UnsupportedCurlCommand if the
+        command should be run by curl instead.
+
+        If digests is a dict, its keys are hashlib algorithm names; their
+        values are set to the hex digests of the body written to --output."""
+        request = parse_curl_cmd(curl_cmd)
+        if uses_proxy(request.url):
+            raise UnsupportedCurlCommand("Proxy configured in the environment")
+        stdout = bytearray()
+        stderr = ""
+        returncode = 0
+        attempts = request.retry + 1
+        for attempt in range(attempts):
+            del stdout[:]
+            hashers = {name: hashlib.new(name) for name in digests or ()}
+            try:
+                if self.perform(request, stdout, list(hashers.values())):
+                    for name, hasher in hashers.items():
+                        digests[name] = hasher.hexdigest()
+                returncode = 0
+                stderr = ""
+                break
+            except CurlError as err:
+                returncode = err.code
+                stderr = f"curl: ({err.code}) {err.message}\n"
+                retryable = err.code in (
+                    CURLE_COULDNT_CONNECT,
+                    CURLE_OPERATION_TIMEDOUT,
+                    CURLE_RECV_ERROR,
+                )
+                if not retryable or attempt + 1 == attempts:
+                    break
+                time.sleep(request.retry_delay or 2 ** attempt)
+        if text:
+            return decode_output(bytes(stdout)), stderr, returncode
+        return bytes(stdout), stderr.encode(), returncode
+
+    def perform(self, request, stdout, hashers=()):
+        """Perform the request, following redirects if asked to, writing
+        headers and/or body where curl would write them. Returns True if a
+        body was written to --output."""
+        url = request.url
+        method = request.method
+        headers = list(request.headers)
+        body = "&".join(request.data).encode() if request.data else None
+        if body is not None and "content-type" not in request.header_names():
+            headers.append(("Content-Type", "application/x-www-form-urlencoded"))
+        if request.continue_at:
+            headers.append(("Range", f"bytes={request.continue_at}-"))
+        if request.compressed and "accept-encoding" not in request.header_names():
+            headers.append(("Accept-Encoding", "deflate, gzip"))
+        deadline = time.monotonic() + request.max_time if request.max_time else None
+        redirects = 0
+        while True:
+            response, connection, key = self.send(
+                url, method, headers, body, request, deadline
+            )
+            header_block = format_response_headers(response)
+            if request.head and request.dump_header == "-":
+                # curl writes --head headers as the body too, a line at a time
+                for line in header_block.splitlines(keepends=True):
+                    stdout.extend(line + line)
+            elif request.head or request.dump_header == "-":
+                stdout.extend(header_block)
+            location = response.getheader("location")
+            if request.location and response.status in REDIRECT_CODES and location:
+                self.discard(response, connection, key)
+                redirects += 1
+                if redirects > request.max_redirs:
+                    raise CurlError(
+                        CURLE_TOO_MANY_REDIRECTS,
+                        f"Maximum ({request.max_redirs}) redirects followed",
+                    )
+                new_url = urljoin(url, location)
+                if urlsplit(new_url).scheme.lower() not in ("http", "https"):
+                    raise CurlError(
+                        CURLE_UNSUPPORTED_PROTOCOL,
+                        f"Protocol not supported for redirect to {new_url}",
+                    )
+                if urlsplit(new_url).netloc != urlsplit(url).netloc:
+                    # like curl, don't leak credentials to another host
+                    headers = [
+                        (name, value)
+                        for name, value in headers
+                        if name.lower() not in ("authorization", "cookie")
+                    ]
+                if response.status == 303 and method not in ("GET", "HEAD"):
+                    method = "GET"
+                    body = None
+                url = new_url
+                continue
+            break
+        if request.fail and response.status >= 400:
+            self.discard(response, connection, key)
+            raise CurlError(
+                CURLE_HTTP_RETURNED_ERROR,
+                f"The requested URL returned error: {response.status}",
+            )
+        return self.write_body(
+            request, response, connection, key, stdout, deadline, hashers
+        )
+
+    def send(self, url, method, headers, body, request, deadline):
+        """Send one request and return (response, connection, pool key),
+        retrying once on a fresh connection if a reused one went stale"""
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        host = parts.hostname
+        port = parts.port or (443 if scheme == "https" else 80)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        timeout = request.speed_time or request.connect_timeout or 300
+        if deadline:
+            timeout = min(timeout, max(deadline - time.monotonic(), 0.001))
+        key = (scheme, host, port, request.insecure)
+        request_headers = {}
+        for name, value in headers:
+            request_headers[name] = value
+        if "user-agent" not in {name.lower() for name in request_headers}:
+            request_headers["User-Agent"] = "curl"
+        if "accept" not in {name.lower() for name in request_headers}:
+            request_headers["Accept"] = "*/*"
+        for attempt in range(2):
+            connection, reused = self.pool.get(
+                scheme, host, port, request.insecure, timeout
+            )
+            try:
+                connection.request(method, path, body=body, headers=request_headers)
+                response = connection.getresponse()
+                return response, connection, key
+            except (
+                http.client.RemoteDisconnected,
+                BrokenPipeError,
+                ConnectionResetError,
+            ) as err:
+                connection.close()
+                if reused and attempt == 0:
+                    continue
+                raise CurlError(CURLE_RECV_ERROR, f"Failure when receiving data: {err}")
+            except socket.gaierror:
+                connection.close()
+                raise CurlError(
+                    CURLE_COULDNT_RESOLVE_HOST, f"Could not resolve host: {host}"
+                )
+            except socket.timeout:
+                connection.close()
+                raise CurlError(CURLE_OPERATION_TIMEDOUT, "Operation timed out")
+            except ssl.SSLCertVerificationError as err:
+                connection.close()
+                raise CurlError(
+                    CURLE_PEER_FAILED_VERIFICATION,
+                    f"SSL certificate problem: {err.verify_message}",
+                )
+            except ssl.SSLError as err:
+                connection.close()
+                raise CurlError(CURLE_SSL_CONNECT_ERROR, f"SSL connect error: {err}")
+            except http.client.HTTPException as err:
+                connection.close()
+                raise CurlError(CURLE_WEIRD_SERVER_REPLY, f"Weird server reply: {err}")
+            except OSError as err:
+                connection.close()
+                raise CurlError(
+                    CURLE_COULDNT_CONNECT,
+                    f"Failed to connect to {host} port {port}: {err.strerror}",
+                )
+
+    def discard(self, response, connection, key):
+        """Read and drop a response body so the connection can be reused"""
+        try:
+            while response.read(CHUNK_SIZE):
+                pass
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            return
+        self.release(response, connection, key)
+
+    def release(self, response, connection, key):
+        """Put a connection back in the pool, or close it if the server
+        won't keep it open"""
+        if response.will_close:
+            connection.close()
+        else:
+            self.pool.put(*key, connection)
+
+    def write_body(
+        self, request, response, connection, key, stdout, deadline, hashers=()
+    ):
+        """Stream the body of the final response to --output or stdout,
+        feeding what goes to --output to hashers on the way. Returns True if
+        a body was written to --output."""
+        if request.method == "HEAD" or response.status == 304:
+            self.discard(response, connection, key)
+            return False
+        mode = "wb"
+        if request.continue_at:
+            if response.status == 416:
+                # curl takes this to mean the output is already complete
+                self.discard(response, connection, key)
+                return False
+            if 200 <= response.status < 300 and response.status != 206:
+                self.discard(response, connection, key)
+                raise CurlError(
+                    CURLE_RANGE_ERROR,
+                    "HTTP server doesn't seem to support byte ranges. Cannot resume.",
+                )
+            mode = "ab"
+        decoder = ContentDecoder(
+            response.getheader("content-encoding", "").lower()
+            if request.compressed
+            else ""
+        )
+        output_file = None
+        try:
+            if request.output:
+                try:
+                    if mode == "ab":
+                        prime_hashers(hashers, request.output)
+                    output_file = open(request.output, mode)
+                except OSError as err:
+                    self.discard(response, connection, key)
+                    raise CurlError(
+                        CURLE_WRITE_ERROR, f"Failed writing body: {err.strerror}"
+                    )
+            if output_file:
+
+                def write(data):
+                    output_file.write(data)
+                    for hasher in hashers:
+                        hasher.update(data)
+
+            else:
+                write = stdout.extend
+            while True:
+                if deadline and time.monotonic() > deadline:
+                    connection.close()
+                    raise CurlError(CURLE_OPERATION_TIMEDOUT, "Operation timed out")
+                try:
+                    chunk = response.read(CHUNK_SIZE)
+                except socket.timeout:
+                    connection.close()
+                    raise CurlError(CURLE_OPERATION_TIMEDOUT, "Operation timed out")
+                except (OSError, http.client.HTTPException) as err:
+                    connection.close()
+                    raise CurlError(
+                        CURLE_RECV_ERROR, f"Failure when receiving data: {err}"
+                    )
+                if not chunk:
+                    break
+                add_network_bytes(len(chunk))
+                write(decoder.decode(chunk))
+            write(decoder.flush())
+        except zlib.error as err:
+            connection.close()
+            raise CurlError(61, f"Error while processing content unencoding: {err}")
+        finally:
+            if output_file:
+                output_file.close()
+        self.release(response, connection, key)
+        return output_file is not None
+
+
+class CurlTransport:
+    """Runs curl command lines with the curl binary."""
+
+    name = "curl"
+
+    def execute(self, curl_cmd, text=True, digests=None):
+        """Run a curl command line. Returns (stdout, stderr, returncode).
+        Raises subprocess.CalledProcessError if curl fails.
+
+        If digests is a dict, its keys are hashlib algorithm names; their
+        values are set to the hex digests of the body written to --output."""
+        output_index = output_option_index(curl_cmd)
+        if digests and output_index is not None:
+            return self.execute_hashing(curl_cmd, text, digests, output_index)
+        output_path = curl_cmd[output_index + 1] if output_index is not None else None
+        output_size = file_size(output_path)
+        result = subprocess.run(
+            curl_cmd, shell=False, bufsize=1, capture_output=True, check=True, text=text
+        )
+        if output_path:
+            add_network_bytes(max(file_size(output_path) - output_size, 0))
+        else:
+            add_network_bytes(len(result.stdout))
+        return result.stdout, result.stderr, result.returncode
+
+    def execute_hashing(self, curl_cmd, text, digests, output_index):
+        """Run curl with the body sent to a pipe instead of the --output file,
+        writing it to that file and hashing it as it arrives. Headers dumped
+        to stdout are redirected through a temporary file so they're returned
+        the same as without hashing."""
+        output_path = curl_cmd[output_index + 1]
+        args = list(curl_cmd)
+        args[output_index + 1] = "-"
+        hashers = {name: hashlib.new(name) for name in digests}
+        # with --continue-at, curl appends to the output file
+        resuming = any(arg in ("--continue-at", "-C") for arg in args)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            header_path = os.path.join(tmp_dir, "headers")
+            for index, arg in enumerate(args[:-1]):
+                if arg in ("--dump-header", "-D") and args[index + 1] == "-":
+                    args[index + 1] = header_path
+            with open(os.path.join(tmp_dir, "stderr"), "w+b") as stderr_file:
+                process = subprocess.Popen(
+                    args, stdout=subprocess.PIPE, stderr=stderr_file
+                )
+                output_file = None
+                try:
+                    for chunk in iter(lambda: process.stdout.read(CHUNK_SIZE), b""):
+                        if output_file is None:
+                            # like curl, only create the file once data arrives
+                            if resuming:
+                                prime_hashers(hashers.values(), output_path)
+                            output_file = open(output_path, "ab" if resuming else "wb")
+                        add_network_bytes(len(chunk))
+                        output_file.write(chunk)
+                        for hasher in hashers.values():
+                            hasher.update(chunk)
+                finally:
+                    if output_file:
+                        output_file.close()
+                    process.stdout.close()
+                    returncode = process.wait()
+                stderr_file.seek(0)
+                stderr = stderr_file.read()
+            stdout = b""
+            if os.path.exists(header_path):
+                with open(header_path, "rb") as f:
+                    stdout = f.read()
+        if text:
+            stdout = decode_output(stdout)
+            stderr = decode_output(stderr)
+        if returncode:
+            raise subprocess.CalledProcessError(
+                returncode, curl_cmd, output=stdout, stderr=stderr
+            )
+        if output_file:
+            for name, hasher in hashers.items():
+                digests[name] = hasher.hexdigest()
+        return stdout, stderr, returncode
+
+
+def prime_hashers(hashers, path):
+    """Feed the existing contents of a file being resumed to hashers"""
+    if not hashers or not os.path.exists(path):
+        return
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b""):
+            for hasher in hashers:
+                hasher.update(chunk)
+
+
+def file_size(path):
+    """Returns the size of the file at path, or 0 if there isn't one"""
+    try:
+        return os.path.getsize(path) if path else 0
+    except OSError:
+        return 0
+
+
+def output_option_index(curl_cmd):
+    """Returns the index of the --output option in a curl command line, or
+    None"""
+    for index, arg in enumerate(curl_cmd[:-1]):
+        if arg in ("--output", "-o"):
+            return index
+    return None
+
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+def get_transport(name):
+    """Returns the process-wide transport with the given name. The native
+    transport is shared so its connections are reused across processors and
+    recipes."""
+    if name not in TRANSPORTS:
+        raise ValueError(f"Unknown URL transport '{name}'")
+    with _transports_lock:
+        if name not in _transports:
+            _transports[name] = (
+                NativeTransport() if name == "native" else CurlTransport()
+            )
+        return _transports[name]
+
+
+def request_host(curl_cmd):
+    """Returns the host a curl command line requests, or None"""
+    try:
+        url = parse_curl_cmd(curl_cmd).url
+    except UnsupportedCurlCommand:
+        urls = [arg for arg in curl_cmd[1:] if "://" in arg]
+        url = urls[-1] if urls else ""
+    return urlsplit(url).hostname
+
+
+class HostLimiter:
+    """Caps the number of requests in flight to any one host."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def hold(self, host):
+        """Context manager that waits for a free slot for host"""
+        with self.lock:
+            semaphore = self.semaphores.setdefault(
+                host, threading.BoundedSemaphore(self.limit)
+            )
+        with semaphore:
+            yield
+
+
+_host_limiter = None
+
+
+def set_host_limit(limit):
+    """Cap the number of concurrent requests per host for this process. A
+    limit of None removes the cap."""
+    global _host_limiter
+    _host_limiter = HostLimiter(limit) if limit else None
+
+
+def host_slot(curl_cmd):
+    """Returns a context manager to hold around running curl_cmd, which waits
+    while the per-host limit (if any) is reached"""
+    if _host_limiter is None:
+        return contextlib.nullcontext()
+    return _host_limiter.hold(request_host(curl_cmd))
@@ -0,0 +1,155 @@
+#!/usr/local/autopkg/python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Cache of recipe overrides that passed trust verification, and the files
+they were verified against"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from autopkglib import log_err
+from autopkglib.gitinfo import find_toplevel
+from autopkglib.recipeindex import git_head
+
+CACHE_FILENAME = "trust_cache.sqlite"
+AUDIT_LOG_FILENAME = "trust_audit.log"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS verified (
+    override_path TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    verified_at REAL NOT NULL
+)
+"""
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def file_fingerprint(path):
+    """Returns what identifies a version of the file at path: its path, size,
+    mtime, ctime and the HEAD of the git working copy it's in. Missing files
+    have only a path."""
+    try:
+        info = os.stat(path)
+    except OSError:
+        return [path]
+    toplevel = find_toplevel(path)
+    return [
+        path,
+        info.st_size,
+        info.st_mtime_ns,
+        info.st_ctime_ns,
+        git_head(toplevel) if toplevel else None,
+    ]
+
+
+def fingerprint(paths, context):
+    """Returns a digest of the fingerprints of the files at paths, and of
+    context, which must be JSON serializable"""
+    data = json.dumps(
+        {"files": [file_fingerprint(path) for path in paths], "context": context},
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class TrustCache:
+    """Overrides that passed trust verification, by the fingerprint of what
+    they were verified against. Every lookup and verification is appended to
+    an audit log. Safe to share between threads."""
+
+    def __init__(self, path, audit_log_path):
+        self.path = path
+        self.audit_log_path = audit_log_path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.db:
+            self.db.execute(SCHEMA)
+
+    def close(self):
+        """Close the database connection"""
+        self.db.close()
+
+    def audit(self, event, override_path, override_fingerprint):
+        """Append a line to the audit log: the time, event, override path and
+        fingerprint, separated by tabs"""
+        timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        line = f"{timestamp}\t{event}\t{override_path}\t{override_fingerprint}\n"
+        try:
+            with open(self.audit_log_path, "a") as f:
+                f.write(line)
+        except OSError as err:
+            log_err(f"WARNING: Can't write {self.audit_log_path}: {err}")
+
+    def is_verified(self, override_path, override_fingerprint):
+        """True if override_path passed verification with this fingerprint"""
+        try:
+            with self.lock:
+                row = self.db.execute(
+                    "SELECT fingerprint FROM verified WHERE override_path = ?",
+                    (override_path,),
+                ).fetchone()
+        except sqlite3.Error as err:
+            log_err(f"WARNING: Trust cache error: {err}")
+            row = None
+        if row and row[0] == override_fingerprint:
+            self.audit("cache-hit", override_path, override_fingerprint)
+            return True
+        self.audit("cache-miss", override_path, override_fingerprint)
+        return False
+
+    def record(self, override_path, override_fingerprint, passed):
+        """Record the result of a full verification of override_path"""
+        try:
+            with self.lock, self.db:
+                if passed:
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO verified VALUES (?, ?, ?)",
+                        (override_path, override_fingerprint, time.time()),
+                    )
+                else:
+                    self.db.execute(
+                        "DELETE FROM verified WHERE override_path = ?",
+                        (override_path,),
+                    )
+        except sqlite3.Error as err:
+            log_err(f"WARNING: Trust cache error: {err}")
+        self.audit(
+            "verified" if passed else "failed", override_path, override_fingerprint
+        )
+
+
+def get_trust_cache(cache_dir=None):
+    """Returns this process's TrustCache kept in cache_dir (defaults to
+    ~/Library/AutoPkg/Cache), or None if it can't be opened"""
+    cache_dir = os.path.expanduser(cache_dir or "~/Library/AutoPkg/Cache")
+    # SQLite connections can't be shared with forked worker processes
+    key = (cache_dir, os.getpid())
+    with _caches_lock:
+        if key not in _caches:
+            try:
+                _caches[key] = TrustCache(
+                    os.path.join(cache_dir, CACHE_FILENAME),
+                    os.path.join(cache_dir, AUDIT_LOG_FILENAME),
+                )
+            except (OSError, sqlite3.Error) as err:
+                log_err(f"WARNING: Can't open trust cache in {cache_dir}: {err}")
+                _caches[key] = None
+        return _caches[key]
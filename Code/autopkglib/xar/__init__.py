@@ -0,0 +1,267 @@
+#!/usr/local/autopkg/python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Reader for xar archives, the container format of flat packages"""
+
+import bz2
+import hashlib
+import lzma
+import os
+import re
+import struct
+import xml.etree.ElementTree as ET
+import zlib
+
+XAR_MAGIC = b"xar!"
+# magic, header size, version, compressed and uncompressed TOC length,
+# checksum algorithm
+HEADER_FORMAT = ">4sHHQQI"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+CHECKSUM_ALGORITHMS = {0: None, 1: "sha1", 2: "md5"}
+CHUNK_SIZE = 2 ** 20
+
+
+class XarError(Exception):
+    """Raised for archives that can't be read"""
+
+
+def new_decompressor(encoding):
+    """Returns a decompress(data) function for a xar encoding style"""
+    if encoding in (None, "application/octet-stream"):
+        return lambda data: data
+    if encoding == "application/x-gzip":
+        # xar's "gzip" encoding is a plain zlib stream
+        return zlib.decompressobj().decompress
+    if encoding == "application/x-bzip2":
+        return bz2.BZ2Decompressor().decompress
+    if encoding in ("application/x-lzma", "application/x-xz"):
+        return lzma.LZMADecompressor().decompress
+    raise XarError(f"Unsupported xar encoding {encoding}")
+
+
+def new_hasher(style):
+    """Returns a hashlib object for a xar checksum style, or None"""
+    if not style or style == "none":
+        return None
+    try:
+        return hashlib.new(style.lower())
+    except ValueError:
+        raise XarError(f"Unsupported xar checksum {style}")
+
+
+class XarMember:
+    """A file, directory or link in a xar archive, as described by its TOC
+    entry. name is the member's path inside the archive."""
+
+    def __init__(self, element, name):
+        self.name = name
+        self.id = element.get("id")
+        type_element = element.find("type")
+        self.type = type_element.text if type_element is not None else "file"
+        self.link = type_element.get("link") if type_element is not None else None
+        mode = element.findtext("mode")
+        self.mode = int(mode, 8) if mode else None
+        self.link_target = element.findtext("link")
+        data = element.find("data")
+        self.offset = self.length = self.size = 0
+        self.encoding = None
+        self.checksum = self.checksum_style = None
+        if data is not None:
+            self.offset = int(data.findtext("offset", "0"))
+            self.length = int(data.findtext("length", "0"))
+            self.size = int(data.findtext("size", "0"))
+            encoding = data.find("encoding")
+            if encoding is not None:
+                self.encoding = encoding.get("style")
+            checksum = data.find("extracted-checksum")
+            if checksum is not None:
+                self.checksum = checksum.text.strip().lower()
+                self.checksum_style = checksum.get("style")
+
+    def isdir(self):
+        """True if the member is a directory"""
+        return self.type == "directory"
+
+    def issym(self):
+        """True if the member is a symbolic link"""
+        return self.type == "symlink"
+
+    def __repr__(self):
+        return f"<XarMember {self.name} ({self.type})>"
+
+
+class XarArchive:
+    """A xar archive opened for reading. Only the table of contents is read
+    up front; members are read from the heap on demand, so inspecting a
+    package's PackageInfo or Distribution doesn't touch its payload.
+
+    with XarArchive("Foo.pkg") as archive:
+        distribution = archive.read("Distribution")
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        try:
+            self.members = self.read_toc()
+        except (OSError, struct.error, zlib.error, ET.ParseError, ValueError) as err:
+            self.file.close()
+            raise XarError(f"{path} is not a valid xar archive: {err}")
+        except XarError:
+            self.file.close()
+            raise
+        self.by_name = {member.name: member for member in self.members}
+        self.by_id = {member.id: member for member in self.members}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the archive file"""
+        self.file.close()
+
+    def read_toc(self):
+        """Read the header and TOC. Returns the list of members."""
+        header = self.file.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE:
+            raise XarError(f"{self.path} is not a xar archive")
+        magic, header_size, _, toc_length, toc_size, algorithm = struct.unpack(
+            HEADER_FORMAT, header
+        )
+        if magic != XAR_MAGIC:
+            raise XarError(f"{self.path} is not a xar archive")
+        # algorithm 3 names the checksum in the rest of the header
+        extra = self.file.read(header_size - HEADER_SIZE)
+        if algorithm == 3:
+            checksum_style = extra.split(b"\0", 1)[0].decode()
+        else:
+            checksum_style = CHECKSUM_ALGORITHMS.get(algorithm)
+        self.file.seek(header_size)
+        compressed_toc = self.file.read(toc_length)
+        self.heap_offset = header_size + toc_length
+        toc = ET.fromstring(zlib.decompress(compressed_toc, bufsize=toc_size))
+        toc = toc.find("toc")
+        if toc is None:
+            raise XarError(f"{self.path} has no table of contents")
+
+        checksum = toc.find("checksum")
+        hasher = new_hasher(checksum_style)
+        if hasher and checksum is not None:
+            hasher.update(compressed_toc)
+            self.file.seek(self.heap_offset + int(checksum.findtext("offset")))
+            expected = self.file.read(int(checksum.findtext("size")))
+            if hasher.digest() != expected:
+                raise XarError(f"{self.path} has a corrupt table of contents")
+
+        members = []
+
+        def add_members(parent, prefix):
+            for element in parent.findall("file"):
+                name = element.findtext("name", "")
+                # never let a member escape the destination when extracted
+                if not name or name in (".", "..") or "/" in name:
+                    raise XarError(f"{self.path} has a bad member name {name!r}")
+                path = f"{prefix}{name}"
+                members.append(XarMember(element, path))
+                add_members(element, f"{path}/")
+
+        add_members(toc, "")
+        return members
+
+    def names(self):
+        """Returns the paths of all members"""
+        return [member.name for member in self.members]
+
+    def getmember(self, name):
+        """Returns the member with the given path. Raises KeyError if there
+        isn't one."""
+        return self.by_name[name]
+
+    def iter_data(self, member, chunk_size=CHUNK_SIZE):
+        """Yields the decompressed contents of a member in chunks, verifying
+        its checksum once it has all been read"""
+        if isinstance(member, str):
+            member = self.getmember(member)
+        if member.type == "hardlink" and member.link != "original":
+            try:
+                member = self.by_id[member.link]
+            except KeyError:
+                raise XarError(f"{member.name} links to a missing member")
+        decompress = new_decompressor(member.encoding)
+        hasher = new_hasher(member.checksum_style) if member.checksum else None
+        position = self.heap_offset + member.offset
+        remaining = member.length
+        while remaining:
+            # seek every time so that members can be streamed side by side
+            self.file.seek(position)
+            data = self.file.read(min(chunk_size, remaining))
+            position += len(data)
+            if not data:
+                raise XarError(f"{self.path} is truncated reading {member.name}")
+            remaining -= len(data)
+            try:
+                data = decompress(data)
+            except (OSError, EOFError, zlib.error, lzma.LZMAError) as err:
+                raise XarError(f"Can't decompress {member.name}: {err}")
+            if hasher:
+                hasher.update(data)
+            yield data
+        if hasher and hasher.hexdigest() != member.checksum:
+            raise XarError(f"Checksum mismatch for {member.name} in {self.path}")
+
+    def read(self, member):
+        """Returns the decompressed contents of a member"""
+        return b"".join(self.iter_data(member))
+
+    def extract(self, member, destination, set_dir_mode=True):
+        """Extract one member into the destination directory"""
+        if isinstance(member, str):
+            member = self.getmember(member)
+        path = os.path.join(destination, member.name)
+        if member.isdir():
+            os.makedirs(path, exist_ok=True)
+            if not set_dir_mode:
+                return
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.lexists(path):
+                os.unlink(path)
+            if member.issym():
+                os.symlink(member.link_target, path)
+                return
+            if member.type not in ("file", "hardlink"):
+                # devices and fifos have no place in a package
+                return
+            with open(path, "wb") as f:
+                for data in self.iter_data(member):
+                    f.write(data)
+        if member.mode is not None:
+            os.chmod(path, member.mode)
+
+    def extractall(self, destination, exclude=None):
+        """Extract every member into the destination directory. exclude is an
+        optional regular expression; members whose path matches it are skipped,
+        like xar's --exclude option."""
+        directories = []
+        for member in self.members:
+            if exclude and re.search(exclude, member.name):
+                continue
+            self.extract(member, destination, set_dir_mode=False)
+            if member.isdir() and member.mode is not None:
+                directories.append(member)
+        # set directory modes last, in case they aren't writable
+        for member in reversed(directories):
+            os.chmod(os.path.join(destination, member.name), member.mode)
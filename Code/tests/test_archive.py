@@ -0,0 +1,129 @@
+#!/usr/local/autopkg/python
+
+import io
+import os
+import stat
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+from autopkglib.archive import ArchiveError, detect_format, extract
+
+BINARY = os.urandom(300000)
+
+
+class TestArchive(unittest.TestCase):
+    """Test class for in-process archive extraction."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.destination = os.path.join(self.tmp_dir.name, "unpacked")
+        os.mkdir(self.destination)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def make_zip(self, name):
+        """Write a zip like ditto -c -k makes of an app bundle."""
+        path = os.path.join(self.tmp_dir.name, name)
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zip_file:
+            for member in ("Foo.app/", "Foo.app/Contents/"):
+                info = zipfile.ZipInfo(member)
+                info.external_attr = (stat.S_IFDIR | 0o755) << 16
+                info.create_system = 3
+                zip_file.writestr(info, b"")
+            for index in range(8):
+                info = zipfile.ZipInfo(f"Foo.app/Contents/MacOS/foo{index}")
+                info.external_attr = (stat.S_IFREG | 0o755) << 16
+                info.create_system = 3
+                zip_file.writestr(info, BINARY, zipfile.ZIP_DEFLATED)
+            info = zipfile.ZipInfo("Foo.app/Contents/Current")
+            info.external_attr = (stat.S_IFLNK | 0o755) << 16
+            info.create_system = 3
+            zip_file.writestr(info, b"MacOS")
+            zip_file.writestr("__MACOSX/Foo.app/._Contents", b"metadata")
+        return path
+
+    def make_tar(self, name, mode):
+        """Write a tar archive with a file and a symlink."""
+        path = os.path.join(self.tmp_dir.name, name)
+        with tarfile.open(path, mode) as tar:
+            info = tarfile.TarInfo("foo/bin/tool")
+            info.size = len(BINARY)
+            info.mode = 0o755
+            tar.addfile(info, io.BytesIO(BINARY))
+            info = tarfile.TarInfo("foo/tool")
+            info.type = tarfile.SYMTYPE
+            info.linkname = "bin/tool"
+            tar.addfile(info)
+        return path
+
+    def test_detect_format_from_contents(self):
+        """Formats should be detected from magic bytes, not extensions."""
+        self.assertEqual(detect_format(self.make_zip("archive.bin")), "zip")
+        self.assertEqual(detect_format(self.make_tar("a.bin", "w:gz")), "tar_gzip")
+        self.assertEqual(detect_format(self.make_tar("b.bin", "w:bz2")), "tar_bzip2")
+        self.assertEqual(detect_format(self.make_tar("c.bin", "w:xz")), "tar_xz")
+        self.assertEqual(detect_format(self.make_tar("d.bin", "w")), "tar")
+
+    def test_extract_zip_in_parallel(self):
+        """A zip should be extracted with modes and symlinks restored."""
+        extract(self.make_zip("Foo.zip"), self.destination, workers=4)
+        contents = os.path.join(self.destination, "Foo.app", "Contents")
+        for index in range(8):
+            path = os.path.join(contents, "MacOS", f"foo{index}")
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), BINARY)
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o755)
+        self.assertEqual(os.readlink(os.path.join(contents, "Current")), "MacOS")
+        self.assertFalse(os.path.exists(os.path.join(self.destination, "__MACOSX")))
+
+    def test_extract_tar_xz(self):
+        """A tar.xz should be streamed out with its symlinks."""
+        extract(self.make_tar("foo.tar.xz", "w:xz"), self.destination)
+        with open(os.path.join(self.destination, "foo", "tool"), "rb") as f:
+            self.assertEqual(f.read(), BINARY)
+
+    def test_refuses_paths_outside_destination(self):
+        """Members that would escape the destination should be refused."""
+        path = os.path.join(self.tmp_dir.name, "evil.zip")
+        with zipfile.ZipFile(path, "w") as zip_file:
+            zip_file.writestr("../evil", b"evil")
+        with self.assertRaises(ArchiveError):
+            extract(path, self.destination)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir.name, "evil")))
+
+    def test_refuses_writing_through_symlinks_outside_destination(self):
+        """A symlink out of the destination, and members extracted through
+        it, should be refused."""
+        outside = os.path.join(self.tmp_dir.name, "outside")
+        os.mkdir(outside)
+        path = os.path.join(self.tmp_dir.name, "evil.zip")
+        with zipfile.ZipFile(path, "w") as zip_file:
+            info = zipfile.ZipInfo("link")
+            info.external_attr = (stat.S_IFLNK | 0o755) << 16
+            info.create_system = 3
+            zip_file.writestr(info, outside.encode())
+            zip_file.writestr("link/pwned.txt", b"evil")
+        with self.assertRaises(ArchiveError):
+            extract(path, self.destination)
+        self.assertEqual(os.listdir(outside), [])
+
+        path = os.path.join(self.tmp_dir.name, "evil.tar")
+        with tarfile.open(path, "w") as tar:
+            info = tarfile.TarInfo("link")
+            info.type = tarfile.SYMTYPE
+            info.linkname = "../outside"
+            tar.addfile(info)
+            info = tarfile.TarInfo("link/pwned.txt")
+            info.size = 4
+            tar.addfile(info, io.BytesIO(b"evil"))
+        with self.assertRaises(ArchiveError):
+            extract(path, self.destination)
+        self.assertEqual(os.listdir(outside), [])
+        self.assertFalse(os.path.lexists(os.path.join(self.destination, "link")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,13 +1,18 @@
 #!/usr/local/autopkg/python
 
+import concurrent.futures
 import imp
 import json
 import os
 import plistlib
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import unittest
 from textwrap import dedent
-from unittest.mock import mock_open, patch
+from unittest.mock import Mock, mock_open, patch
 
 # DO NOT MOVE THIS! This needs to happen BEFORE importing autopkglib
 # Annoyingly, I can't figure out how to correctly suppress memoization
@@ -15,6 +20,7 @@ from unittest.mock import mock_open, patch
 # autopkglib.__init__.py to correctly run these tests.
 patch("autopkglib.memoize", lambda x: x).start()
 import autopkglib  # isort:skip
+import autopkglib.recipeindex  # isort:skip
 
 autopkg = imp.load_source("autopkg", os.path.join("Code", "autopkg"))
 
@@ -291,6 +297,548 @@ class TestAutoPkg(unittest.TestCase):
         self.assertEqual(value, "fake_value")
         mock_sav.assert_called()
 
+    @patch("autopkg.get_pref")
+    def test_get_recipe_cache_dir_uses_identifier(self, mock_get_pref):
+        """get_recipe_cache_dir should match AutoPackager's RECIPE_CACHE_DIR."""
+        mock_get_pref.return_value = "/path/to/cache"
+        recipe = plistlib.loads(self.download_recipe.encode("utf-8"))
+        recipe["RECIPE_PATH"] = "/fake/Chrome.recipe"
+        value = autopkg.get_recipe_cache_dir(recipe, {})
+        self.assertEqual(
+            value, "/path/to/cache/com.github.autopkg.download.googlechrome"
+        )
+        value = autopkg.get_recipe_cache_dir(recipe, {"CACHE_DIR": "/other"})
+        self.assertEqual(value, "/other/com.github.autopkg.download.googlechrome")
+        recipe["Input"]["CACHE_DIR"] = "/recipe/cache"
+        value = autopkg.get_recipe_cache_dir(recipe, {})
+        self.assertEqual(
+            value, "/recipe/cache/com.github.autopkg.download.googlechrome"
+        )
+        value = autopkg.get_recipe_cache_dir(recipe, {"CACHE_DIR": "/other"})
+        self.assertEqual(value, "/other/com.github.autopkg.download.googlechrome")
+        del recipe["Input"]["CACHE_DIR"]
+        del recipe["Identifier"]
+        value = autopkg.get_recipe_cache_dir(recipe, {})
+        self.assertEqual(value, "/path/to/cache/-fake-Chrome")
+        recipe["RECIPE_PATH"] = "Chrome.recipe"
+        value = autopkg.get_recipe_cache_dir(recipe, {})
+        self.assertEqual(
+            value,
+            "/path/to/cache/"
+            + "-".join(os.path.join(os.getcwd(), "Chrome").split("/")),
+        )
+
+    def test_run_recipes_in_parallel_keeps_order(self):
+        """Results should be yielded in recipe order, with recipes sharing a
+        cache dir run one after another."""
+        running = []
+        overlaps = []
+        lock = threading.Lock()
+
+        def fake_process_recipe(recipe_path, recipe, *args):
+            cache_dir = autopkg.get_recipe_cache_dir(recipe, {})
+            with lock:
+                if cache_dir in running:
+                    overlaps.append(recipe_path)
+                running.append(cache_dir)
+            # make earlier recipes finish last
+            time.sleep(0.05 * recipe["Input"]["DELAY"])
+            with lock:
+                running.remove(cache_dir)
+            return {"recipe_cache_dir": cache_dir}
+
+        def thread_pool(max_workers, mp_context, initializer, initargs):
+            return concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers, initializer=initializer, initargs=initargs
+            )
+
+        recipe_jobs = []
+        for index, identifier in enumerate(["a", "b", "a", "c", "b", "a"]):
+            recipe_jobs.append(
+                (
+                    f"/fake/{index}.recipe",
+                    {
+                        "Identifier": f"com.example.{identifier}",
+                        "Input": {"CACHE_DIR": "/cache", "DELAY": 6 - index},
+                        "RECIPE_PATH": f"/fake/{index}.recipe",
+                    },
+                )
+            )
+        with patch.object(autopkg, "process_recipe", fake_process_recipe), patch(
+            "autopkg.concurrent.futures.ProcessPoolExecutor", thread_pool
+        ), patch("autopkg.init_recipe_worker"):
+            results = list(
+                autopkg.run_recipes_in_parallel(
+                    recipe_jobs, Mock(jobs=3), {}, [], [], {}
+                )
+            )
+        self.assertEqual(
+            [recipe_path for recipe_path, _ in results],
+            [recipe_path for recipe_path, _ in recipe_jobs],
+        )
+        self.assertEqual(
+            [result["recipe_cache_dir"] for _, result in results],
+            [f"/cache/com.example.{name}" for name in "abacba"],
+        )
+        self.assertEqual(overlaps, [])
+
+    @patch("autopkg.subprocess.Popen")
+    def test_update_munki_catalogs_runs_makecatalogs_per_repo(self, mock_popen):
+        """update_munki_catalogs should run makecatalogs once for each changed
+        repo and count the repos where it failed."""
+        mock_popen.return_value.communicate.return_value = ("", "oops")
+        mock_popen.return_value.returncode = 0
+        run_results = [
+            [
+                {
+                    "Input": {"MUNKI_REPO": "/repo/a"},
+                    "Output": {
+                        "munki_repo_changed": True,
+                        "pkginfo_repo_path": "/repo/a/pkgsinfo/Foo.plist",
+                    },
+                }
+            ],
+            [{"Input": {"MUNKI_REPO": "/repo/b"}, "Output": {}}],
+            [
+                {
+                    "Input": {"MUNKI_REPO": "/repo/a"},
+                    "Output": {"munki_repo_changed": True},
+                },
+                {
+                    "Input": {"MUNKI_REPO": "/repo/c"},
+                    "Output": {"munki_repo_changed": True},
+                },
+            ],
+        ]
+        options = Mock(verbose=0)
+        self.assertEqual(autopkg.update_munki_catalogs(run_results, options), 0)
+        self.assertEqual(
+            [call[0][0] for call in mock_popen.call_args_list],
+            [
+                ["/usr/local/munki/makecatalogs", "/repo/a"],
+                ["/usr/local/munki/makecatalogs", "/repo/c"],
+            ],
+        )
+        mock_popen.return_value.returncode = 1
+        self.assertEqual(autopkg.update_munki_catalogs(run_results, options), 2)
+        mock_popen.side_effect = OSError(2, "No such file or directory")
+        self.assertEqual(autopkg.update_munki_catalogs(run_results, options), 2)
+
+    def test_load_recipe_parses_each_file_once(self):
+        """Loading the same recipe twice should reuse the merged recipe."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            recipe_dir = os.path.join(tmp_dir, "recipes")
+            os.mkdir(recipe_dir)
+            with open(os.path.join(recipe_dir, "Chrome.download.recipe"), "wb") as f:
+                f.write(self.download_recipe.encode("utf-8"))
+            munki_path = os.path.join(recipe_dir, "Chrome.munki.recipe")
+            with open(munki_path, "wb") as f:
+                f.write(self.munki_recipe.encode("utf-8"))
+            index = autopkglib.recipeindex.RecipeIndex(
+                os.path.join(tmp_dir, "recipe_index.json")
+            )
+            with patch("autopkglib.recipeindex._recipe_index", index), patch.object(
+                autopkg, "read_recipe_file", wraps=autopkg.read_recipe_file
+            ) as mock_read:
+                first = autopkg.load_recipe(munki_path, [], [recipe_dir])
+                first["Input"]["NAME"] = "Changed"
+                second = autopkg.load_recipe(munki_path, [], [recipe_dir])
+            self.assertEqual(mock_read.call_count, 2)
+            self.assertEqual(second["Input"]["NAME"], "GoogleChrome")
+            self.assertEqual(
+                second["PARENT_RECIPES"],
+                [os.path.join(recipe_dir, "Chrome.download.recipe")],
+            )
+            self.assertEqual(len(second["Process"]), 4)
+
+    def test_get_recipe_list_uses_index(self):
+        """Recipes should be listed from the index without reading them, with
+        an override hiding the recipe it overrides."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            recipe_dir = os.path.join(tmp_dir, "recipes")
+            override_dir = os.path.join(tmp_dir, "overrides")
+            os.mkdir(recipe_dir)
+            os.mkdir(override_dir)
+            with open(os.path.join(recipe_dir, "Chrome.download.recipe"), "wb") as f:
+                f.write(self.download_recipe.encode("utf-8"))
+            override_path = os.path.join(override_dir, "Chrome.download.recipe")
+            with open(override_path, "wb") as f:
+                plistlib.dump(
+                    {
+                        "Identifier": "local.download.googlechrome",
+                        "Input": {},
+                        "ParentRecipe": "com.github.autopkg.download.googlechrome",
+                    },
+                    f,
+                )
+            index = autopkglib.recipeindex.RecipeIndex(
+                os.path.join(tmp_dir, "recipe_index.json")
+            )
+            with patch("autopkglib.recipeindex._recipe_index", index), patch.object(
+                autopkg, "recipe_plist_from_file"
+            ) as mock_read:
+                recipes = autopkg.get_recipe_list(
+                    [override_dir], [recipe_dir], augmented_list=True
+                )
+                mock_read.assert_not_called()
+        self.assertEqual(
+            recipes,
+            [
+                {
+                    "Name": "Chrome.download",
+                    "Path": override_path,
+                    "Identifier": "local.download.googlechrome",
+                    "IsOverride": True,
+                }
+            ],
+        )
+
+    def test_unjournaled_recipe_is_a_failure(self):
+        """A recipe whose results can't be written to the run journal should
+        be reported as failed."""
+        journal = Mock(path="autopkg_results.jsonl")
+        journal.add_recipe.side_effect = TypeError("can't serialize")
+        failures = []
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            error_count = autopkg.record_recipe_result(
+                "Foo.recipe",
+                {
+                    "results": [],
+                    "recipe_cache_dir": tmp_dir,
+                    "failure": None,
+                    "resources": {},
+                },
+                Mock(verbose=0),
+                journal,
+                {},
+                failures,
+                [],
+                None,
+            )
+        self.assertEqual(error_count, 1)
+        self.assertEqual(failures[0]["recipe"], "Foo.recipe")
+
+    def stub_git(self, outputs):
+        """Returns a stand-in for run_git that returns the output listed in
+        outputs for each git subcommand, or raises it if it's an exception.
+        A list gives the outputs of successive calls, the last repeated."""
+
+        def run_git(git_options_and_arguments, git_directory=None):
+            output = outputs[git_options_and_arguments[0]]
+            if isinstance(output, list):
+                output = output.pop(0) if len(output) > 1 else output[0]
+            if isinstance(output, Exception):
+                raise output
+            return output
+
+        return Mock(side_effect=run_git)
+
+    def git_commands(self, run_git):
+        """Returns the git subcommands a stub_git() was called with."""
+        return [call.args[0][0] for call in run_git.call_args_list]
+
+    def test_up_to_date_recipe_repo_not_pulled(self):
+        """A repo whose upstream is at the commit checked out shouldn't be
+        pulled."""
+        run_git = self.stub_git(
+            {
+                "rev-parse": "abc123\n",
+                "symbolic-ref": "refs/heads/main\n",
+                "for-each-ref": "origin refs/heads/main\n",
+                "ls-remote": "abc123\trefs/heads/main\n",
+            }
+        )
+        with patch.object(autopkg, "run_git", run_git):
+            update = autopkg.update_recipe_repo("/repos/foo")
+        self.assertFalse(update["updated"])
+        self.assertIsNone(update["error"])
+        self.assertNotIn("pull", self.git_commands(run_git))
+
+    def test_updated_recipe_repo_lists_changed_recipes(self):
+        """A pulled repo should list the recipes added, modified and deleted
+        by the pull, from git diff --name-status -z."""
+        run_git = self.stub_git(
+            {
+                "rev-parse": ["abc123\n", "def456\n"],
+                "symbolic-ref": "refs/heads/main\n",
+                "for-each-ref": "origin refs/heads/main\n",
+                "ls-remote": "def456\trefs/heads/main\n",
+                "pull": "Updating abc123..def456\n",
+                "diff": (
+                    "A\0Foo/New Foo.download.recipe\0"
+                    "M\0Foo/Foo.munki.recipe\0"
+                    "D\0Bar/Bar.pkg.recipe\0"
+                ),
+            }
+        )
+        with patch.object(autopkg, "run_git", run_git):
+            update = autopkg.update_recipe_repo("/repos/foo")
+        self.assertTrue(update["updated"])
+        self.assertEqual(
+            update["changed_recipes"],
+            [
+                {"path": "/repos/foo/Foo/New Foo.download.recipe", "change": "added"},
+                {"path": "/repos/foo/Foo/Foo.munki.recipe", "change": "modified"},
+                {"path": "/repos/foo/Bar/Bar.pkg.recipe", "change": "deleted"},
+            ],
+        )
+        diff_args = run_git.call_args_list[-1].args[0]
+        self.assertIn("--name-status", diff_args)
+        self.assertIn("-z", diff_args)
+        self.assertEqual(diff_args[-2:], ["--", "*.recipe"])
+
+    def test_repo_update_reports_errors(self):
+        """A repo that fails to update should have its error in the
+        --report-plist, and the other repos their results."""
+        run_git = self.stub_git(
+            {
+                "rev-parse": "abc123\n",
+                "symbolic-ref": "refs/heads/main\n",
+                "for-each-ref": "origin refs/heads/main\n",
+                "ls-remote": ["def456\trefs/heads/main\n", "abc123\n"],
+                "pull": autopkg.GitError("ERROR: fatal: couldn't find remote ref"),
+            }
+        )
+        prefs = {"RECIPE_REPOS": {"/repos/foo": {}, "/repos/bar": {}}, "REPO_JOBS": 1}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            report_path = os.path.join(tmp_dir, "report.plist")
+            with patch.object(autopkg, "run_git", run_git), patch.object(
+                autopkg, "get_pref", side_effect=prefs.get
+            ), patch.object(autopkg, "log_err"), patch.object(autopkg, "log"):
+                autopkg.repo_update(
+                    ["autopkg", "repo-update", "all", "--report-plist", report_path]
+                )
+            with open(report_path, "rb") as f:
+                report = plistlib.load(f)
+        self.assertEqual(
+            report,
+            {
+                "/repos/foo": {
+                    "updated": False,
+                    "changed_recipes": [],
+                    "error": "ERROR: fatal: couldn't find remote ref",
+                },
+                "/repos/bar": {"updated": False, "changed_recipes": [], "error": ""},
+            },
+        )
+
+    def test_split_check_phase(self):
+        """Steps up to EndOfCheckPhase should make up the check phase."""
+        recipe = plistlib.loads(self.download_recipe.encode("utf-8"))
+        check_steps, build_steps = autopkg.split_check_phase(recipe["Process"])
+        self.assertEqual(
+            [step["Processor"] for step in check_steps],
+            ["URLDownloader", "EndOfCheckPhase"],
+        )
+        self.assertEqual(
+            [step["Processor"] for step in build_steps], ["CodeSignatureVerifier"]
+        )
+        check_steps, build_steps = autopkg.split_check_phase(build_steps)
+        self.assertEqual((check_steps, len(build_steps)), ([], 1))
+
+    @patch("autopkg.new_recipe_autopackager")
+    def test_pipeline_recipe_skips_unchanged_download(self, mock_new):
+        """Only recipes with a changed download should run past the check."""
+        recipe = plistlib.loads(self.download_recipe.encode("utf-8"))
+        options = Mock(verbose=0)
+        for download_changed in (False, True):
+            autopackager = Mock(env={"download_changed": download_changed})
+            autopackager.results = []
+            mock_new.return_value = (autopackager, True)
+            result = autopkg.pipeline_recipe(
+                "Chrome", recipe, options, {}, [], [], {}, threading.Lock()
+            )
+            self.assertIsNone(result["failure"])
+            self.assertEqual(autopackager.process_steps.call_count, 1)
+            self.assertEqual(autopackager.process_build_phase.called, download_changed)
+
+    @unittest.skipUnless(hasattr(autopkglib, "NSArray"), "Foundation is not available")
+    def test_pipelined_check_phases_share_recipe_caches(self):
+        """Check phases run in parallel threads, verifying trust in overrides
+        of the same parent, should all load and verify their recipes."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            recipe_dir = os.path.join(tmp_dir, "recipes")
+            override_dir = os.path.join(tmp_dir, "overrides")
+            cache_dir = os.path.join(tmp_dir, "cache")
+            os.mkdir(recipe_dir)
+            os.mkdir(override_dir)
+            parent = {
+                "Identifier": "com.example.parent",
+                "Input": {"NAME": "Foo"},
+                "Process": [{"Processor": "EndOfCheckPhase"}],
+            }
+            with open(os.path.join(recipe_dir, "Foo.recipe"), "wb") as f:
+                plistlib.dump(parent, f)
+            trust_info = autopkg.get_trust_info(
+                autopkg.load_recipe("com.example.parent", [], [recipe_dir]),
+                [recipe_dir],
+            )
+            paths = []
+            for number in range(16):
+                override = {
+                    "Identifier": f"local.Foo{number}",
+                    "Input": {"NAME": f"Foo{number}"},
+                    "ParentRecipe": "com.example.parent",
+                    "ParentRecipeTrustInfo": trust_info,
+                }
+                path = os.path.join(override_dir, f"Foo{number}.recipe")
+                with open(path, "wb") as f:
+                    plistlib.dump(override, f)
+                paths.append(path)
+            recipe_jobs = [
+                (path, autopkg.load_recipe(path, [override_dir], [recipe_dir]))
+                for path in paths
+            ]
+            options = Mock(
+                verbose=0,
+                check_jobs=8,
+                max_per_host=4,
+                no_fastpath=True,
+                no_trust_cache=True,
+                ignore_parent_trust_verification_errors=False,
+            )
+            index_path = os.path.join(tmp_dir, "recipe_index.json")
+            index_recipe_file = autopkglib.recipeindex.index_recipe_file
+            indexing = []
+            overlapped = []
+
+            def slow_index_recipe_file(path, file_stat):
+                # give other threads the chance to index at the same time
+                indexing.append(path)
+                overlapped.append(len(indexing) > 1)
+                time.sleep(0.01)
+                indexing.remove(path)
+                return index_recipe_file(path, file_stat)
+
+            # start from cold caches, so the threads fill them
+            with patch(
+                "autopkglib.recipeindex.index_recipe_file", slow_index_recipe_file
+            ), patch(
+                "autopkglib.recipeindex._recipe_index",
+                autopkglib.recipeindex.RecipeIndex(index_path),
+            ), patch.dict(
+                autopkg._recipe_file_cache, clear=True
+            ), patch.dict(
+                autopkg._merged_recipe_cache, clear=True
+            ), patch.object(
+                autopkg, "log"
+            ):
+                results = list(
+                    autopkg.run_recipes_pipelined(
+                        recipe_jobs,
+                        options,
+                        {"CACHE_DIR": cache_dir},
+                        [override_dir],
+                        [recipe_dir],
+                        {"CACHE_DIR": cache_dir},
+                    )
+                )
+            with open(index_path) as f:
+                self.assertIn(recipe_dir, json.load(f)["directories"])
+        self.assertFalse(any(overlapped))
+        self.assertEqual([path for path, _ in results], paths)
+        for _, result in results:
+            self.assertIsNone(result["failure"])
+            self.assertEqual(result["results"][-1]["Processor"], "EndOfCheckPhase")
+
+    def test_core_processor_manifest(self):
+        """The core processor list should name every processor module."""
+        lib_dir = os.path.dirname(autopkglib.__file__)
+        modules = [
+            os.path.splitext(name)[0]
+            for name in os.listdir(lib_dir)
+            if name.endswith(".py") and name != "__init__.py"
+        ]
+        self.assertEqual(sorted(autopkglib.core_processor_names()), sorted(modules))
+
+    def test_processors_imported_lazily(self):
+        """Importing autopkglib shouldn't import any processor modules."""
+        code = (
+            "import sys, autopkglib; "
+            "print([m for m in sys.modules if m.startswith('autopkglib.')])"
+        )
+        output = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=os.path.dirname(os.path.dirname(autopkglib.__file__)),
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        self.assertEqual(output.splitlines()[-1], "[]")
+        processor = autopkglib.get_processor("EndOfCheckPhase")
+        self.assertEqual(processor.__name__, "EndOfCheckPhase")
+
+    def test_core_processor_attributes_after_submodule_import(self):
+        """Core processors should stay classes on autopkglib after their
+        modules are imported directly."""
+        code = (
+            "import autopkglib, autopkglib.github; "
+            "autopkglib.get_processor('AppDmgVersioner'); "
+            "from autopkglib import URLGetter, DmgMounter; "
+            "print(isinstance(URLGetter, type), isinstance(DmgMounter, type))"
+        )
+        output = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=os.path.dirname(os.path.dirname(autopkglib.__file__)),
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        self.assertEqual(output.splitlines()[-1], "True True")
+
+    @unittest.skipUnless(hasattr(autopkglib, "NSArray"), "Foundation is not available")
+    def test_update_data(self):
+        """update_data should substitute %key% references everywhere, copying
+        only the dicts it changes."""
+        unchanged = {"catalogs": ["testing"], "description": "100% free"}
+        pkginfo = {"name": "%NAME%", "installs": [{"path": "/Applications/%NAME%.app"}]}
+        env = {"NAME": "Foo"}
+        autopkglib.update_data(env, "unchanged", unchanged)
+        autopkglib.update_data(env, "pkginfo", pkginfo)
+        autopkglib.update_data(env, "missing", "%NAME%-%MISSING%")
+        self.assertIs(env["unchanged"], unchanged)
+        self.assertEqual(
+            env["pkginfo"],
+            {"name": "Foo", "installs": [{"path": "/Applications/Foo.app"}]},
+        )
+        self.assertEqual(pkginfo["name"], "%NAME%")
+        self.assertEqual(env["missing"], "%NAME%-%MISSING%")
+        env["NAME"] = "Bar"
+        autopkglib.update_data(env, "name", "%NAME%")
+        self.assertEqual(env["name"], "Bar")
+
+    def test_recipe_env_copy_on_write(self):
+        """A RecipeEnv should read through to its base layer, but changes to
+        it, including to mutable values, shouldn't reach the base layer."""
+        prefs = {"CACHE_DIR": "/cache", "RECIPE_SEARCH_DIRS": ["."], "A": "a"}
+        env = autopkglib.RecipeEnv(prefs)
+        env["NAME"] = "Foo"
+        env["CACHE_DIR"] = "/other"
+        env["RECIPE_SEARCH_DIRS"].append("/recipes")
+        del env["A"]
+        self.assertEqual(list(env), ["CACHE_DIR", "RECIPE_SEARCH_DIRS", "NAME"])
+        self.assertNotIn("A", env)
+        self.assertEqual(env["RECIPE_SEARCH_DIRS"], [".", "/recipes"])
+        self.assertEqual(
+            prefs, {"CACHE_DIR": "/cache", "RECIPE_SEARCH_DIRS": ["."], "A": "a"}
+        )
+        self.assertEqual(
+            env.copy(),
+            {
+                "CACHE_DIR": "/other",
+                "RECIPE_SEARCH_DIRS": [".", "/recipes"],
+                "NAME": "Foo",
+            },
+        )
+        self.assertEqual(
+            env.changes(),
+            {
+                "NAME": "Foo",
+                "CACHE_DIR": "/other",
+                "RECIPE_SEARCH_DIRS": [".", "/recipes"],
+            },
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
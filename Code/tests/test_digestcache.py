@@ -0,0 +1,68 @@
+#!/usr/local/autopkg/python
+
+import hashlib
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from autopkglib import digestcache
+from autopkglib.digestcache import DigestCache, hash_file
+
+BIG_DATA = os.urandom(3 * 2 ** 20 + 12345)
+
+
+class TestDigestCache(unittest.TestCase):
+    """Test class for the persistent file digest cache."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = DigestCache(os.path.join(self.tmp_dir.name, "digests.sqlite"))
+        self.path = os.path.join(self.tmp_dir.name, "Foo.dmg")
+        with open(self.path, "wb") as f:
+            f.write(b"foo" * 1000)
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmp_dir.cleanup()
+
+    def test_unchanged_file_is_not_rehashed(self):
+        """A second lookup of an unchanged file should come from the cache."""
+        digest = self.cache.digests(self.path)["sha256"]
+        self.assertEqual(digest, hashlib.sha256(b"foo" * 1000).hexdigest())
+        with mock.patch.object(digestcache, "hash_file") as hasher:
+            self.assertEqual(self.cache.digests(self.path)["sha256"], digest)
+            hasher.assert_not_called()
+
+    def test_changed_file_is_rehashed(self):
+        """A rewritten file should be hashed again, even with the same mtime."""
+        self.cache.digests(self.path)
+        info = os.stat(self.path)
+        with open(self.path, "wb") as f:
+            f.write(b"bar" * 1000)
+        os.utime(self.path, ns=(info.st_atime_ns, info.st_mtime_ns))
+        self.assertEqual(
+            self.cache.digests(self.path)["sha256"],
+            hashlib.sha256(b"bar" * 1000).hexdigest(),
+        )
+
+    def test_recorded_digests(self):
+        """Digests recorded by a download should be used for lookups."""
+        self.cache.record(self.path, {"sha256": "recorded", "sha1": "ignored"})
+        self.assertEqual(self.cache.digests(self.path)["sha256"], "recorded")
+
+    def test_hash_big_file(self):
+        """Several digests of a big, memory mapped file should match hashlib."""
+        with open(self.path, "wb") as f:
+            f.write(BIG_DATA)
+        self.assertEqual(
+            hash_file(self.path, ("sha256", "md5")),
+            {
+                "sha256": hashlib.sha256(BIG_DATA).hexdigest(),
+                "md5": hashlib.md5(BIG_DATA).hexdigest(),
+            },
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/local/autopkg/python
+
+import hashlib
+import os
+import tempfile
+import unittest
+
+from autopkglib.downloadstore import DownloadStore
+from autopkglib.URLDownloader import URLDownloader
+
+
+class TestDownloadStore(unittest.TestCase):
+    """Test class for the shared download store."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = DownloadStore(os.path.join(self.tmp_dir.name, "store"))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_download(self, name, content):
+        """Write a fake download and return its path and checksum."""
+        path = os.path.join(self.tmp_dir.name, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        return path, hashlib.sha256(content).hexdigest()
+
+    def test_add_and_materialize(self):
+        """A stored download should be found by URL and copied elsewhere."""
+        path, sha256 = self.write_download("a.dmg", b"content")
+        self.store.add(path, sha256, "https://example.com/a.dmg", etag='"1"')
+        entry = self.store.lookup("https://example.com/a.dmg")
+        self.assertEqual(entry["sha256"], sha256)
+        self.assertEqual(entry["etag"], '"1"')
+        self.assertIsNone(self.store.lookup("https://example.com/b.dmg"))
+        destination = os.path.join(self.tmp_dir.name, "copy.dmg")
+        self.store.materialize(entry, destination)
+        with open(destination, "rb") as f:
+            self.assertEqual(f.read(), b"content")
+
+    def test_duplicate_content_is_stored_once(self):
+        """Adding the same content from another URL should link to it."""
+        first, sha256 = self.write_download("a.dmg", b"content")
+        second, _ = self.write_download("b.dmg", b"content")
+        self.store.add(first, sha256, "https://example.com/a.dmg")
+        self.store.add(second, sha256, "https://mirror.example.com/a.dmg")
+        self.assertEqual(
+            os.stat(second).st_ino, os.stat(self.store.object_path(sha256)).st_ino
+        )
+        objects = os.listdir(os.path.dirname(self.store.object_path(sha256)))
+        self.assertEqual(objects, [sha256])
+
+    def test_linked_downloads_keep_their_own_validators(self):
+        """Recipes whose downloads are hard linked to the same stored file
+        should each keep their own ETag and checksum."""
+        path, sha256 = self.write_download("a.dmg", b"content")
+        self.store.add(path, sha256, "https://example.com/a.dmg")
+        other_path = os.path.join(self.tmp_dir.name, "b.dmg")
+        self.store.materialize(
+            self.store.lookup("https://example.com/a.dmg"), other_path
+        )
+        self.assertEqual(os.stat(path).st_ino, os.stat(other_path).st_ino)
+        downloaders = []
+        for pathname, etag in ((path, '"a"'), (other_path, '"b"')):
+            downloader = URLDownloader({"pathname": pathname})
+            downloader.clear_vars()
+            downloader.setxattr(downloader.xattr_etag, etag)
+            downloader.setxattr(downloader.xattr_digests["sha256"], sha256)
+            downloaders.append(downloader)
+        self.assertEqual(downloaders[0].getxattr(downloaders[0].xattr_etag), '"a"')
+        self.assertEqual(downloaders[1].getxattr(downloaders[1].xattr_etag), '"b"')
+        self.assertEqual(
+            downloaders[1].getxattr(downloaders[1].xattr_digests["sha256"]), sha256
+        )
+
+    def test_least_recently_used_are_evicted(self):
+        """The store should evict the oldest downloads beyond max_size."""
+        self.store.max_size = 10
+        old, old_sha256 = self.write_download("old.dmg", b"0123456789")
+        new, new_sha256 = self.write_download("new.dmg", b"abcdefghij")
+        self.store.add(old, old_sha256, "https://example.com/old.dmg")
+        self.store.add(new, new_sha256, "https://example.com/new.dmg")
+        self.assertIsNone(self.store.lookup("https://example.com/old.dmg"))
+        self.assertFalse(os.path.exists(self.store.object_path(old_sha256)))
+        self.assertIsNotNone(self.store.lookup("https://example.com/new.dmg"))
+        # the recipe's own copy is left alone
+        self.assertTrue(os.path.exists(old))
+
+
+if __name__ == "__main__":
+    unittest.main()
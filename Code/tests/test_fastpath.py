@@ -0,0 +1,146 @@
+#!/usr/local/autopkg/python
+
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+
+from autopkglib import AutoPackager, Processor, get_processor
+from autopkglib.fastpath import fingerprint, matching_record, save_record
+
+
+class FakeDownloader(Processor):
+    """Stands in for URLDownloader, outputting the download at DOWNLOAD."""
+
+    input_variables = {}
+    output_variables = {"pathname": {"description": "The download."}}
+
+    def main(self):
+        self.env["pathname"] = self.env["DOWNLOAD"]
+
+
+class FakeImporter(Processor):
+    """Stands in for PkgCreator and MunkiImporter, building PKG and importing
+    it as PKGINFO."""
+
+    input_variables = {}
+    output_variables = {
+        "pkg_path": {"description": "The package."},
+        "new_package_request": {"description": "Whether it was built."},
+        "pkginfo_repo_path": {"description": "The imported pkginfo."},
+        "munki_repo_changed": {"description": "Whether it was imported."},
+    }
+
+    def main(self):
+        self.env["pkg_path"] = self.env["PKG"]
+        self.env["new_package_request"] = True
+        self.env["pkginfo_repo_path"] = self.env["PKGINFO"]
+        self.env["munki_repo_changed"] = True
+
+
+class TestFastPath(unittest.TestCase):
+    """Test class for recipe run fingerprints."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.download = os.path.join(self.tmp_dir.name, "Foo.dmg")
+        with open(self.download, "wb") as f:
+            f.write(b"foo")
+        self.recipe = {
+            "Identifier": "com.example.Foo",
+            "Process": [{"Processor": "URLDownloader"}],
+        }
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def fingerprint(self, inputs=None, check_outputs=None):
+        return fingerprint(
+            self.recipe,
+            inputs or {"NAME": "Foo"},
+            check_outputs or [{"pathname": self.download}],
+            [TestFastPath],
+        )
+
+    def test_fingerprint(self):
+        """A fingerprint should change with the inputs and the contents of
+        the download, but not with variables that differ on every run."""
+        before = self.fingerprint()
+        self.assertEqual(before, self.fingerprint())
+        self.assertNotEqual(before, self.fingerprint(inputs={"NAME": "Bar"}))
+        self.assertEqual(
+            before,
+            self.fingerprint(
+                check_outputs=[{"pathname": self.download, "download_changed": True}]
+            ),
+        )
+        with open(self.download, "wb") as f:
+            f.write(b"bar")
+        self.assertNotEqual(before, self.fingerprint())
+
+    def test_matching_record(self):
+        """A record should only match with the same fingerprint and while the
+        files the run output still exist."""
+        pkg_path = os.path.join(self.tmp_dir.name, "Foo.pkg")
+        with open(pkg_path, "wb") as f:
+            f.write(b"pkg")
+        save_record(self.tmp_dir.name, "abc", [{"pkg_path": pkg_path}])
+        record = matching_record(self.tmp_dir.name, "abc")
+        self.assertEqual(record["outputs"], {"pkg_path": pkg_path})
+        self.assertIsNone(matching_record(self.tmp_dir.name, "def"))
+        os.remove(pkg_path)
+        self.assertIsNone(matching_record(self.tmp_dir.name, "abc"))
+
+    def test_skipped_run_reports_no_import(self):
+        """A second run with nothing changed should restore the package it
+        built, but not report the import as done again."""
+        env = {"CACHE_DIR": os.path.join(self.tmp_dir.name, "cache")}
+        for key, name in (
+            ("DOWNLOAD", "Foo.dmg"),
+            ("PKG", "Foo.pkg"),
+            ("PKGINFO", "Foo.plist"),
+        ):
+            env[key] = os.path.join(self.tmp_dir.name, name)
+            with open(env[key], "wb") as f:
+                f.write(name.encode())
+        recipe = {
+            "Identifier": "com.example.Foo",
+            "Process": [
+                {"Processor": "FakeDownloader"},
+                {"Processor": "EndOfCheckPhase"},
+                {"Processor": "FakeImporter"},
+            ],
+        }
+        processors = {
+            "FakeDownloader": FakeDownloader,
+            "EndOfCheckPhase": get_processor("EndOfCheckPhase"),
+            "FakeImporter": FakeImporter,
+        }
+        autopackagers = []
+        with patch.object(
+            AutoPackager,
+            "step_processor",
+            lambda self, step: processors[step["Processor"]],
+        ):
+            for _ in range(2):
+                autopackager = AutoPackager(Mock(verbose=0), dict(env))
+                autopackager.fastpath = True
+                autopackager.process(recipe)
+                autopackagers.append(autopackager)
+        first, second = autopackagers
+        self.assertTrue(first.env["munki_repo_changed"])
+        self.assertNotIn("FastPath", first.results[-1])
+        self.assertIn("FastPath", second.results[-1])
+        self.assertEqual(second.env["pkg_path"], env["PKG"])
+        for key in ("munki_repo_changed", "new_package_request", "pkginfo_repo_path"):
+            self.assertNotIn(key, second.env)
+        self.assertFalse(
+            any(
+                item.get("Output", {}).get("munki_repo_changed")
+                for item in second.results
+            )
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
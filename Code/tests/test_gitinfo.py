@@ -0,0 +1,91 @@
+#!/usr/local/autopkg/python
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from autopkglib import gitinfo
+from autopkglib.gitinfo import find_toplevel, get_git_repo_info
+
+
+@unittest.skipUnless(shutil.which("git"), "git is not installed")
+class TestGitInfo(unittest.TestCase):
+    """Test class for batched git metadata."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.repo = os.path.realpath(os.path.join(self.tmp_dir.name, "recipes"))
+        self.cache_dir = os.path.join(self.tmp_dir.name, "Cache")
+        os.makedirs(os.path.join(self.repo, "Foo"))
+        self.calls = []
+        self.run_git(["init", "-q"], git_directory=self.repo)
+
+    def tearDown(self):
+        gitinfo._repos.clear()
+        self.tmp_dir.cleanup()
+
+    def run_git(self, arguments, git_directory=None):
+        """Run git, counting the calls."""
+        self.calls.append(arguments[0])
+        return subprocess.run(
+            ["git", "-c", "user.name=a", "-c", "user.email=a@b", *arguments],
+            cwd=git_directory,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+
+    def commit(self, path, contents):
+        """Write a file and commit it, returning the commit hash."""
+        with open(os.path.join(self.repo, path), "w") as f:
+            f.write(contents)
+        self.run_git(["add", path], git_directory=self.repo)
+        self.run_git(["commit", "-q", "-m", path], git_directory=self.repo)
+        return self.run_git(["rev-parse", "HEAD"], git_directory=self.repo).strip()
+
+    def repo_info(self):
+        """Returns the repo's GitRepoInfo, counting only its own git calls."""
+        self.calls = []
+        return get_git_repo_info(self.repo, self.run_git, self.cache_dir)
+
+    def test_last_commits(self):
+        """Every file's last commit should come from a single git log."""
+        first = self.commit("Foo/Foo recipe.recipe", "foo")
+        second = self.commit("Bar.recipe", "bar")
+        recipe = os.path.join(self.repo, "Foo", "Foo recipe.recipe")
+        self.assertEqual(find_toplevel(recipe), self.repo)
+        repo = self.repo_info()
+        self.assertEqual(repo.clean_commit(recipe), first)
+        self.assertEqual(
+            repo.last_commit(os.path.join(self.repo, "Bar.recipe")), second
+        )
+        self.assertIsNone(repo.last_commit(os.path.join(self.repo, "Untracked")))
+        self.assertEqual(self.calls.count("log"), 1)
+
+    def test_changed_files(self):
+        """Files changed since their last commit should have no clean commit."""
+        self.commit("Bar.recipe", "bar")
+        with open(os.path.join(self.repo, "Bar.recipe"), "w") as f:
+            f.write("changed")
+        repo = self.repo_info()
+        self.assertIsNone(repo.clean_commit(os.path.join(self.repo, "Bar.recipe")))
+
+    def test_cached_per_head(self):
+        """Last commits should be reused until HEAD moves."""
+        self.commit("Bar.recipe", "bar")
+        self.repo_info()
+        gitinfo._repos.clear()
+        self.repo_info()
+        self.assertNotIn("log", self.calls)
+        commit = self.commit("Bar.recipe", "changed")
+        repo = self.repo_info()
+        self.assertIn("log", self.calls)
+        self.assertEqual(
+            repo.last_commit(os.path.join(self.repo, "Bar.recipe")), commit
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/local/autopkg/python
+
+import os
+import tempfile
+import unittest
+
+from autopkglib.metrics import RunMetrics
+
+
+def step(processor, wall_time, network_bytes=0, output=None):
+    """Returns an AutoPackager results entry for a processor step."""
+    return {
+        "Processor": processor,
+        "Input": {},
+        "Output": output or {},
+        "Resources": {"wall_time": wall_time, "network_bytes": network_bytes},
+    }
+
+
+class TestMetrics(unittest.TestCase):
+    """Test class for OpenMetrics run metrics."""
+
+    def setUp(self):
+        self.metrics = RunMetrics()
+        self.metrics.record_recipe(
+            "Foo.download.recipe",
+            {
+                "results": [
+                    step("URLDownloader", 3.0, 2048, {"download_changed": True}),
+                    step("EndOfCheckPhase", 0.001),
+                ],
+                "failure": None,
+                "resources": {"wall_time": 4.0, "trust_verification_time": 0.02},
+            },
+        )
+        self.metrics.record_recipe(
+            "Bar.download.recipe",
+            {
+                "results": [step("URLDownloader", 0.2)],
+                "failure": {
+                    "recipe": "Bar.download.recipe",
+                    "processor": "com.example/CodeSignatureVerifier",
+                },
+                "resources": {"wall_time": 0.5},
+            },
+        )
+
+    def test_render(self):
+        """Counters, gauges and cumulative histogram buckets should be
+        rendered in the OpenMetrics text format."""
+        lines = self.metrics.render().splitlines()
+        for line in (
+            'autopkg_recipes_total{result="success"} 1',
+            'autopkg_recipes_total{result="failure"} 1',
+            'autopkg_processor_failures_total{processor="CodeSignatureVerifier"} 1',
+            'autopkg_downloads_total{result="changed"} 1',
+            'autopkg_downloads_total{result="unchanged"} 1',
+            "autopkg_download_bytes_total 2048",
+            'autopkg_recipe_download_bytes{recipe="Foo.download.recipe"} 2048',
+            'autopkg_recipe_duration_seconds_bucket{le="1.0"} 1',
+            'autopkg_recipe_duration_seconds_bucket{le="5.0"} 2',
+            'autopkg_recipe_duration_seconds_bucket{le="+Inf"} 2',
+            "autopkg_recipe_duration_seconds_sum 4.5",
+            'autopkg_processor_duration_seconds_count{processor="URLDownloader"} 2',
+            "autopkg_trust_verification_duration_seconds_count 1",
+            "autopkg_run_in_progress 1",
+        ):
+            self.assertIn(line, lines)
+        self.assertEqual(lines[-1], "# EOF")
+
+    def test_write(self):
+        """The metrics file should be replaced whole and be world readable."""
+        self.metrics.finish()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "autopkg.prom")
+            self.metrics.write(path)
+            self.assertEqual(os.listdir(tmp_dir), ["autopkg.prom"])
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+            with open(path) as f:
+                self.assertIn("autopkg_run_in_progress 0\n", f.read())
+
+
+if __name__ == "__main__":
+    unittest.main()
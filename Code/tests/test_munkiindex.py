@@ -0,0 +1,107 @@
+#!/usr/local/autopkg/python
+
+import os
+import plistlib
+import tempfile
+import unittest
+
+from autopkglib.munkiindex import MunkiRepoIndex
+
+
+class TestMunkiRepoIndex(unittest.TestCase):
+    """Test class for the Munki repo index."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.repo = os.path.join(self.tmp_dir.name, "repo")
+        os.makedirs(os.path.join(self.repo, "pkgsinfo", "apps"))
+        self.index = MunkiRepoIndex(
+            self.repo, index_path=os.path.join(self.tmp_dir.name, "index.sqlite")
+        )
+
+    def tearDown(self):
+        self.index.close()
+        self.tmp_dir.cleanup()
+
+    def write_pkginfo(self, name, pkginfo):
+        """Write a pkginfo to the repo and return its path."""
+        path = os.path.join(self.repo, "pkgsinfo", "apps", name)
+        with open(path, "wb") as f:
+            plistlib.dump(pkginfo, f)
+        return path
+
+    def test_items_are_found_by_hash_receipt_and_installs(self):
+        """Indexed pkginfos should be found by each of their lookup keys."""
+        os.makedirs(os.path.join(self.repo, "pkgs", "apps"))
+        open(os.path.join(self.repo, "pkgs", "apps", "Foo-1.0.dmg"), "w").close()
+        self.write_pkginfo(
+            "Foo-1.0.plist",
+            {
+                "name": "Foo",
+                "version": "1.0",
+                "installer_item_hash": "abc",
+                "installer_item_location": "apps/Foo-1.0.dmg",
+                "receipts": [{"packageid": "com.example.foo", "version": "1.0"}],
+                "installs": [
+                    {
+                        "type": "application",
+                        "path": "/Applications/Foo.app",
+                        "CFBundleShortVersionString": "1.0",
+                    },
+                    {"type": "file", "path": "/usr/local/bin/foo"},
+                ],
+            },
+        )
+        self.assertEqual(self.index.sync(), 1)
+        ids = self.index.ids_with_hash("abc")
+        self.assertEqual(self.index.first_item(ids)["name"], "Foo")
+        self.assertEqual(self.index.ids_with_receipt("com.example.foo", "1.0"), ids)
+        self.assertEqual(
+            self.index.ids_with_application("/Applications/Foo.app", "1.0"), ids
+        )
+        self.assertEqual(self.index.ids_with_file("/usr/local/bin/foo"), ids)
+        self.assertEqual(self.index.ids_with_installer_item("Foo-1.0.dmg", "1.0"), ids)
+        self.assertFalse(self.index.ids_with_receipt("com.example.foo", "2.0"))
+
+    def test_items_with_missing_installer_item_are_not_found(self):
+        """Pkginfos left out of the 'all' catalog shouldn't be matched."""
+        self.write_pkginfo(
+            "Foo-1.0.plist",
+            {
+                "name": "Foo",
+                "version": "1.0",
+                "installer_item_hash": "abc",
+                "installer_item_location": "apps/Foo-1.0.dmg",
+                "receipts": [{"packageid": "com.example.foo", "version": "1.0"}],
+            },
+        )
+        self.index.sync()
+        self.assertFalse(self.index.ids_with_hash("abc"))
+        self.assertFalse(self.index.ids_with_receipt("com.example.foo", "1.0"))
+        self.assertIsNone(self.index.first_item(self.index.ids_with_hash("abc")))
+
+    def test_sync_only_rereads_changed_pkginfos(self):
+        """Unchanged pkginfos should be skipped and deleted ones dropped."""
+        first = self.write_pkginfo(
+            "Foo-1.0.plist",
+            {"name": "Foo", "version": "1.0", "installer_item_hash": "abc"},
+        )
+        self.write_pkginfo(
+            "Bar-1.0.plist",
+            {"name": "Bar", "version": "1.0", "installer_item_hash": "def"},
+        )
+        self.assertEqual(self.index.sync(), 2)
+        self.assertEqual(self.index.sync(), 0)
+        self.write_pkginfo(
+            "Bar-1.0.plist",
+            {"name": "Bar", "version": "1.0", "installer_item_hash": "ghij"},
+        )
+        os.remove(first)
+        self.assertEqual(self.index.sync(), 2)
+        self.assertFalse(self.index.ids_with_hash("abc"))
+        self.assertFalse(self.index.ids_with_hash("def"))
+        self.assertTrue(self.index.ids_with_hash("ghij"))
+
+
+if __name__ == "__main__":
+    unittest.main()
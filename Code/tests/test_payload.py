@@ -0,0 +1,127 @@
+#!/usr/local/autopkg/python
+
+import gzip
+import lzma
+import os
+import stat
+import struct
+import tempfile
+import unittest
+
+from autopkglib.payload import PayloadError, unpack_payload
+
+FILE_DATA = b"".join(b"line %d\n" % i for i in range(20000))
+
+
+def cpio_entry(name, mode, data=b"", ino=0, nlink=1, mtime=1600000000):
+    """Returns one entry of an odc cpio archive"""
+    name = name.encode() + b"\0"
+    header = (
+        f"070707{0:06o}{ino:06o}{mode:06o}{0:06o}{0:06o}{nlink:06o}{0:06o}"
+        f"{mtime:011o}{len(name):06o}{len(data):011o}"
+    )
+    return header.encode() + name + data
+
+
+def cpio_archive():
+    """Returns a cpio archive with a directory, files, a symlink and a hard
+    link"""
+    return b"".join(
+        [
+            cpio_entry(".", stat.S_IFDIR | 0o755, ino=1),
+            cpio_entry("./Foo.app", stat.S_IFDIR | 0o755, ino=2),
+            cpio_entry("./Foo.app/foo", stat.S_IFREG | 0o755, FILE_DATA, ino=3),
+            cpio_entry("./Foo.app/bar", stat.S_IFREG | 0o600, b"bar", ino=4, nlink=2),
+            cpio_entry("./Foo.app/baz", stat.S_IFREG | 0o600, b"bar", ino=4, nlink=2),
+            cpio_entry("./Foo.app/link", stat.S_IFLNK | 0o755, b"foo", ino=5),
+            cpio_entry("TRAILER!!!", 0),
+        ]
+    )
+
+
+def pbzx(data, chunk_size):
+    """Returns data as a pbzx stream of xz chunks of chunk_size bytes. Each
+    chunk's flags say whether another follows."""
+    offsets = range(0, len(data), chunk_size)
+    stream = b"pbzx" + struct.pack(">Q", chunk_size | 0x01000000)
+    for offset in offsets:
+        chunk = lzma.compress(data[offset : offset + chunk_size])
+        more = 0 if offset == offsets[-1] else 0x01000000
+        stream += struct.pack(">QQ", chunk_size | more, len(chunk)) + chunk
+    return stream
+
+
+class TestPayload(unittest.TestCase):
+    """Test class for the payload extractor."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.payload = os.path.join(self.tmp_dir.name, "Payload")
+        self.destination = os.path.join(self.tmp_dir.name, "root")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_payload(self, data):
+        """Write a payload file."""
+        with open(self.payload, "wb") as f:
+            f.write(data)
+
+    def assert_unpacked(self):
+        """Check everything in cpio_archive() was unpacked as archived."""
+        app = os.path.join(self.destination, "Foo.app")
+        with open(os.path.join(app, "foo"), "rb") as f:
+            self.assertEqual(f.read(), FILE_DATA)
+        foo = os.stat(os.path.join(app, "foo"))
+        self.assertEqual(stat.S_IMODE(foo.st_mode), 0o755)
+        self.assertEqual(foo.st_mtime, 1600000000)
+        bar = os.stat(os.path.join(app, "bar"))
+        self.assertEqual(bar.st_ino, os.stat(os.path.join(app, "baz")).st_ino)
+        self.assertEqual(stat.S_IMODE(bar.st_mode), 0o600)
+        self.assertEqual(os.readlink(os.path.join(app, "link")), "foo")
+
+    def test_gzip_payload(self):
+        """A gzipped cpio payload should be unpacked."""
+        self.write_payload(gzip.compress(cpio_archive()))
+        self.assertEqual(unpack_payload(self.payload, self.destination), 5)
+        self.assert_unpacked()
+
+    def test_pbzx_payload_in_parallel(self):
+        """A pbzx payload should be unpacked with chunks split across workers."""
+        self.write_payload(pbzx(cpio_archive(), 16384))
+        unpack_payload(self.payload, self.destination, workers=2)
+        self.assert_unpacked()
+
+    def test_path_outside_destination(self):
+        """Entries that would escape the destination should be refused."""
+        self.write_payload(
+            cpio_entry("../escape", stat.S_IFREG | 0o644, b"x")
+            + cpio_entry("TRAILER!!!", 0)
+        )
+        with self.assertRaises(PayloadError):
+            unpack_payload(self.payload, self.destination)
+
+    def test_nothing_written_through_symlinks(self):
+        """Symlinks out of the destination should be kept, but entries
+        extracted through them refused."""
+        outside = os.path.join(self.tmp_dir.name, "outside")
+        os.mkdir(outside)
+        self.write_payload(
+            cpio_entry("./link", stat.S_IFLNK | 0o755, outside.encode())
+            + cpio_entry("./link/escape", stat.S_IFREG | 0o644, b"x")
+            + cpio_entry("TRAILER!!!", 0)
+        )
+        with self.assertRaises(PayloadError):
+            unpack_payload(self.payload, self.destination)
+        self.assertEqual(os.readlink(os.path.join(self.destination, "link")), outside)
+        self.assertEqual(os.listdir(outside), [])
+
+    def test_truncated_payload(self):
+        """A truncated payload should raise PayloadError."""
+        self.write_payload(cpio_archive()[:1000])
+        with self.assertRaises(PayloadError):
+            unpack_payload(self.payload, self.destination)
+
+
+if __name__ == "__main__":
+    unittest.main()
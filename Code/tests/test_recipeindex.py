@@ -0,0 +1,115 @@
+#!/usr/local/autopkg/python
+
+import os
+import plistlib
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from autopkglib.recipeindex import RecipeIndex
+
+
+class TestRecipeIndex(unittest.TestCase):
+    """Test class for the on-disk recipe index."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.recipe_dir = os.path.join(self.tmp_dir.name, "recipes")
+        os.makedirs(os.path.join(self.recipe_dir, "Vendor"))
+        self.index_path = os.path.join(self.tmp_dir.name, "recipe_index.json")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_recipe(self, relative_path, identifier, **extra):
+        """Write a minimal recipe and return its path."""
+        path = os.path.join(self.recipe_dir, relative_path)
+        recipe = {"Identifier": identifier, "Input": {}, "Process": []}
+        recipe.update(extra)
+        with open(path, "wb") as f:
+            plistlib.dump(recipe, f)
+        return path
+
+    def test_find_by_identifier_prefers_top_level(self):
+        """Top-level recipes should win over ones in subdirectories."""
+        self.write_recipe("Vendor/Foo.download.recipe", "com.example.foo")
+        top_level = self.write_recipe("Foo.download.recipe", "com.example.foo")
+        index = RecipeIndex(self.index_path)
+        result = index.find_recipe_by_identifier("com.example.foo", [self.recipe_dir])
+        self.assertEqual(result, top_level)
+
+    def test_find_by_name(self):
+        """Recipes should be found by file name minus the extension."""
+        path = self.write_recipe("Vendor/Foo.munki.recipe", "com.example.foo.munki")
+        index = RecipeIndex(self.index_path)
+        self.assertEqual(
+            index.find_recipes_by_name("Foo.munki", self.recipe_dir), [path]
+        )
+        self.assertEqual(index.find_recipes_by_name("Bar.munki", self.recipe_dir), [])
+
+    def test_records_parent_and_processors(self):
+        """Index entries should include the parent and the processors used."""
+        path = self.write_recipe(
+            "Foo.munki.recipe",
+            "com.example.foo.munki",
+            ParentRecipe="com.example.foo",
+            Process=[{"Processor": "MunkiImporter"}],
+        )
+        index = RecipeIndex(self.index_path)
+        entry = dict(index.recipe_entries([self.recipe_dir]))[path]
+        self.assertEqual(entry["parent"], "com.example.foo")
+        self.assertEqual(entry["processors"], ["MunkiImporter"])
+
+    def test_index_is_reused_without_parsing(self):
+        """A second index instance should not reparse unchanged recipes."""
+        self.write_recipe("Foo.download.recipe", "com.example.foo")
+        RecipeIndex(self.index_path).find_recipe_by_identifier(
+            "com.example.foo", [self.recipe_dir]
+        )
+        self.assertTrue(os.path.exists(self.index_path))
+        with patch("autopkglib.recipeindex.plistlib.load") as mock_load:
+            result = RecipeIndex(self.index_path).find_recipe_by_identifier(
+                "com.example.foo", [self.recipe_dir]
+            )
+            mock_load.assert_not_called()
+        self.assertIsNotNone(result)
+
+    def test_edited_recipe_is_reindexed(self):
+        """Changing a recipe file in place should update its entry."""
+        path = self.write_recipe("Foo.download.recipe", "com.example.foo")
+        RecipeIndex(self.index_path).find_recipe_by_identifier(
+            "com.example.foo", [self.recipe_dir]
+        )
+        self.write_recipe("Foo.download.recipe", "com.example.renamed")
+        # make sure the mtime moves even on coarse-grained filesystems
+        os.utime(path, ns=(0, 0))
+        index = RecipeIndex(self.index_path)
+        self.assertEqual(
+            index.find_recipe_by_identifier("com.example.renamed", [self.recipe_dir]),
+            path,
+        )
+        self.assertIsNone(
+            index.find_recipe_by_identifier("com.example.foo", [self.recipe_dir])
+        )
+
+    def test_edited_recipe_in_git_working_copy_is_reindexed(self):
+        """Uncommitted edits in a git working copy should be picked up while
+        its HEAD stays the same."""
+        os.makedirs(os.path.join(self.recipe_dir, ".git"))
+        with open(os.path.join(self.recipe_dir, ".git", "HEAD"), "w") as f:
+            f.write("0123456789abcdef0123456789abcdef01234567\n")
+        path = self.write_recipe("Foo.download.recipe", "com.example.foo")
+        RecipeIndex(self.index_path).find_recipe_by_identifier(
+            "com.example.foo", [self.recipe_dir]
+        )
+        self.write_recipe("Foo.download.recipe", "com.example.renamed")
+        os.utime(path, ns=(0, 0))
+        index = RecipeIndex(self.index_path)
+        self.assertEqual(
+            index.find_recipe_by_identifier("com.example.renamed", [self.recipe_dir]),
+            path,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+#!/usr/local/autopkg/python
+
+import datetime
+import os
+import plistlib
+import tempfile
+import unittest
+
+from autopkglib.runjournal import (
+    RunJournal,
+    export_plist,
+    journal_results,
+    read_journal,
+)
+
+
+class TestRunJournal(unittest.TestCase):
+    """Test class for the run results journal."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "autopkg_results.jsonl")
+        self.results = [
+            {"Recipe input": {"NAME": "Foo"}},
+            {
+                "Processor": "URLDownloader",
+                "Input": {"url": "https://example.com/foo.dmg"},
+                "Output": {
+                    "last_modified": datetime.datetime(2020, 1, 2, 3, 4, 5),
+                    "icon": b"\x89PNG",
+                },
+            },
+        ]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_round_trip(self):
+        """Results should read back with their plist types, and export to
+        the autopkg_results.plist format."""
+        journal = RunJournal(self.path)
+        journal.add_recipe("Foo.download.recipe", self.results)
+        journal.add_recipe("Bar.download.recipe", [])
+        journal.close()
+        self.assertEqual(list(journal_results(self.path)), [self.results, []])
+        plist_path = os.path.join(self.tmp_dir.name, "autopkg_results.plist")
+        export_plist(self.path, plist_path)
+        with open(plist_path, "rb") as f:
+            self.assertEqual(plistlib.load(f), [self.results, []])
+
+    def test_readable_while_writing(self):
+        """Records should be readable before the journal is closed, and a
+        partly written record should be skipped."""
+        journal = RunJournal(self.path, fsync_interval=60)
+        journal.add_recipe("Foo.download.recipe", self.results)
+        with open(self.path, "ab") as f:
+            f.write(b'{"type":"recipe","recipe":"Bar')
+        records = list(read_journal(self.path))
+        self.assertEqual([record["type"] for record in records], ["run", "recipe"])
+        self.assertEqual(records[1]["recipe"], "Foo.download.recipe")
+        journal.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
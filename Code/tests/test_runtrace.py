@@ -0,0 +1,108 @@
+#!/usr/local/autopkg/python
+
+import concurrent.futures
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from autopkglib.runtrace import (
+    Measurement,
+    add_network_bytes,
+    carry_counters,
+    recipe_trace_events,
+    write_trace,
+)
+
+
+class TestRunTrace(unittest.TestCase):
+    """Test class for recipe step resource usage and trace events."""
+
+    def test_measurement(self):
+        """A Measurement should count subprocesses and network bytes used
+        inside it, but not outside it."""
+        add_network_bytes(100)
+        with Measurement() as usage:
+            subprocess.run([sys.executable, "-c", "pass"], check=True)
+            add_network_bytes(1024)
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        self.assertEqual(usage["subprocesses"], 1)
+        self.assertEqual(usage["network_bytes"], 1024)
+        self.assertEqual(usage["pid"], os.getpid())
+        self.assertGreater(usage["wall_time"], 0)
+        self.assertGreater(usage["cpu_time"], 0)
+
+    def test_counters_carried_into_worker_threads(self):
+        """Work handed to other threads through carry_counters() should count
+        against the Measurement in the calling thread."""
+
+        def work():
+            subprocess.run([sys.executable, "-c", "pass"], check=True)
+            add_network_bytes(1024)
+
+        with Measurement() as usage:
+            with concurrent.futures.ThreadPoolExecutor(4) as executor:
+                futures = [executor.submit(carry_counters(work)) for _ in range(4)]
+                futures.append(executor.submit(work))
+                for future in futures:
+                    future.result()
+        self.assertEqual(usage["subprocesses"], 4)
+        self.assertEqual(usage["network_bytes"], 4096)
+
+    def test_measurement_without_audit_hooks(self):
+        """On Python 3.7, without audit hooks or native thread ids, a
+        Measurement should still work, leaving out the subprocess count."""
+        script = (
+            "import subprocess, sys, threading\n"
+            "del sys.addaudithook, threading.get_native_id\n"
+            "from autopkglib.runtrace import Measurement, add_network_bytes\n"
+            "with Measurement() as usage:\n"
+            "    subprocess.run([sys.executable, '-c', 'pass'], check=True)\n"
+            "    add_network_bytes(1024)\n"
+            "print(sorted(usage))\n"
+            "print(usage['network_bytes'], usage['thread'] == threading.get_ident())\n"
+        )
+        env = dict(os.environ, PYTHONPATH=os.path.abspath("Code"))
+        output = subprocess.run(
+            [sys.executable, "-c", script],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.splitlines()[-2:]
+        self.assertNotIn("'subprocesses'", output[0])
+        self.assertIn("'wall_time'", output[0])
+        self.assertEqual(output[1], "1024 True")
+
+    def test_trace_events(self):
+        """Each recipe and step should become a complete trace event."""
+        with Measurement() as step:
+            pass
+        recipe = Measurement().stop()
+        recipe_resources = [
+            {
+                "recipe": "Foo.download.recipe",
+                "resources": recipe,
+                "steps": [{"processor": "URLDownloader", **step}],
+            }
+        ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "trace.json")
+            write_trace(path, recipe_trace_events(recipe_resources))
+            with open(path) as f:
+                events = json.load(f)["traceEvents"]
+        self.assertEqual(
+            [(event["name"], event["cat"], event["ph"]) for event in events],
+            [
+                ("Foo.download.recipe", "recipe", "X"),
+                ("URLDownloader", "processor", "X"),
+            ],
+        )
+        self.assertEqual(events[1]["tid"], step["thread"])
+        self.assertIn("cpu_time", events[1]["args"])
+
+
+if __name__ == "__main__":
+    unittest.main()
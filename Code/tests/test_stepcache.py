@@ -0,0 +1,91 @@
+#!/usr/local/autopkg/python
+
+import importlib
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from unittest.mock import patch
+
+from autopkglib.stepcache import StepCache
+
+# autopkglib.Unarchiver is the processor class, not its module
+unarchiver = importlib.import_module("autopkglib.Unarchiver")
+
+
+class TestStepCache(unittest.TestCase):
+    """Test class for memoized processor steps."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp_dir.name, "steps")
+        self.archive = os.path.join(self.tmp_dir.name, "Foo.zip")
+        self.destination = os.path.join(self.tmp_dir.name, "Foo")
+        self.write_archive(b"foo")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_archive(self, content):
+        """Write a zip holding Foo.app/Contents/foo."""
+        with zipfile.ZipFile(self.archive, "w") as zip_file:
+            zip_file.writestr("Foo.app/Contents/foo", content)
+
+    def unarchive(self):
+        """Run Unarchiver with the step cache, returning how many times it
+        actually extracted."""
+        env = {
+            "archive_path": self.archive,
+            "destination_path": self.destination,
+            "purge_destination": True,
+            "unarchive_engine": "native",
+            "STEP_CACHE_DIR": self.cache_dir,
+            "CACHE_DIR": self.tmp_dir.name,
+            "RECIPE_CACHE_DIR": self.tmp_dir.name,
+            "NAME": "Foo",
+        }
+        with patch.object(unarchiver, "extract", wraps=unarchiver.extract) as extract:
+            unarchiver.Unarchiver(env).process()
+        return extract.call_count
+
+    def read_output(self):
+        with open(os.path.join(self.destination, "Foo.app/Contents/foo"), "rb") as f:
+            return f.read()
+
+    def test_restores_outputs(self):
+        """An unchanged archive should be restored rather than extracted
+        again, and a changed one extracted."""
+        self.assertEqual(self.unarchive(), 1)
+        shutil.rmtree(self.destination)
+        self.assertEqual(self.unarchive(), 0)
+        self.assertEqual(self.read_output(), b"foo")
+        self.write_archive(b"bar")
+        self.assertEqual(self.unarchive(), 1)
+        self.assertEqual(self.read_output(), b"bar")
+
+    def test_changed_entry_not_restored(self):
+        """An entry whose files were changed through a hard link shouldn't be
+        restored."""
+        self.unarchive()
+        with open(os.path.join(self.destination, "Foo.app/Contents/foo"), "ab") as f:
+            f.write(b"changed")
+        self.assertEqual(self.unarchive(), 1)
+        self.assertEqual(self.read_output(), b"foo")
+
+    def test_least_recently_used_are_evicted(self):
+        """The cache should evict the oldest entries beyond max_size."""
+        cache = StepCache(self.cache_dir, max_size=10)
+        for key, content in (("aa", b"0123456789"), ("bb", b"abcdefghij")):
+            path = os.path.join(self.tmp_dir.name, key)
+            with open(path, "wb") as f:
+                f.write(content)
+            cache.add(key, [path], {"pathname": path})
+        self.assertIsNone(cache.restore("aa"))
+        self.assertEqual(
+            cache.restore("bb"), {"pathname": os.path.join(self.tmp_dir.name, "bb")}
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
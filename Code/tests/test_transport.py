@@ -0,0 +1,241 @@
+#!/usr/local/autopkg/python
+
+import gzip
+import hashlib
+import os
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+from autopkglib.transport import (
+    CURLE_HTTP_RETURNED_ERROR,
+    CURLE_RANGE_ERROR,
+    CurlTransport,
+    NativeTransport,
+    UnsupportedCurlCommand,
+    parse_curl_cmd,
+)
+
+BODY = b"Hello, autopkg!\n"
+ETAG = '"abc123"'
+
+
+class TestRequestHandler(BaseHTTPRequestHandler):
+    """Serves a handful of canned responses."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body, status=200, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        if self.path == "/file":
+            if self.headers.get("If-None-Match") == ETAG:
+                self.send_body(b"", status=304, headers={"ETag": ETAG})
+            else:
+                self.send_body(BODY, headers={"ETag": ETAG})
+        elif self.path == "/redirect":
+            self.send_body(b"", status=302, headers={"Location": "/file"})
+        elif self.path == "/gzip":
+            self.send_body(gzip.compress(BODY), headers={"Content-Encoding": "gzip"})
+        elif self.path == "/range" and self.headers.get("Range"):
+            first_byte = int(self.headers["Range"][len("bytes=") :].rstrip("-"))
+            self.send_body(
+                BODY[first_byte:],
+                status=206,
+                headers={"Content-Range": f"bytes {first_byte}-/{len(BODY)}"},
+            )
+        elif self.path == "/echo":
+            self.send_body(self.headers.get("X-Test", "").encode())
+        else:
+            self.send_body(b"Not found", status=404)
+
+
+class TestNativeTransport(unittest.TestCase):
+    """Test class for the pooled native transport."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), TestRequestHandler)
+        cls.server.daemon_threads = True
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.transport = NativeTransport()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.transport.pool.close()
+        self.tmp_dir.cleanup()
+
+    def run_curl(self, *args, text=True):
+        return self.transport.execute(["/usr/bin/curl", *args], text)
+
+    def test_body_to_stdout(self):
+        """The response body should be returned like curl's stdout."""
+        stdout, stderr, retcode = self.run_curl(
+            "--compressed", "--location", f"{self.base_url}/file"
+        )
+        self.assertEqual((stdout, stderr, retcode), (BODY.decode(), "", 0))
+
+    def test_request_headers_are_sent(self):
+        """--header values should be sent with the request."""
+        stdout, _, _ = self.run_curl(
+            "--header", "X-Test: value", f"{self.base_url}/echo"
+        )
+        self.assertEqual(stdout, "value")
+
+    def test_redirect_headers_are_dumped(self):
+        """Every hop of a redirect should be in the dumped headers, like curl."""
+        output = os.path.join(self.tmp_dir.name, "file")
+        stdout, _, retcode = self.run_curl(
+            "--dump-header",
+            "-",
+            "--location",
+            "--output",
+            output,
+            "--url",
+            f"{self.base_url}/redirect",
+        )
+        self.assertEqual(retcode, 0)
+        status_lines = [
+            line for line in stdout.splitlines() if line.startswith("HTTP/")
+        ]
+        self.assertEqual(status_lines, ["HTTP/1.1 302 Found", "HTTP/1.1 200 OK"])
+        self.assertIn(f"ETag: {ETAG}", stdout)
+        with open(output, "rb") as f:
+            self.assertEqual(f.read(), BODY)
+
+    def test_not_modified_leaves_output_alone(self):
+        """A 304 response should not touch the output file."""
+        output = os.path.join(self.tmp_dir.name, "file")
+        with open(output, "wb") as f:
+            f.write(b"cached")
+        stdout, _, retcode = self.run_curl(
+            "--dump-header",
+            "-",
+            "--header",
+            f"If-None-Match: {ETAG}",
+            "--output",
+            output,
+            f"{self.base_url}/file",
+        )
+        self.assertEqual(retcode, 0)
+        self.assertIn("304 Not Modified", stdout)
+        with open(output, "rb") as f:
+            self.assertEqual(f.read(), b"cached")
+
+    def test_fail_returns_curl_exit_code(self):
+        """--fail should turn HTTP errors into curl's exit code 22."""
+        _, stderr, retcode = self.run_curl("--fail", f"{self.base_url}/missing")
+        self.assertEqual(retcode, CURLE_HTTP_RETURNED_ERROR)
+        self.assertTrue(stderr.startswith("curl: (22)"))
+
+    def test_compressed_body_is_decoded(self):
+        """--compressed should decode gzip content."""
+        stdout, _, _ = self.run_curl(
+            "--compressed", f"{self.base_url}/gzip", text=False
+        )
+        self.assertEqual(stdout, BODY)
+
+    def test_connections_are_reused(self):
+        """Requests to the same host should share one connection."""
+        for _ in range(3):
+            self.run_curl("--location", f"{self.base_url}/redirect")
+        self.assertEqual(self.transport.pool.connections_opened, 1)
+
+    def test_digests_calculated_while_downloading(self):
+        """Both transports should hash the body written to --output."""
+        expected = {
+            "sha256": hashlib.sha256(BODY).hexdigest(),
+            "md5": hashlib.md5(BODY).hexdigest(),
+        }
+        transports = [self.transport]
+        if os.path.exists("/usr/bin/curl"):
+            transports.append(CurlTransport())
+        for transport in transports:
+            output = os.path.join(self.tmp_dir.name, transport.name)
+            digests = dict.fromkeys(expected)
+            stdout, _, retcode = transport.execute(
+                [
+                    "/usr/bin/curl",
+                    "--dump-header",
+                    "-",
+                    "--location",
+                    "--url",
+                    f"{self.base_url}/redirect",
+                    "--fail",
+                    "--output",
+                    output,
+                ],
+                True,
+                digests,
+            )
+            self.assertEqual(retcode, 0)
+            self.assertIn("HTTP/1.1 302 Found\n", stdout)
+            self.assertEqual(digests, expected)
+            with open(output, "rb") as f:
+                self.assertEqual(f.read(), BODY)
+
+    def test_continue_at_appends_to_output(self):
+        """--continue-at should append the rest of the body and fail like curl
+        if the server sends the whole body instead."""
+        output = os.path.join(self.tmp_dir.name, "file")
+        with open(output, "wb") as f:
+            f.write(BODY[:5])
+        digests = {"sha256": None}
+        _, _, retcode = self.transport.execute(
+            [
+                "/usr/bin/curl",
+                "--continue-at",
+                "5",
+                "--output",
+                output,
+                f"{self.base_url}/range",
+            ],
+            True,
+            digests,
+        )
+        self.assertEqual(retcode, 0)
+        with open(output, "rb") as f:
+            self.assertEqual(f.read(), BODY)
+        self.assertEqual(digests["sha256"], hashlib.sha256(BODY).hexdigest())
+        _, _, retcode = self.run_curl(
+            "-C", "5", "--output", output, f"{self.base_url}/file"
+        )
+        self.assertEqual(retcode, CURLE_RANGE_ERROR)
+
+    def test_unsupported_commands(self):
+        """Commands the transport can't run exactly should be refused."""
+        with self.assertRaises(UnsupportedCurlCommand):
+            parse_curl_cmd(["curl", "--netrc", "https://example.com"])
+        with self.assertRaises(UnsupportedCurlCommand):
+            parse_curl_cmd(["curl", "ftp://example.com/file"])
+        with patch.dict(os.environ, {"https_proxy": "http://proxy:3128"}):
+            with self.assertRaises(UnsupportedCurlCommand):
+                self.run_curl("https://example.com")
+
+
+if __name__ == "__main__":
+    unittest.main()
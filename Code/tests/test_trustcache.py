@@ -0,0 +1,75 @@
+#!/usr/local/autopkg/python
+
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+from autopkglib.trustcache import TrustCache, fingerprint
+
+
+class TestTrustCache(unittest.TestCase):
+    """Test class for cached trust verification results."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.audit_log = os.path.join(self.tmp_dir.name, "trust_audit.log")
+        self.cache = TrustCache(
+            os.path.join(self.tmp_dir.name, "trust_cache.sqlite"), self.audit_log
+        )
+        self.override = os.path.join(self.tmp_dir.name, "Foo.munki.recipe")
+        self.parent = os.path.join(self.tmp_dir.name, "Foo.download.recipe")
+        for path in (self.override, self.parent):
+            with open(path, "w") as f:
+                f.write("recipe")
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmp_dir.cleanup()
+
+    def fingerprint(self):
+        """Returns the fingerprint of the override and its parent."""
+        return fingerprint([self.override, self.parent], {"trust_info": {}})
+
+    def audit_events(self):
+        """Returns the events written to the audit log."""
+        with open(self.audit_log) as f:
+            return [line.split("\t")[1] for line in f]
+
+    def test_verified_until_a_file_changes(self):
+        """A passed verification should stand until a parent recipe changes."""
+        self.cache.record(self.override, self.fingerprint(), passed=True)
+        self.assertTrue(self.cache.is_verified(self.override, self.fingerprint()))
+        with open(self.parent, "w") as f:
+            f.write("changed")
+        self.assertFalse(self.cache.is_verified(self.override, self.fingerprint()))
+        self.assertEqual(self.audit_events(), ["verified", "cache-hit", "cache-miss"])
+
+    def test_failure_is_not_cached(self):
+        """A failed verification should forget an earlier pass."""
+        self.cache.record(self.override, self.fingerprint(), passed=True)
+        self.cache.record(self.override, self.fingerprint(), passed=False)
+        self.assertFalse(self.cache.is_verified(self.override, self.fingerprint()))
+
+    def test_shared_between_threads(self):
+        """A cache should answer lookups from threads other than the one it
+        was opened in, as 'autopkg run --pipeline' check threads do."""
+        self.cache.record(self.override, self.fingerprint(), passed=True)
+        results = []
+
+        def lookup():
+            results.append(self.cache.is_verified(self.override, self.fingerprint()))
+
+        with patch("autopkglib.trustcache.log_err") as log_err:
+            threads = [threading.Thread(target=lookup) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(results, [True] * 4)
+        log_err.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
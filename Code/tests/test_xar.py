@@ -0,0 +1,127 @@
+#!/usr/local/autopkg/python
+
+import hashlib
+import os
+import stat
+import struct
+import tempfile
+import unittest
+import zlib
+from xml.sax.saxutils import escape
+
+from autopkglib.xar import XarArchive, XarError
+
+PACKAGEINFO = b'<pkg-info identifier="com.example.foo" version="1.0"/>'
+# incompressible, so that it's read from the heap in several chunks
+PAYLOAD = b"".join(hashlib.sha256(bytes([i])).digest() for i in range(256))
+
+
+def write_xar(path, files):
+    """Write a xar archive like xar(1) does. files is a list of (name,
+    content) tuples; a name ending in / is a directory whose members follow
+    it, until a None entry closes it."""
+    heap = bytearray(hashlib.sha1().digest_size)
+    toc = []
+    file_id = 0
+    for name, content in files:
+        if name is None:
+            toc.append("</file>")
+            continue
+        file_id += 1
+        if name.endswith("/"):
+            toc.append(
+                f'<file id="{file_id}"><name>{escape(name[:-1])}</name>'
+                "<type>directory</type><mode>0755</mode>"
+            )
+            continue
+        archived = zlib.compress(content)
+        toc.append(
+            f'<file id="{file_id}"><name>{escape(name)}</name><type>file</type>'
+            f"<mode>0640</mode><data><offset>{len(heap)}</offset>"
+            f"<length>{len(archived)}</length><size>{len(content)}</size>"
+            '<encoding style="application/x-gzip"/>'
+            '<extracted-checksum style="sha1">'
+            f"{hashlib.sha1(content).hexdigest()}</extracted-checksum>"
+            "</data></file>"
+        )
+        heap += archived
+    toc_xml = (
+        '<?xml version="1.0" encoding="UTF-8"?><xar><toc>'
+        '<checksum style="sha1"><offset>0</offset><size>20</size></checksum>'
+        f"{''.join(toc)}</toc></xar>"
+    ).encode()
+    compressed_toc = zlib.compress(toc_xml)
+    heap[:20] = hashlib.sha1(compressed_toc).digest()
+    header = struct.pack(
+        ">4sHHQQI", b"xar!", 28, 1, len(compressed_toc), len(toc_xml), 1
+    )
+    with open(path, "wb") as f:
+        f.write(header + compressed_toc + heap)
+
+
+class TestXarArchive(unittest.TestCase):
+    """Test class for the xar archive reader."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.pkg = os.path.join(self.tmp_dir.name, "Foo.pkg")
+        write_xar(
+            self.pkg,
+            [
+                ("Distribution", b"<installer-gui-script/>"),
+                ("Foo.pkg/", None),
+                ("PackageInfo", PACKAGEINFO),
+                ("Payload", PAYLOAD),
+                (None, None),
+            ],
+        )
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_read_member(self):
+        """Members should be read by path without extracting anything."""
+        with XarArchive(self.pkg) as archive:
+            self.assertEqual(
+                archive.names(),
+                ["Distribution", "Foo.pkg", "Foo.pkg/PackageInfo", "Foo.pkg/Payload"],
+            )
+            self.assertEqual(archive.read("Foo.pkg/PackageInfo"), PACKAGEINFO)
+            chunks = list(archive.iter_data("Foo.pkg/Payload", chunk_size=100))
+            self.assertGreater(len(chunks), 1)
+            self.assertEqual(b"".join(chunks), PAYLOAD)
+
+    def test_extractall_with_exclude(self):
+        """extractall should skip excluded members and set modes."""
+        destination = os.path.join(self.tmp_dir.name, "expanded")
+        with XarArchive(self.pkg) as archive:
+            archive.extractall(destination, exclude="Payload")
+        packageinfo = os.path.join(destination, "Foo.pkg", "PackageInfo")
+        with open(packageinfo, "rb") as f:
+            self.assertEqual(f.read(), PACKAGEINFO)
+        self.assertEqual(stat.S_IMODE(os.stat(packageinfo).st_mode), 0o640)
+        self.assertFalse(os.path.exists(os.path.join(destination, "Foo.pkg/Payload")))
+
+    def test_not_a_xar_archive(self):
+        """Reading something that isn't a xar archive should raise XarError."""
+        with open(self.pkg, "wb") as f:
+            f.write(b"PK\x03\x04 not a xar archive at all")
+        with self.assertRaises(XarError):
+            XarArchive(self.pkg)
+
+    def test_corrupt_member(self):
+        """A member with corrupt data should raise XarError."""
+        with open(self.pkg, "rb") as f:
+            data = bytearray(f.read())
+        offset = data.index(zlib.compress(PAYLOAD)) + 10
+        data[offset] ^= 0xFF
+        with open(self.pkg, "wb") as f:
+            f.write(data)
+        with XarArchive(self.pkg) as archive:
+            self.assertEqual(archive.read("Foo.pkg/PackageInfo"), PACKAGEINFO)
+            with self.assertRaises(XarError):
+                archive.read("Foo.pkg/Payload")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+#!/usr/local/autopkg/python
+"""Compare ways of unpacking a package payload.
+
+Builds a pbzx payload of random-ish files like the ones in large Apple and
+Adobe packages, then times unpacking it with the native extractor on one
+process and on every CPU. The same archive is also gzipped, like
+Archive.pax.gz and older Payload files, and timed with the native extractor and
+with /usr/bin/ditto -x -z (what PkgPayloadUnpacker used to run) when it's
+available."""
+
+import argparse
+import gzip
+import lzma
+import os
+import shutil
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "Code"))
+
+from autopkglib.payload import unpack_payload  # noqa: E402
+
+PBZX_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def cpio_entry(name, mode, data=b"", ino=0):
+    """Returns one entry of an odc cpio archive"""
+    name = name.encode() + b"\0"
+    header = (
+        f"070707{0:06o}{ino:06o}{mode:06o}{0:06o}{0:06o}{1:06o}{0:06o}"
+        f"{int(time.time()):011o}{len(name):06o}{len(data):011o}"
+    )
+    return header.encode() + name + data
+
+
+def make_cpio(file_count, file_size):
+    """Returns a cpio archive of file_count files that compress about as well
+    as application binaries do"""
+    entries = [cpio_entry(".", stat.S_IFDIR | 0o755, ino=1)]
+    for index in range(file_count):
+        data = (os.urandom(file_size // 4) + bytes(file_size // 4)) * 2
+        entries.append(
+            cpio_entry(f"./file{index}", stat.S_IFREG | 0o644, data, ino=index + 2)
+        )
+    entries.append(cpio_entry("TRAILER!!!", 0))
+    return b"".join(entries)
+
+
+def make_pbzx(data):
+    """Returns data as a pbzx stream"""
+    offsets = range(0, len(data), PBZX_CHUNK_SIZE)
+    stream = [b"pbzx", struct.pack(">Q", PBZX_CHUNK_SIZE | 0x01000000)]
+    for offset in offsets:
+        chunk = lzma.compress(data[offset : offset + PBZX_CHUNK_SIZE], preset=6)
+        more = 0 if offset == offsets[-1] else 0x01000000
+        stream.append(struct.pack(">QQ", PBZX_CHUNK_SIZE | more, len(chunk)))
+        stream.append(chunk)
+    return b"".join(stream)
+
+
+def timed(label, function, destination, rounds):
+    """Run function rounds times into a fresh destination and print the best
+    time"""
+    best = None
+    for _ in range(rounds):
+        shutil.rmtree(destination, ignore_errors=True)
+        os.makedirs(destination)
+        start = time.perf_counter()
+        function(destination)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{label:>24}: {best:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=64, help="Number of files.")
+    parser.add_argument(
+        "--file-size", type=int, default=4 * 1024 * 1024, help="Bytes per file."
+    )
+    parser.add_argument(
+        "--rounds", type=int, default=3, help="Best of this many rounds."
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cpio = make_cpio(args.files, args.file_size)
+        pbzx_payload = os.path.join(tmp_dir, "Payload")
+        with open(pbzx_payload, "wb") as f:
+            f.write(make_pbzx(cpio))
+        gzip_payload = os.path.join(tmp_dir, "Archive.pax.gz")
+        with open(gzip_payload, "wb") as f:
+            f.write(gzip.compress(cpio))
+        destination = os.path.join(tmp_dir, "root")
+        print(f"{args.files} files, {len(cpio) // 2 ** 20} MB uncompressed")
+
+        timed(
+            "native pbzx, 1 process",
+            lambda dest: unpack_payload(pbzx_payload, dest, workers=1),
+            destination,
+            args.rounds,
+        )
+        timed(
+            f"native pbzx, {os.cpu_count()} processes",
+            lambda dest: unpack_payload(pbzx_payload, dest),
+            destination,
+            args.rounds,
+        )
+        timed(
+            "native gzip",
+            lambda dest: unpack_payload(gzip_payload, dest),
+            destination,
+            args.rounds,
+        )
+        if os.path.exists("/usr/bin/ditto"):
+            timed(
+                "ditto gzip",
+                lambda dest: subprocess.run(
+                    ["/usr/bin/ditto", "-x", "-z", gzip_payload, dest], check=True
+                ),
+                destination,
+                args.rounds,
+            )
+
+
+if __name__ == "__main__":
+    main()
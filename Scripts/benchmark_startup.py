@@ -0,0 +1,88 @@
+#!/usr/local/autopkg/python
+"""Time how long importing autopkglib takes, and fail over a budget.
+
+Runs python -X importtime -c "import autopkglib" several times in fresh
+interpreters, prints the best cumulative import time and the slowest modules
+it pulled in, and exits with an error if the best time is over --budget-ms or
+if any processor module was imported. Processors are meant to be imported
+only when a recipe uses them."""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Code")
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def import_times(python):
+    """Returns a list of (module, self microseconds, cumulative microseconds,
+    depth) for one import of autopkglib"""
+    result = subprocess.run(
+        [python, "-X", "importtime", "-c", "import autopkglib"],
+        cwd=CODE_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            times.append((module, int(self_us), int(cumulative_us), len(indent)))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--python", default=sys.executable, help="Python interpreter to time."
+    )
+    parser.add_argument(
+        "--rounds", type=int, default=5, help="Best of this many rounds."
+    )
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        help="Fail if importing autopkglib takes longer than this.",
+    )
+    parser.add_argument(
+        "--top", type=int, default=10, help="Number of slowest modules to show."
+    )
+    args = parser.parse_args()
+
+    best = None
+    for _ in range(args.rounds):
+        times = import_times(args.python)
+        total = max(
+            cumulative for module, _, cumulative, _ in times if module == "autopkglib"
+        )
+        if best is None or total < best[0]:
+            best = (total, times)
+    total, times = best
+
+    print(f"import autopkglib: {total / 1000:.1f}ms")
+    slowest = sorted(times, key=lambda t: t[1], reverse=True)[: args.top]
+    for module, self_us, _, _ in slowest:
+        print(f"{self_us / 1000:>10.1f}ms  {module}")
+
+    failed = False
+    processors = [
+        module
+        for module, _, _, _ in times
+        if module.startswith("autopkglib.") and module.split(".")[1][:1].isupper()
+    ]
+    if processors:
+        print(f"Processors imported at startup: {', '.join(processors)}")
+        failed = True
+    if args.budget_ms is not None and total / 1000 > args.budget_ms:
+        print(f"Over the budget of {args.budget_ms:.1f}ms")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+#!/usr/local/autopkg/python
+"""Microbenchmarks of recipe variable substitution.
+
+Times autopkglib.update_data() against the regular expression substitution
+it replaced, for the ways AutoPackager uses it: substituting a whole env with
+large preferences and a pkginfo Input dict (process_cli_overrides), and
+injecting a processor step's Arguments (Processor.inject). Checks that both
+give the same results before timing them."""
+
+import argparse
+import copy
+import os
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Code")
+)
+
+from autopkglib import RE_KEYREF, update_data  # noqa: E402
+
+
+def regex_update_data(a_dict, key, value):
+    """update_data() as it was before templates were compiled"""
+
+    def getdata(match):
+        return a_dict[match.group("key")]
+
+    def do_variable_substitution(item):
+        if isinstance(item, str):
+            try:
+                item = RE_KEYREF.sub(getdata, item)
+            except KeyError:
+                pass
+        elif isinstance(item, list):
+            for index in range(len(item)):
+                item[index] = do_variable_substitution(item[index])
+        elif isinstance(item, dict):
+            item_copy = item.copy()
+            for key, value in list(item.items()):
+                item_copy[key] = do_variable_substitution(value)
+            return item_copy
+        return item
+
+    a_dict[key] = do_variable_substitution(value)
+
+
+def make_env(repos):
+    """Returns an env like one AutoPackager builds: preferences with many
+    recipe repos, and a recipe Input with a long pkginfo"""
+    env = {
+        "NAME": "Firefox",
+        "version": "115.0.2",
+        "CACHE_DIR": "/Users/autopkg/Library/AutoPkg/Cache",
+        "MUNKI_REPO": "/Volumes/munki_repo",
+        "RECIPE_SEARCH_DIRS": [f"/Users/autopkg/repos/repo{i}" for i in range(repos)],
+        "RECIPE_REPOS": {
+            f"/Users/autopkg/repos/repo{i}": {
+                "URL": f"https://github.com/autopkg/repo{i}-recipes.git"
+            }
+            for i in range(repos)
+        },
+        "MUNKI_REPO_PLUGIN": "FileRepo",
+    }
+    env["pkginfo"] = {
+        "catalogs": ["testing"],
+        "description": "A free web browser. " * 200,
+        "display_name": "%NAME%",
+        "name": "%NAME%",
+        "unattended_install": True,
+        "installs": [
+            {
+                "CFBundleShortVersionString": "%version%",
+                "path": f"/Applications/%NAME%.app/Contents/Helper{i}.app",
+                "type": "application",
+            }
+            for i in range(50)
+        ],
+    }
+    return env
+
+
+def substitute_env(update, env):
+    """What process_cli_overrides() does to the env"""
+    for key, value in list(env.items()):
+        update(env, key, value)
+
+
+def inject(update, env, arguments):
+    """What Processor.inject() does with a step's Arguments"""
+    for key, value in list(arguments.items()):
+        update(env, key, value)
+
+
+def time_benchmark(benchmark, update, setup, number):
+    """Returns the mean milliseconds benchmark(update, *setup()) takes, not
+    counting setup()"""
+    total = 0
+    for _ in range(number):
+        setup_args = setup()
+        started = time.perf_counter()
+        benchmark(update, *setup_args)
+        total += time.perf_counter() - started
+    return total / number * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--repos", type=int, default=200, help="Recipe repos in the preferences."
+    )
+    parser.add_argument(
+        "--number", type=int, default=50, help="Runs of each benchmark per round."
+    )
+    parser.add_argument(
+        "--rounds", type=int, default=5, help="Best of this many rounds."
+    )
+    args = parser.parse_args()
+
+    arguments = {
+        "pkg_path": "%CACHE_DIR%/%NAME%-%version%.pkg",
+        "repo_subdirectory": "apps/%NAME%",
+        "additional_makepkginfo_options": ["--displayname", "%NAME%"],
+    }
+    old_env = make_env(args.repos)
+    new_env = make_env(args.repos)
+    substitute_env(regex_update_data, old_env)
+    substitute_env(update_data, new_env)
+    inject(regex_update_data, old_env, copy.deepcopy(arguments))
+    inject(update_data, new_env, copy.deepcopy(arguments))
+    if old_env != new_env:
+        sys.exit("update_data() and the regex substitution gave different results")
+
+    benchmarks = {
+        "process_cli_overrides": (lambda: (make_env(args.repos),), substitute_env,),
+        "inject": (lambda: (make_env(args.repos), copy.deepcopy(arguments)), inject,),
+    }
+    print(f"{'benchmark':<24}{'regex':>12}{'compiled':>12}{'speedup':>10}")
+    for name, (setup, benchmark) in benchmarks.items():
+        timings = []
+        for update in (regex_update_data, update_data):
+            timings.append(
+                min(
+                    time_benchmark(benchmark, update, setup, args.number)
+                    for _ in range(args.rounds)
+                )
+            )
+        old, new = timings
+        print(f"{name:<24}{old:>10.3f}ms{new:>10.3f}ms{old / new:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!/usr/local/autopkg/python
+"""Compare the curl and native URL transports against a local HTTP server.
+
+Runs the same curl command lines URLDownloader and URLTextSearcher build
+(a check request with --head and --dump-header, a full download to a file and
+a text fetch) through each transport and prints the wall time."""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "Code"))
+
+from autopkglib.transport import get_transport  # noqa: E402
+
+
+class BenchmarkRequestHandler(BaseHTTPRequestHandler):
+    """Serves a payload of the requested size with an ETag."""
+
+    protocol_version = "HTTP/1.1"
+    payload = b""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.payload)))
+        self.send_header("ETag", '"benchmark"')
+        self.send_header("Last-Modified", "Mon, 01 Jan 2024 00:00:00 GMT")
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(self.payload)
+
+
+def run(transport, curl_cmds, rounds):
+    """Returns the time taken to run every command rounds times"""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for curl_cmd, text in curl_cmds:
+            _, stderr, retcode = transport.execute(curl_cmd, text)
+            if retcode:
+                raise SystemExit(f"{transport.name} failed: {stderr}")
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--rounds", type=int, default=50, help="Number of rounds to run."
+    )
+    parser.add_argument(
+        "--size", type=int, default=1024 * 1024, help="Payload size in bytes."
+    )
+    parser.add_argument("--curl", default="/usr/bin/curl", help="Path to curl.")
+    args = parser.parse_args()
+
+    BenchmarkRequestHandler.payload = os.urandom(args.size)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), BenchmarkRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/payload"
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output = os.path.join(tmp_dir, "payload")
+        base = [args.curl, "--compressed", "--location"]
+        curl_cmds = [
+            (base + ["--head", "--dump-header", "-", "--url", url], True),
+            (
+                base
+                + ["--silent", "--show-error", "--no-buffer", "--dump-header", "-"]
+                + ["--speed-time", "30", "--url", url, "--fail", "--output", output],
+                True,
+            ),
+            (base + ["--header", "Accept: */*", url], False),
+        ]
+        print(f"{args.rounds} rounds of {len(curl_cmds)} requests, {args.size} bytes")
+        for name in ("curl", "native"):
+            elapsed = run(get_transport(name), curl_cmds, args.rounds)
+            per_request = elapsed / (args.rounds * len(curl_cmds)) * 1000
+            print(f"{name:>8}: {elapsed:.2f}s ({per_request:.2f} ms/request)")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
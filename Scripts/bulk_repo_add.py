@@ -73,9 +73,11 @@ def output(quiet, msg):
         print(msg)
 
 
-def repo_add(repo):
-    """Add a repo using 'repo-add'."""
-    cmd = ["/usr/local/bin/autopkg", "repo-add", repo]
+def repo_add(repos, prefs, jobs):
+    """Add repos with a single 'repo-add', which clones jobs of them at once."""
+    cmd = ["/usr/local/bin/autopkg", "repo-add", "--jobs", str(jobs), *repos]
+    if prefs:
+        cmd.extend(["--prefs", prefs])
     subprocess.run(cmd, check=False, capture_output=True)
 
 
@@ -128,6 +130,9 @@ def main():
         action="store_true",
     )
     parser.add_argument("-p", "--prefs", help=("Pass in a preferences file."))
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=8, help=("Number of repos to clone at once."),
+    )
     args = parser.parse_args()
 
     token = args.token
@@ -164,14 +169,16 @@ def main():
 
     # Ignore autopkg itself
     repos.remove("autopkg/autopkg")
+    new_repos = []
     for repo in repos:
         dirname = repo.replace("autopkg/", "")
         if dirname in repo_list and not args.ignore_existing:
             # Ignore ones we've already got
             continue
         print(dirname)
-        if args.add:
-            repo_add(dirname)
+        new_repos.append(dirname)
+    if args.add and new_repos:
+        repo_add(new_repos, args.prefs, args.jobs)
 
 
 if __name__ == "__main__":
@@ -39,7 +39,22 @@ echo "Installing AutoPkg to $INSTALL_DIR"
 echo "Creating directories"
 mkdir -m 0755 "$INSTALL_DIR"
 mkdir -m 0755 "$INSTALL_DIR/autopkglib"
+mkdir -m 0755 "$INSTALL_DIR/autopkglib/archive"
+mkdir -m 0755 "$INSTALL_DIR/autopkglib/digestcache"
+mkdir -m 0755 "$INSTALL_DIR/autopkglib/downloadstore"
+mkdir -m 0755 "$INSTALL_DIR/autopkglib/fastpath"
 mkdir -m 0755 "$INSTALL_DIR/autopkglib/github"
+mkdir -m 0755 "$INSTALL_DIR/autopkglib/gitinfo"
+mkdir -m 0755 "$INSTALL_DIR/autopkglib/metrics"
+mkdir -m 0755 "$INSTALL_DIR/autopkglib/munkiindex"
+mkdir -m 0755 "$INSTALL_DIR/autopkglib/payload"
+mkdir -m 0755 "$INSTALL_DIR/autopkglib/recipeindex"
+mkdir -m 0755 "$INSTALL_DIR/autopkglib/runjournal"
+mkdir -m 0755 "$INSTALL_DIR/autopkglib/runtrace"
+mkdir -m 0755 "$INSTALL_DIR/autopkglib/stepcache"
+mkdir -m 0755 "$INSTALL_DIR/autopkglib/transport"
+mkdir -m 0755 "$INSTALL_DIR/autopkglib/trustcache"
+mkdir -m 0755 "$INSTALL_DIR/autopkglib/xar"
 mkdir -m 0755 "$INSTALL_DIR/autopkgserver"
 
 echo "Copying executable"
@@ -48,7 +63,22 @@ ln -sf "$INSTALL_DIR/autopkg" /usr/local/bin/autopkg
 
 echo "Copying library"
 cp Code/autopkglib/*.py "$INSTALL_DIR/autopkglib/"
+cp Code/autopkglib/archive/*.py "$INSTALL_DIR/autopkglib/archive"
+cp Code/autopkglib/digestcache/*.py "$INSTALL_DIR/autopkglib/digestcache"
+cp Code/autopkglib/downloadstore/*.py "$INSTALL_DIR/autopkglib/downloadstore"
+cp Code/autopkglib/fastpath/*.py "$INSTALL_DIR/autopkglib/fastpath"
 cp Code/autopkglib/github/*.py "$INSTALL_DIR/autopkglib/github"
+cp Code/autopkglib/gitinfo/*.py "$INSTALL_DIR/autopkglib/gitinfo"
+cp Code/autopkglib/metrics/*.py "$INSTALL_DIR/autopkglib/metrics"
+cp Code/autopkglib/munkiindex/*.py "$INSTALL_DIR/autopkglib/munkiindex"
+cp Code/autopkglib/payload/*.py "$INSTALL_DIR/autopkglib/payload"
+cp Code/autopkglib/recipeindex/*.py "$INSTALL_DIR/autopkglib/recipeindex"
+cp Code/autopkglib/runjournal/*.py "$INSTALL_DIR/autopkglib/runjournal"
+cp Code/autopkglib/runtrace/*.py "$INSTALL_DIR/autopkglib/runtrace"
+cp Code/autopkglib/stepcache/*.py "$INSTALL_DIR/autopkglib/stepcache"
+cp Code/autopkglib/transport/*.py "$INSTALL_DIR/autopkglib/transport"
+cp Code/autopkglib/trustcache/*.py "$INSTALL_DIR/autopkglib/trustcache"
+cp Code/autopkglib/xar/*.py "$INSTALL_DIR/autopkglib/xar"
 cp Code/autopkglib/version.plist "$INSTALL_DIR/autopkglib/"
 
 echo "Copying server"